@@ -0,0 +1,326 @@
+"""Load benchmark for the bot's handlers.
+
+Replays a synthetic party: guests send links and searches, add search
+results, look at and edit their lists, pause and unpause, while an admin
+calls /next. Telegram and the YouTube API are faked, so the numbers are
+the bot's own time. Prints p50/p99 latency per handler and the updates
+handled per second of wall time, and compares them with the last run of
+the same workload in the history.
+
+    poetry run python src/bench_bot.py --guests 2000 --updates 20000
+"""
+
+import argparse
+import asyncio
+import contextlib
+import datetime
+import itertools
+import os
+import random
+import tempfile
+import time
+import zlib
+from collections import defaultdict
+from types import SimpleNamespace
+from typing import Iterator
+
+import httpx
+from telegram import CallbackQuery, Chat, Message, Update, User
+
+import benchmark
+import bot as karaoke
+from storage import open_storage
+from youtube import VideoFormatter
+
+ADMIN = "bench_admin"
+ADMIN_ID = 1
+
+
+class FakeBot:
+    """Stands in for telegram.Bot: every API call succeeds at once.
+
+    Calls that send a message return one, so that it can be edited later.
+    """
+
+    defaults = None
+
+    def __init__(self):
+        self.calls = 0
+        self._ids = itertools.count(1)
+
+    def __getattr__(self, name: str):
+        async def call(*args, **kwargs):
+            self.calls += 1
+            if not name.startswith("send_"):
+                return True
+            chat_id = kwargs.get("chat_id", args[0] if args else 0)
+            chat = Chat(id=chat_id, type="private")
+            message = Message(
+                message_id=next(self._ids),
+                date=datetime.datetime.now(),
+                chat=chat,
+                text=kwargs.get("text", ""),
+            )
+            message.set_bot(self)
+            return message
+
+        return call
+
+
+def search_results(query: str) -> list[str]:
+    """URLs of the videos that the fake API finds for the query"""
+    key = zlib.crc32(query.encode())
+    return [f"https://www.youtube.com/watch?v=s{key}x{i}" for i in range(3)]
+
+
+def fake_youtube(latency: float = 0.0) -> httpx.AsyncClient:
+    """A YouTube Data API that knows every video and finds three per search"""
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        await asyncio.sleep(latency)
+        if request.url.path.endswith("/search"):
+            query = request.url.params["q"]
+            items = [
+                {
+                    "id": {"videoId": url.rpartition("=")[2]},
+                    "snippet": {
+                        "title": f"{query} #{i}",
+                        "channelTitle": "Karaoke Channel",
+                        "thumbnails": {"default": {"url": "https://i.ytimg.com/x.jpg"}},
+                    },
+                }
+                for i, url in enumerate(search_results(query))
+            ]
+        else:
+            items = [
+                {
+                    "id": yt_id,
+                    "snippet": {"title": f"Song {yt_id}"},
+                    "contentDetails": {"duration": "PT3M30S"},
+                }
+                for yt_id in request.url.params["id"].split(",")
+            ]
+        return httpx.Response(200, json={"items": items})
+
+    return httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+
+class Workload:
+    """Synthetic updates for `guests` guests and one admin"""
+
+    # relative frequency of what a guest does next
+    ACTIONS = {
+        "link": 40,
+        "search": 8,
+        "add": 8,
+        "list": 15,
+        "edit": 10,
+        "pause": 4,
+        "queue": 5,
+    }
+
+    def __init__(
+        self,
+        tgbot: FakeBot,
+        guests: int,
+        songs: int,
+        next_every: int,
+        seed: int = 0,
+    ):
+        self.tgbot = tgbot
+        self.guests = guests
+        self.songs = songs
+        self.next_every = next_every
+        self.random = random.Random(seed)
+        self.paused: set[int] = set()
+        self.found: dict[int, list[str]] = {}
+        self._ids = itertools.count(1)
+        self.admin = User(id=ADMIN_ID, first_name="Admin", is_bot=False, username=ADMIN)
+
+    def guest(self, uid: int) -> User:
+        return User(id=uid, first_name=f"Guest {uid}", is_bot=False)
+
+    def message(self, user: User, text: str) -> Update:
+        chat = Chat(id=user.id, type="private")
+        message = Message(
+            message_id=next(self._ids),
+            date=datetime.datetime.now(),
+            chat=chat,
+            from_user=user,
+            text=text,
+        )
+        update = Update(update_id=next(self._ids), message=message)
+        for obj in (chat, message, update):
+            obj.set_bot(self.tgbot)
+        return update
+
+    def button(self, user: User, action: str, **params) -> Update:
+        data = karaoke.btn("", action, **params).callback_data
+        chat = Chat(id=user.id, type="private")
+        message = Message(
+            message_id=next(self._ids),
+            date=datetime.datetime.now(),
+            chat=chat,
+            text="Song list:",
+        )
+        query = CallbackQuery(
+            id=str(next(self._ids)),
+            from_user=user,
+            chat_instance="bench",
+            data=data,
+            message=message,
+        )
+        update = Update(update_id=next(self._ids), callback_query=query)
+        for obj in (chat, message, query, update):
+            obj.set_bot(self.tgbot)
+        return update
+
+    def updates(self, count: int) -> Iterator[tuple[str, Update]]:
+        """(handler name, update) pairs"""
+        actions = list(self.ACTIONS)
+        weights = list(self.ACTIONS.values())
+        for n in range(count):
+            if self.next_every and n % self.next_every == self.next_every - 1:
+                yield "next", self.message(self.admin, "/next")
+                continue
+            uid = ADMIN_ID + 1 + self.random.randrange(self.guests)
+            user = self.guest(uid)
+            match self.random.choices(actions, weights)[0]:
+                case "link":
+                    song = self.random.randrange(self.songs)
+                    yield "request_song", self.message(
+                        user, f"https://youtu.be/v{song}"
+                    )
+                case "search":
+                    query = f"artist {self.random.randrange(self.songs)}"
+                    self.found[uid] = search_results(query + " karaoke")
+                    yield "request_song", self.message(user, query)
+                case "add" if self.found:
+                    found = self.found[self.random.choice(list(self.found))]
+                    url = self.random.choice(found)
+                    yield "button_callback", self.button(user, "add", u=url)
+                case "add" | "list":
+                    yield "list_songs", self.message(user, "/list")
+                case "edit":
+                    action = self.random.choice(("move_up", "move_down", "delete"))
+                    index = self.random.randrange(3)
+                    yield "button_callback", self.button(user, action, i=index, u=uid)
+                case "pause" if uid in self.paused:
+                    self.paused.discard(uid)
+                    yield "unpause", self.message(user, "/unpause")
+                case "pause":
+                    self.paused.add(uid)
+                    yield "pause", self.message(user, "/pause")
+                case "queue":
+                    yield "list_all_queues", self.message(user, "/queue")
+
+
+async def run(args: argparse.Namespace) -> dict[str, dict[str, float]]:
+    """Replay the workload and return the latency summary per handler"""
+    with contextlib.ExitStack() as stack:
+        directory = stack.enter_context(tempfile.TemporaryDirectory())
+        db = open_storage(f"{args.storage}:{os.path.join(directory, 'bench')}")
+        stack.callback(db.close)
+        # the formatter prints every title it fetches
+        devnull = stack.enter_context(open(os.devnull, "w"))
+        stack.enter_context(contextlib.redirect_stdout(devnull))
+
+        stack.callback(setattr, karaoke, "ADMIN_USERNAMES", karaoke.ADMIN_USERNAMES)
+        karaoke.ADMIN_USERNAMES = ADMIN
+        bot = karaoke.KaraokeBot(db, coalesce_writes=args.coalesce_writes)
+        bot.formatter = VideoFormatter(
+            "key", db, http=fake_youtube(args.api_latency / 1000)
+        )
+        tgbot = FakeBot()
+        context = SimpleNamespace(bot=tgbot)
+        workload = Workload(tgbot, args.guests, args.songs, args.next_every, args.seed)
+
+        latencies: dict[str, list[float]] = defaultdict(list)
+        limit = asyncio.Semaphore(args.concurrency)
+
+        async def handle(name: str, update: Update) -> None:
+            try:
+                start = time.perf_counter()
+                await getattr(bot, name)(update, context)
+                if args.coalesce_writes:
+                    await bot.flush_state(update, context)
+                latencies[name].append(time.perf_counter() - start)
+            finally:
+                limit.release()
+
+        tasks = set()
+        started = time.perf_counter()
+        for name, update in workload.updates(args.updates):
+            # at most `concurrency` updates in flight; the rest wait here
+            await limit.acquire()
+            task = asyncio.create_task(handle(name, update))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - started
+        await bot.drain()
+        await bot.formatter.drain()
+
+    results = {
+        name: benchmark.summarize(samples) for name, samples in latencies.items()
+    }
+    # updates handled per second of wall time, with the handlers overlapping
+    results["total"] = benchmark.summarize(sum(latencies.values(), [])) | {
+        "ops_per_sec": args.updates / elapsed
+    }
+    return results
+
+
+def format_results(results: dict[str, dict[str, float]]) -> str:
+    lines = [f"{'handler':<18}{'count':>8}{'serial/s':>12}{'p50 ms':>10}{'p99 ms':>10}"]
+    for name, row in sorted(results.items(), key=lambda item: item[0] == "total"):
+        lines.append(
+            f"{name:<18}{row['count']:>8}{row['calls_per_sec_serial']:>12.0f}"
+            f"{row['p50_ms']:>10.3f}{row['p99_ms']:>10.3f}"
+        )
+    lines.append(f"{results['total']['ops_per_sec']:.0f} updates/sec overall")
+    return "\n".join(lines)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--guests", type=int, default=1000)
+    parser.add_argument("--songs", type=int, default=5000)
+    parser.add_argument("--updates", type=int, default=10000)
+    parser.add_argument(
+        "--next-every", type=int, default=25, help="an admin /next per N updates"
+    )
+    parser.add_argument(
+        "--storage", choices=("memory", "shelve", "sqlite"), default="memory"
+    )
+    parser.add_argument("--coalesce-writes", action="store_true")
+    parser.add_argument("--concurrency", type=int, default=karaoke.CONCURRENT_UPDATES)
+    parser.add_argument(
+        "--api-latency", type=float, default=0, help="YouTube API latency, ms"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--history", default=benchmark.HISTORY)
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="report handlers whose p99 grew by more than this fraction",
+    )
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    print(format_results(results))
+
+    params = {k: v for k, v in vars(args).items() if k not in ("history", "tolerance")}
+    previous = benchmark.record("bot", params, results, args.history)
+    if previous is None:
+        return
+    print(f"\nCompared with {previous['revision']} ({previous['time']}):")
+    slower = benchmark.regressions(
+        previous["results"], results, "p99_ms", args.tolerance
+    )
+    print("\n".join(slower) if slower else "no regressions")
+
+
+if __name__ == "__main__":
+    main()
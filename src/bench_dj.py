@@ -0,0 +1,226 @@
+"""Scaling curves for DJ operations.
+
+Fills a party with N singers (three songs each) on each storage backend
+and times single calls of each operation. Anything that a call changes
+and that would skew the next one is put back between calls, outside
+the timed part. Prints the median time per call for each party size
+on a log scale, together with the fitted growth exponent: about 0 is
+constant time, 1 is linear.
+
+    poetry run python src/bench_dj.py --sizes 10,100,1000,10000
+"""
+
+import argparse
+import math
+import os
+import random
+import statistics
+import tempfile
+import time
+from typing import Callable
+
+import benchmark
+from dj import DJ
+from party import Party
+from storage import Storage, open_storage
+
+SONGS_PER_SINGER = 3
+
+
+def song(user: int, n: int) -> str:
+    return f"https://youtu.be/u{user}s{n}"
+
+
+def populate(db: Storage, singers: int) -> DJ:
+    """A DJ, fresh from storage, for a party of `singers` singers"""
+    party = Party(db, 0)
+    # written out once at the end: filling in a big party one write per
+    # singer takes minutes, and it is not what is measured
+    dj = DJ(party, coalesce_writes=True)
+    for user in range(1, singers + 1):
+        dj.register(user, f"@singer{user}")
+        for n in range(SONGS_PER_SINGER):
+            dj.enqueue(user, song(user, n))
+    dj.flush()
+    return DJ(party)
+
+
+# Each case sets up a call on the DJ: it returns the timed call and
+# what to run after it to put the state back.
+Case = Callable[[DJ, random.Random, int], tuple[Callable, Callable | None]]
+
+
+def enqueue(dj, rnd, singers):
+    user = rnd.randint(1, singers)
+    link = song(user, SONGS_PER_SINGER)
+    return (lambda: dj.enqueue(user, link)), (lambda: dj.remove_song(user, -1))
+
+
+def next_singer(dj, rnd, singers):
+    def give_back():
+        singer, link = dj.current
+        dj.enqueue(singer, link)
+
+    return dj.next, give_back
+
+
+def peek_next(dj, rnd, singers):
+    return dj.peek_next, None
+
+
+def get_upcoming_singers(dj, rnd, singers):
+    return dj.get_upcoming_singers, None
+
+
+def show_all_queues(dj, rnd, singers):
+    return (lambda: dj.show_all_queues(requester=1, is_admin=True)), None
+
+
+def get_queue_json(dj, rnd, singers):
+    # displays ask for the queue after it has changed; a rename will do
+    user = rnd.randint(1, singers)
+    dj.register(user, f"@singer{user}-{rnd.random()}")
+    return dj.get_queue_json, None
+
+
+def move_song(dj, rnd, singers):
+    user = rnd.randint(1, singers)
+    return (lambda: dj.move_song(user, "move_down", 0)), None
+
+
+def remove_with_id(dj, rnd, singers):
+    user = rnd.randint(1, singers)
+    songs = list(dj.user_song_lists.peek(user))
+
+    def rejoin():
+        for link in songs:
+            dj.enqueue(user, link)
+
+    return (lambda: dj.remove_with_id(user)), rejoin
+
+
+CASES: dict[str, Case] = {
+    "enqueue": enqueue,
+    "next": next_singer,
+    "peek_next": peek_next,
+    "get_upcoming_singers": get_upcoming_singers,
+    "show_all_queues": show_all_queues,
+    "get_queue_json": get_queue_json,
+    "move_song": move_song,
+    "remove_with_id": remove_with_id,
+}
+
+
+def measure(
+    dj: DJ, case: Case, singers: int, calls: int, budget: float, seed: int
+) -> float:
+    """Median seconds per call, over `calls` calls or as many as fit in
+    `budget` seconds, but at least three"""
+    rnd = random.Random(seed)
+    timings: list[float] = []
+    deadline = time.perf_counter() + budget
+    while len(timings) < calls and (len(timings) < 3 or time.perf_counter() < deadline):
+        call, restore = case(dj, rnd, singers)
+        start = time.perf_counter()
+        call()
+        timings.append(time.perf_counter() - start)
+        if restore is not None:
+            restore()
+    return statistics.median(timings)
+
+
+def growth(sizes: list[int], seconds: list[float]) -> float:
+    """Slope of the least-squares line through log(time) against log(size)"""
+    xs = [math.log(size) for size in sizes]
+    ys = [math.log(max(s, 1e-9)) for s in seconds]
+    mean_x, mean_y = statistics.fmean(xs), statistics.fmean(ys)
+    spread = sum((x - mean_x) ** 2 for x in xs)
+    if not spread:
+        return 0.0
+    return sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / spread
+
+
+def plot(curves: dict[str, dict[int, float]], width: int = 40) -> str:
+    """Bars on a log scale, one group per operation"""
+    everything = [s for curve in curves.values() for s in curve.values()]
+    low = math.log10(min(everything))
+    high = math.log10(max(everything))
+    scale = width / (high - low) if high > low else 0
+    lines = [f"{'':<30}{'singers':>8}  time per call (log scale)"]
+    for name, curve in curves.items():
+        exponent = growth(list(curve), list(curve.values()))
+        for i, (size, seconds) in enumerate(curve.items()):
+            bar = "#" * (1 + round((math.log10(seconds) - low) * scale))
+            label = f"{name} ~n^{exponent:.1f}" if i == 0 else ""
+            lines.append(f"{label:<30}{size:>8}  {bar} {seconds * 1e6:.1f} us")
+    return "\n".join(lines)
+
+
+def run(
+    backend: str,
+    sizes: list[int],
+    cases: list[str],
+    calls: int,
+    budget: float = 1.0,
+    seed: int = 0,
+) -> dict[str, dict[int, float]]:
+    """Median seconds per call of each case at each party size"""
+    curves: dict[str, dict[int, float]] = {name: {} for name in cases}
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            db = open_storage(f"{backend}:{os.path.join(directory, 'bench')}")
+            try:
+                dj = populate(db, size)
+                for name in cases:
+                    curves[name][size] = measure(
+                        dj, CASES[name], size, calls, budget, seed
+                    )
+            finally:
+                db.close()
+    return curves
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--sizes", default="10,100,1000,10000")
+    parser.add_argument(
+        "--backends", default="memory,shelve", help="memory, shelve and/or sqlite"
+    )
+    parser.add_argument("--ops", default=",".join(CASES), help="operations to time")
+    parser.add_argument("--calls", type=int, default=200, help="calls per point")
+    parser.add_argument(
+        "--budget", type=float, default=1.0, help="seconds per point, at most"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--history", default=benchmark.HISTORY)
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="report points that got slower by more than this fraction",
+    )
+    args = parser.parse_args()
+    sizes = [int(size) for size in args.sizes.split(",")]
+    cases = args.ops.split(",")
+
+    for backend in args.backends.split(","):
+        curves = run(backend, sizes, cases, args.calls, args.budget, args.seed)
+        print(f"\n{backend}:\n{plot(curves)}")
+
+        results = {
+            f"{name}@{size}": {"median_us": seconds * 1e6}
+            for name, curve in curves.items()
+            for size, seconds in curve.items()
+        }
+        params = {"backend": backend, "sizes": sizes, "calls": args.calls}
+        previous = benchmark.record("dj", params, results, args.history)
+        if previous is not None:
+            slower = benchmark.regressions(
+                previous["results"], results, "median_us", args.tolerance
+            )
+            print(f"Compared with {previous['revision']}:")
+            print("\n".join(slower) if slower else "no regressions")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""Helpers shared by the bench_*.py scripts: latency summaries and a
+history of results keyed by git commit, so that runs can be compared
+across commits.
+"""
+
+import datetime
+import json
+import math
+import os
+import subprocess
+from typing import Any
+
+HISTORY = os.path.join(os.path.dirname(__file__), "..", "bench_history.jsonl")
+
+Result = dict[str, Any]
+
+
+def percentile(samples: list[float], q: float) -> float:
+    """The q-th percentile (0..100) of the samples, nearest-rank"""
+    if not samples:
+        return math.nan
+    ordered = sorted(samples)
+    rank = max(math.ceil(q / 100 * len(ordered)), 1)
+    return ordered[rank - 1]
+
+
+def summarize(samples: list[float]) -> dict[str, float]:
+    """Count and p50/p99 in ms of per-operation latencies.
+
+    `calls_per_sec_serial` is the rate if the operations ran one after
+    another, which is 1 / mean latency; throughput of operations that
+    overlap has to be measured against wall time.
+    """
+    total = sum(samples)
+    return {
+        "count": len(samples),
+        "calls_per_sec_serial": len(samples) / total if total else math.inf,
+        "p50_ms": percentile(samples, 50) * 1000,
+        "p99_ms": percentile(samples, 99) * 1000,
+    }
+
+
+def git_revision() -> str:
+    """The commit checked out, with a + when there are local changes"""
+
+    def git(*args: str) -> str:
+        return subprocess.run(
+            ["git", *args],
+            capture_output=True,
+            text=True,
+            cwd=os.path.dirname(__file__) or ".",
+        ).stdout.strip()
+
+    revision = git("rev-parse", "--short", "HEAD") or "unknown"
+    return revision + (
+        "+" if git("status", "--porcelain", "--untracked-files=no") else ""
+    )
+
+
+def record(
+    name: str, params: dict[str, Any], results: Result, path: str = HISTORY
+) -> Result | None:
+    """Append the results to the history and return the latest earlier run
+    of the same benchmark with the same parameters, if any"""
+    previous = None
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                entry = json.loads(line)
+                if entry["name"] == name and entry["params"] == params:
+                    previous = entry
+    entry = {
+        "name": name,
+        "revision": git_revision(),
+        "time": datetime.datetime.now().isoformat(timespec="seconds"),
+        "params": params,
+        "results": results,
+    }
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(entry) + "\n")
+    return previous
+
+
+def regressions(
+    previous: Result, results: Result, key: str, tolerance: float
+) -> list[str]:
+    """Rows whose `key` grew by more than `tolerance` (0.2 is 20%)"""
+    slower = []
+    for row, values in results.items():
+        before = previous.get(row, {}).get(key)
+        if before and values[key] > before * (1 + tolerance):
+            slower.append(f"{row}: {key} {before:.3f} -> {values[key]:.3f}")
+    return slower
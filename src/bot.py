@@ -1,15 +1,20 @@
 #!./venv/bin/python3
+import startup  # first, so that it can time the imports below
 import os
 import asyncio
 import logging
-import shelve
 import json
-from functools import wraps
+import hmac
+import html
+import secrets
+from functools import partial, wraps
+from typing import TYPE_CHECKING, Awaitable
 from telegram import (
     Update,
     User,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
+    InputMediaPhoto,
     Message,
     MaybeInaccessibleMessage,
 )
@@ -20,14 +25,22 @@ from telegram.ext import (
     MessageHandler,
     filters,
     CallbackContext,
+    TypeHandler,
 )
 from telegram.constants import ParseMode
-from aiohttp import web
 from dotenv import load_dotenv
 
+from dispatch import Delivery, Dispatcher
 from dj import DJ
+from journal import Journal
+import metrics
 from party import Party
-from youtube import VideoFormatter, SongInfo
+from parties import ActiveParty, PartyRegistry
+from storage import Storage, as_storage, open_storage
+
+if TYPE_CHECKING:
+    from aiohttp import web
+    from youtube import SongInfo
 
 load_dotenv()
 
@@ -47,6 +60,38 @@ YOUTUBE_API_KEY = os.environ.get("YOUTUBE_API_KEY")
 
 ADMIN_USERNAMES = os.environ.get("ADMIN_USERNAMES", "")
 
+# Where to keep the state: shelve:PATH, sqlite:PATH or memory:
+STORAGE = os.environ.get("STORAGE", "shelve:bot")
+
+# Write state changes once per handled update instead of once per change
+COALESCE_WRITES = os.environ.get("COALESCE_WRITES", "") not in ("", "0")
+
+# Receive updates at WEBHOOK_URL + WEBHOOK_PATH (this server's public address)
+# instead of polling. Telegram sends WEBHOOK_SECRET with every update; a
+# random one is used if it is not set.
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "")
+WEBHOOK_PATH = "/telegram"
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")
+
+# Keep each party's queue in an operation journal in this directory, which
+# also lets /undo take back any change. Party storage is then not updated.
+JOURNAL_DIR = os.environ.get("JOURNAL_DIR", "")
+
+# How many updates are handled at the same time
+CONCURRENT_UPDATES = int(os.environ.get("CONCURRENT_UPDATES", "32"))
+
+
+HANDLER_SECONDS = metrics.Histogram(
+    "bot_handler_seconds", "Time to handle an update", ["handler"]
+)
+HANDLER_ERRORS = metrics.Counter(
+    "bot_handler_errors_total", "Updates whose handler raised an exception"
+)
+DISPLAYS = metrics.Gauge("displays_connected", "Connected queue displays", ["party"])
+QUEUE_DEPTH = metrics.Gauge(
+    "queue_singers", "Singers in the rotation of each loaded party", ["party"]
+)
+
 
 def is_url(text: str) -> bool:
     return text.startswith("https://")
@@ -68,13 +113,25 @@ async def maybe(coro):
         logger.error(f"Error: {e}")
 
 
+async def gather_logged(*aws: Awaitable) -> None:
+    """Run the awaitables concurrently, logging each one that fails"""
+    for result in await asyncio.gather(*aws, return_exceptions=True):
+        if isinstance(result, Exception):
+            logger.error(f"Error: {result}")
+
+
+def measured(func):
+    """Record how long the handler takes in HANDLER_SECONDS"""
+    return metrics.timed(HANDLER_SECONDS, handler=func.__name__)(func)
+
+
 def admin_only(func):
     @wraps(func)
     async def wrapper(self, update: Update, context: CallbackContext, *args, **kwargs):
         message = update.message
         if not (message and message.from_user and message.from_user.username):
             return
-        if not self.is_admin(message.from_user.username):
+        if not self.is_admin(message.from_user):
             await message.reply_text("Only the admin can use this command.")
             return
         return await func(self, update, context, *args, **kwargs)
@@ -88,19 +145,81 @@ def btn(text: str, action: str, **params) -> InlineKeyboardButton:
 
 
 class KaraokeBot:
-    def __init__(self, db: shelve.Shelf):
-        self.formatter = (
-            VideoFormatter(YOUTUBE_API_KEY, db) if YOUTUBE_API_KEY else None
+    def __init__(self, db: Storage | dict, coalesce_writes: bool = False):
+        db = as_storage(db)
+        self.formatter = None
+        if YOUTUBE_API_KEY:
+            from youtube import VideoFormatter  # only with a YouTube API key
+
+            self.formatter = VideoFormatter(YOUTUBE_API_KEY, db)
+        self.coalesce_writes = coalesce_writes
+        self.dispatcher = Dispatcher()
+        self._background: set[asyncio.Future] = set()
+        self.parties = PartyRegistry(
+            db, self._make_dj, default_admins=set(ADMIN_USERNAMES.split(","))
+        )
+
+    def register_metrics(self) -> None:
+        """Report this bot's parties in the gauges served at /metrics"""
+        DISPLAYS.callback = lambda: {
+            (str(id),): len(party.displays) for id, party in self.parties.active.items()
+        }
+        QUEUE_DEPTH.callback = lambda: {
+            (str(id),): len(party.dj.new_users) + len(party.dj.queue)
+            for id, party in self.parties.active.items()
+        }
+
+    async def initialize(self, application: Application) -> None:
+        """Connect to Telegram while a worker thread reads the default party"""
+        await asyncio.gather(
+            application.initialize(), asyncio.to_thread(self.parties.get, 0)
+        )
+
+    def _make_dj(self, party: Party) -> DJ:
+        journal = None
+        if JOURNAL_DIR:
+            journal = Journal(os.path.join(JOURNAL_DIR, f"party{party.id}.jsonl"))
+        return DJ(
+            party, self.formatter, coalesce_writes=self.coalesce_writes, journal=journal
+        )
+
+    @property
+    def dj(self) -> DJ:
+        """The DJ of the default party"""
+        return self.parties.get(0).dj
+
+    def _party(self, user: User) -> ActiveParty:
+        return self.parties.for_user(user.id)
+
+    def send_to_party(
+        self, party: ActiveParty, bot, messages: list[tuple[int, str]], **kwargs
+    ) -> Delivery:
+        """Queue messages for the party's users; those who blocked the bot
+        are dropped from that party"""
+        return self.dispatcher.submit(
+            bot, messages, on_blocked=partial(self._forget_chat, party.id), **kwargs
         )
-        self.dj = DJ(Party(db, 0, set(ADMIN_USERNAMES.split(","))), self.formatter)
-        self.last_msg_with_buttons: Message | None = None
-        self.websockets = []
 
-    def _register(self, user: User) -> None:
-        self.dj.register(user.id, format_name(user))
+    def _forget_chat(self, party_id: int, chat_id: int) -> None:
+        self.parties.get(party_id).dj.unregister(chat_id)
+
+    async def flush_state(self, update: object, context: CallbackContext) -> None:
+        for party in self.parties.active.values():
+            party.dj.flush()
 
+    def _register(self, user: User) -> ActiveParty:
+        party = self._party(user)
+        party.dj.register(user.id, format_name(user))
+        return party
+
+    @measured
     async def start(self, update: Update, context: CallbackContext) -> None:
         assert update.message is not None
+        words = (update.message.text or "").split()
+        if len(words) == 2 and words[1].startswith("party"):
+            # deep link: https://t.me/<bot>?start=party<id>
+            await self.join_impl(update, words[1].removeprefix("party"))
+            return
         await update.message.reply_html(
             "\n".join(
                 (
@@ -115,6 +234,7 @@ class KaraokeBot:
                     "/queue — view singer queue",
                     "/pause — take a break from singing",
                     "/unpause — continue singing",
+                    "/join N — move to party number N",
                 )
                 + (
                     (
@@ -125,31 +245,65 @@ class KaraokeBot:
                         "/notready — pause current singer and move on",
                         "/reset — clear all queues",
                         "/admins [+newadmin] [-oldadmin] — show or update the list of admins",
+                        "/newparty — start another party with its own queue",
                     )
-                    if self.is_admin(update.message.from_user.username)
+                    if self.is_admin(update.message.from_user)
                     else ()
                 )
             )
         )
 
-    async def send_search_result_with_thumbnail(self, bot, chat_id, result) -> None:
-        await bot.sendPhoto(chat_id, result["thumbnail"])
+    @staticmethod
+    def search_result_caption(result: dict[str, str]) -> str:
+        return (
+            f"{html.escape(result['title'])}\n<i>{html.escape(result['channel'])}</i>"
+        )
 
-        button = [[btn("Add to my list", "add", u=result["url"])]]
-        reply_markup = InlineKeyboardMarkup(button)
+    async def send_search_results(
+        self, bot, chat_id: int, results: list[dict[str, str]]
+    ) -> None:
+        """Send the results as an album followed by their buttons"""
+        if len(results) == 1:
+            [result] = results
+            await bot.send_photo(
+                chat_id,
+                result["thumbnail"],
+                caption=self.search_result_caption(result),
+                parse_mode=ParseMode.HTML,
+                reply_markup=InlineKeyboardMarkup(
+                    [[btn("Add to my list", "add", u=result["url"])]]
+                ),
+            )
+            return
 
-        text = f"{result['title']}\n<i>{result['channel']}</i>"
-        await bot.sendMessage(
-            chat_id, text, reply_markup=reply_markup, parse_mode=ParseMode.HTML
+        # albums cannot have buttons, so they come in a message of their own
+        await bot.send_media_group(
+            chat_id,
+            [
+                InputMediaPhoto(
+                    result["thumbnail"],
+                    caption=f"{i}. {self.search_result_caption(result)}",
+                    parse_mode=ParseMode.HTML,
+                )
+                for i, result in enumerate(results, start=1)
+            ],
+        )
+        keyboard = [
+            [btn(f"➕ {i}. {result['title'][:40]}", "add", u=result["url"])]
+            for i, result in enumerate(results, start=1)
+        ]
+        await bot.send_message(
+            chat_id, "Add to my list:", reply_markup=InlineKeyboardMarkup(keyboard)
         )
 
+    @measured
     async def request_song(self, update: Update, context: CallbackContext) -> None:
         message = update.message
         if message.chat.type != "private":
             return
         assert message and message.from_user
         user = message.from_user
-        self._register(user)
+        party = self._register(user)
         song = message.text or ""
 
         if not is_url(song):
@@ -158,20 +312,24 @@ class KaraokeBot:
                     chat_id=message.chat_id, action="typing"
                 )
                 results = await self.formatter.search_youtube(song)
-                for r in results:
-                    await self.send_search_result_with_thumbnail(
-                        context.bot, message.chat_id, r
+                if results:
+                    await self.send_search_results(
+                        context.bot, message.chat_id, results
                     )
                 return
             await self.reply_text(message, "Invalid link. Please try again.")
             return
 
-        enqueued = self.dj.enqueue(user.id, song)
+        # replies go out after the lock is released, so that other updates
+        # to the party do not wait for Telegram
+        async with party.lock:
+            enqueued = party.dj.enqueue(user.id, song)
+            if enqueued:
+                await self.update_websockets(party)
         if not enqueued:
             await self.reply_text(message, "This song is already on your /list")
             return
         await self.reply_text(message, "Your song request has been added to your /list")
-        await self.update_websockets()
         if self.formatter:
             await self.formatter.register_url(song)
 
@@ -195,8 +353,12 @@ class KaraokeBot:
     async def enqueue_from_callback(self, update: Update, song: str) -> None:
         assert update.callback_query
         user = update.callback_query.from_user
-        self._register(user)
-        if not self.dj.enqueue(user.id, song):
+        party = self._register(user)
+        async with party.lock:
+            enqueued = party.dj.enqueue(user.id, song)
+            if enqueued:
+                await self.update_websockets(party)
+        if not enqueued:
             return
         await self.reply_text(
             update.callback_query.message,
@@ -205,27 +367,55 @@ class KaraokeBot:
         if self.formatter:
             await self.formatter.register_url(song)
 
+    @measured
     @admin_only
     async def next(self, update: Update, context: CallbackContext) -> None:
         assert update.message is not None
-        await self.next_impl(update.message)
+        await self.next_impl(self._party(update.message.from_user), update.message)
 
-    async def update_websockets(self, sockets=None) -> None:
-        queue_json = self.dj.get_queue_json()
-        for ws in sockets or self.websockets:
-            try:
-                await ws.send_str(queue_json)
-            except Exception as e:
-                logger.error(f"Error sending message to websocket: {e}")
-
-    async def next_impl(self, message: Message) -> None:
-        text, url = self.dj.next()
+    async def update_websockets(self, party: ActiveParty) -> None:
+        if not party.displays:
+            party.published = None
+            return
+        snapshot = party.dj.get_queue_snapshot()
+        if snapshot is party.published:
+            return
+        if party.published is None:
+            frame = snapshot.data
+        else:
+            frame = party.dj.get_queue_delta(party.published)
+        party.published = snapshot
+        party.displays.broadcast(frame, snapshot.data)
+
+    async def add_display(self, ws, party_id: int = 0) -> None:
+        party = self.parties.get(party_id)
+        await self.update_websockets(party)
+        snapshot = party.dj.get_queue_snapshot()
+        party.displays.add(ws, snapshot.data)
+        party.published = snapshot
+
+    def remove_display(self, ws, party_id: int = 0) -> None:
+        self.parties.get(party_id).displays.remove(ws)
+
+    def display_message(self, ws, text: str, party_id: int = 0) -> None:
+        party = self.parties.get(party_id)
+        if text == "resync":
+            # the version that the next delta will be based on
+            snapshot = party.published or party.dj.get_queue_snapshot()
+            party.displays.send(ws, snapshot.data)
+
+    async def next_impl(self, party: ActiveParty, message: Message) -> None:
+        # one /next at a time, so that admin cards go out in queue order
+        async with party.lock:
+            await self._next(party, message)
+
+    async def _next(self, party: ActiveParty, message: Message) -> None:
+        text, url = party.dj.next()
         if not url:
             await message.chat.send_message(text)
             return
 
-        self.dj.peek_next()
-        await self.update_websockets()
+        party.dj.peek_next()
 
         song_button = InlineKeyboardButton(text="▶️ Play song", url=url)
         not_ready_button = btn("⏳ Singer not ready", "not_ready")
@@ -241,56 +431,63 @@ class KaraokeBot:
             disable_web_page_preview=True,
         )
 
-        if self.last_msg_with_buttons:
-            await self.last_msg_with_buttons.edit_reply_markup(reply_markup=None)
-        self.last_msg_with_buttons = sent
-
-        await self.notify_next_singers(message.get_bot())
-
-    async def notify_next_singers(self, bot) -> None:
-        upcoming = self.dj.get_upcoming_singers()
+        # The room is waiting for the card above; everything else can
+        # happen while the singer walks up.
+        previous, party.last_msg_with_buttons = party.last_msg_with_buttons, sent
+        self.notify_next_singers(party, message.get_bot())
+        side_effects = [self.update_websockets(party)]
+        if previous:
+            side_effects.append(previous.edit_reply_markup(reply_markup=None))
+        self.in_background(gather_logged(*side_effects))
+
+    def in_background(self, work: Awaitable) -> None:
+        task = asyncio.ensure_future(work)
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    async def drain(self) -> None:
+        """Wait until background work and queued messages are done"""
+        while self._background:
+            await asyncio.gather(*self._background)
+        await self.dispatcher.drain()
+
+    def notify_next_singers(self, party: ActiveParty, bot) -> None:
+        upcoming = party.dj.get_upcoming_singers()
         if not upcoming:
             return
         next_singer, ready = upcoming[0]
         if ready:
-            await maybe(
-                bot.send_message(
-                    chat_id=next_singer,
-                    text="You are next in the queue. Get ready to sing!",
-                )
-            )
+            messages = [(next_singer, "You are next in the queue. Get ready to sing!")]
         else:
-            await maybe(
-                bot.send_message(
-                    chat_id=next_singer,
-                    text="You are next in the queue. Add a song to your list to sing next!",
+            messages = [
+                (
+                    next_singer,
+                    "You are next in the queue. Add a song to your list to sing next!",
                 )
-            )
+            ]
 
         for i, (singer, ready) in enumerate(upcoming[1:], start=1):
             if i == 1:
                 condition = "the singer ahead of you is not ready"
             else:
                 condition = f"the {i} singers ahead of you are not ready"
-            await maybe(
-                bot.send_message(
-                    singer,
-                    text=f"You may be called to sing next if {condition}",
-                )
-            )
+            messages.append((singer, f"You may be called to sing next if {condition}"))
+        self.send_to_party(party, bot, messages)
 
+    @measured
     async def button_callback(self, update: Update, context: CallbackContext) -> None:
         await update.callback_query.answer()
         data = json.loads(update.callback_query.data)
+        user = update.callback_query.from_user
 
         match action := data.get("a"):
             case "not_ready":
-                if self.is_admin(update.callback_query.from_user.username):
+                if self.is_admin(user):
                     await self.notready_impl(update)
             case "next":
-                if self.is_admin(update.callback_query.from_user.username):
+                if self.is_admin(user):
                     assert update.effective_message is not None
-                    await self.next_impl(update.effective_message)
+                    await self.next_impl(self._party(user), update.effective_message)
             case "noop":
                 return
             case "add":
@@ -304,22 +501,25 @@ class KaraokeBot:
         self, update: Update, uid: int, action: str, index: int
     ) -> None:
         user = update.callback_query.from_user
-        if uid != user.id and not self.is_admin(user.username):
+        if uid != user.id and not self.is_admin(user):
             logger.warning(f"non-admin user {user} attempts to modify others' lists")
             return
 
-        if action == "delete":
-            action_taken = self.dj.remove_song(uid, index)
-        else:
-            action_taken = self.dj.move_song(uid, action, index)
+        party = self._party(user)
+        async with party.lock:
+            if action == "delete":
+                action_taken = party.dj.remove_song(uid, index)
+            else:
+                action_taken = party.dj.move_song(uid, action, index)
         if not action_taken:
             return
-        songs = self.dj.get_queue(uid)
+        songs = party.dj.get_queue(uid)
         text = "Song list:" if songs else "Song list is empty"
         await update.callback_query.edit_message_text(
             text, reply_markup=self.generate_list_markup(songs, uid)
         )
 
+    @measured
     @admin_only
     async def admins(self, update: Update, context: CallbackContext) -> None:
         themselves = update.message.from_user.username
@@ -332,56 +532,79 @@ class KaraokeBot:
                 update.message, "You cannot promote or demote yourself"
             )
             return
-        text = self.dj.admins_cmd(words)
+        party = self._party(update.message.from_user)
+        async with party.lock:
+            text = party.dj.admins_cmd(words)
         await self.reply_text(update.message, text)
 
+    @measured
     @admin_only
     async def notready(self, update: Update, context: CallbackContext) -> None:
         await self.notready_impl(update)
 
     async def notready_impl(self, update: Update) -> None:
-        msgs = self.dj.notready()
-        for chat_id, text in msgs:
-            if chat_id is None:
-                chat_id = update.effective_message.chat_id
-            await update.get_bot().send_message(chat_id=chat_id, text=text)
+        party = self._party(update.effective_user)
+        async with party.lock:
+            messages = [
+                (update.effective_message.chat_id if chat_id is None else chat_id, text)
+                for chat_id, text in party.dj.notready()
+            ]
+        # delivered without holding up the next command
+        delivery = self.send_to_party(party, update.get_bot(), messages)
+        self.in_background(self.log_delivery(delivery, "/notready"))
 
+    @measured
     @admin_only
     async def remove(self, update: Update, context: CallbackContext) -> None:
-        msg = self.dj.remove()
-        await self.reply_text(update.message, msg)
+        party = self._party(update.message.from_user)
+        async with party.lock:
+            text = party.dj.remove()
+            await self.update_websockets(party)
+        await self.reply_text(update.message, text)
 
+    @measured
     @admin_only
     async def remove_with_id(self, update: Update, context: CallbackContext) -> None:
         index = int(update.message.text.removeprefix("/remove"))
-        msg = self.dj.remove_with_id(index)
-        await self.reply_text(update.message, msg)
+        party = self._party(update.message.from_user)
+        async with party.lock:
+            text = party.dj.remove_with_id(index)
+            await self.update_websockets(party)
+        await self.reply_text(update.message, text)
 
+    @measured
     async def clear(self, update: Update, context: CallbackContext) -> None:
-        self._register(update.message.from_user)
-        msg = self.dj.clear(update.message.chat_id)
+        party = self._register(update.message.from_user)
+        async with party.lock:
+            msg = party.dj.clear(update.message.chat_id)
         await self.reply_text(update.message, msg)
 
+    @measured
     @admin_only
     async def undo(self, update: Update, context: CallbackContext) -> None:
-        for to, text in self.dj.undo():
-            if to is None:
-                await self.reply_text(update.message, text)
-            else:
-                await update.get_bot().send_message(chat_id=to, text=text)
+        party = self._party(update.message.from_user)
+        async with party.lock:
+            messages = [
+                (update.message.chat_id if chat_id is None else chat_id, text)
+                for chat_id, text in party.dj.undo()
+            ]
+            await self.update_websockets(party)
+        delivery = self.send_to_party(party, update.get_bot(), messages)
+        self.in_background(self.log_delivery(delivery, "/undo"))
 
+    @measured
     @admin_only
     async def reset(self, update: Update, context: CallbackContext) -> None:
-        messages = self.dj.reset()
-        for chat_id, text in messages:
-            try:
-                if chat_id is None:
-                    await self.reply_text(update.message, text)
-                else:
-                    await update.get_bot().send_message(chat_id=chat_id, text=text)
-            except Exception as e:
-                logger.error(f"Error sending message to {chat_id}: {e}")
+        party = self._party(update.message.from_user)
+        async with party.lock:
+            messages = [
+                (update.message.chat_id if chat_id is None else chat_id, text)
+                for chat_id, text in party.dj.reset()
+            ]
+        delivery = self.send_to_party(party, update.get_bot(), messages)
+        self.in_background(self.log_delivery(delivery, "/reset"))
 
+    @measured
     @admin_only
     async def tell(self, update: Update, context: CallbackContext) -> None:
         words = update.message.text.split(None, 2)
@@ -391,24 +614,41 @@ class KaraokeBot:
         uid = int(words[1])
         await update.get_bot().send_message(chat_id=uid, text=words[2])
 
+    @measured
     @admin_only
     async def bcast(self, update: Update, context: CallbackContext) -> None:
         text = update.message.text.removeprefix("/bcast ")
-        for uid in self.dj.names:
-            await asyncio.sleep(0.1)
-            try:
-                await update.get_bot().send_message(chat_id=uid, text=text)
-            except Exception:
-                pass
+        party = self._party(update.message.from_user)
+        users = list(party.dj.names)
+        delivery = self.send_to_party(
+            party, update.get_bot(), [(uid, text) for uid in users]
+        )
+        status = await update.message.reply_text(f"Broadcasting to {len(users)} users")
+        self.in_background(self.report_progress(status, delivery))
+
+    @staticmethod
+    async def log_delivery(delivery: Delivery, command: str) -> None:
+        await delivery.wait()
+        if delivery.failed:
+            logger.warning(f"Messages of {command}: {delivery}")
 
+    @staticmethod
+    async def report_progress(
+        status: Message, delivery: Delivery, interval: float = 5.0
+    ) -> None:
+        while not await delivery.wait(interval):
+            await maybe(status.edit_text(f"Broadcasting: {delivery}"))
+        await maybe(status.edit_text(f"Broadcast done: {delivery}"))
+
+    @measured
     async def list_songs(self, update: Update, context: CallbackContext) -> None:
         user = update.message.from_user
-        self._register(user)
+        party = self._register(user)
 
         command_id = update.message.text.removeprefix("/list")
         uid = int(command_id) if command_id else user.id
 
-        songs = self.dj.get_queue(uid)
+        songs = party.dj.get_queue(uid)
         text = "Song list:" if songs else "Song list is empty"
         await update.get_bot().send_message(
             chat_id=user.id,
@@ -417,7 +657,7 @@ class KaraokeBot:
         )
 
     @staticmethod
-    def generate_list_markup(songs: list[SongInfo], uid: int) -> InlineKeyboardMarkup:
+    def generate_list_markup(songs: "list[SongInfo]", uid: int) -> InlineKeyboardMarkup:
         # Build the list display with buttons
         keyboard = []
         empty_button_text = "⠀"  # Invisible separator character (U+2800)
@@ -434,21 +674,28 @@ class KaraokeBot:
             keyboard.append(buttons)
         return InlineKeyboardMarkup(keyboard)
 
+    @measured
     async def pause(self, update: Update, context: CallbackContext) -> None:
         user = update.message.from_user
-        self._register(user)
-        await self.reply_text(update.message, self.dj.pause(user.id))
-        await self.update_websockets()
+        party = self._register(user)
+        async with party.lock:
+            text = party.dj.pause(user.id)
+            await self.update_websockets(party)
+        await self.reply_text(update.message, text)
 
+    @measured
     async def unpause(self, update: Update, context: CallbackContext) -> None:
         user = update.message.from_user
-        self._register(user)
-        await self.reply_text(update.message, self.dj.unpause(user.id))
-        await self.update_websockets()
+        party = self._register(user)
+        async with party.lock:
+            text = party.dj.unpause(user.id)
+            await self.update_websockets(party)
+        await self.reply_text(update.message, text)
 
+    @measured
     async def list_all_queues(self, update: Update, context: CallbackContext) -> None:
-        is_admin = self.is_admin(update.message.from_user.username)
-        text = self.dj.show_all_queues(
+        is_admin = self.is_admin(update.message.from_user)
+        text = self._party(update.message.from_user).dj.show_all_queues(
             requester=update.message.chat.id, is_admin=is_admin
         )
         await self.reply_text(
@@ -459,17 +706,145 @@ class KaraokeBot:
             show_error=True,
         )
 
-    def is_admin(self, username: str) -> bool:
-        return self.dj.is_admin(username)
+    @measured
+    @admin_only
+    async def new_party(self, update: Update, context: CallbackContext) -> None:
+        user = update.message.from_user
+        party = await self.move_to_party(user, self.parties.create(user.username).id)
+        bot_name = update.get_bot().username
+        await self.reply_text(
+            update.message,
+            f"Party {party.id} is ready and you are its admin.\n"
+            f"Guests join with /join {party.id} or "
+            f"https://t.me/{bot_name}?start=party{party.id}\n"
+            f"Queue display: /party/{party.id} on the web server",
+        )
+
+    @measured
+    async def join(self, update: Update, context: CallbackContext) -> None:
+        party_id = update.message.text.removeprefix("/join").strip()
+        if not party_id:
+            party = self._party(update.message.from_user)
+            await self.reply_text(update.message, f"You are in party {party.id}")
+            return
+        await self.join_impl(update, party_id)
+
+    async def join_impl(self, update: Update, party_id: str) -> None:
+        user = update.message.from_user
+        if not (party_id.isdigit() and self.parties.exists(int(party_id))):
+            await self.reply_text(update.message, "There is no such party")
+            return
+        party = await self.move_to_party(user, int(party_id))
+        await self.reply_text(
+            update.message,
+            f"Welcome to party {party.id}! Send a YouTube link or a search term "
+            "to add a song to your /list",
+        )
+
+    async def move_to_party(self, user: User, party_id: int) -> ActiveParty:
+        """Make the user a member of the party, and take them and their
+        songs off the queue of the party they were in"""
+        old = self._party(user)
+        if old.id != party_id:
+            async with old.lock:
+                old.dj.leave(user.id)
+                await self.update_websockets(old)
+        party = self.parties.join(user.id, party_id)
+        party.dj.register(user.id, format_name(user))
+        return party
+
+    def is_admin(self, user: User | None) -> bool:
+        if user is None or not user.username:
+            return False
+        return self._party(user).dj.is_admin(user.username)
 
 
 async def error_handler(update: object, context: CallbackContext) -> None:
+    HANDLER_ERRORS.inc()
     logger.error(f"Exception while handling an update ({update}): {context.error}")
 
 
+def init_web_app(
+    bot: KaraokeBot,
+    application: Application | None = None,
+    secret_token: str | None = None,
+) -> "web.Application":
+    """The queue displays, and the webhook if `application` is given.
+
+    Webhook requests must carry `secret_token`, which is required then.
+    """
+    from aiohttp import web, WSMsgType  # not needed until the bot is up
+
+    if application is not None and not secret_token:
+        raise ValueError("The webhook needs a secret token")
+
+    def requested_party(request) -> int:
+        party_id = int(request.match_info.get("party", 0))
+        if not bot.parties.exists(party_id):
+            raise web.HTTPNotFound()
+        return party_id
+
+    async def websocket_handler(request):
+        party_id = requested_party(request)
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        await bot.add_display(ws, party_id)  # Send initial queue state
+
+        try:
+            async for msg in ws:
+                if msg.type == WSMsgType.TEXT:
+                    bot.display_message(ws, msg.data, party_id)
+        finally:
+            bot.remove_display(ws, party_id)
+            await ws.close()
+        return ws
+
+    async def static_handler(request):
+        requested_party(request)
+        return web.FileResponse("queue.html")
+
+    async def metrics_handler(request):
+        return web.Response(
+            text=metrics.REGISTRY.render(),
+            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+        )
+
+    async def webhook_handler(request):
+        token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(token.encode(), secret_token.encode()):
+            raise web.HTTPForbidden()
+        try:
+            update = Update.de_json(await request.json(), application.bot)
+        except (ValueError, KeyError, TypeError, AttributeError):
+            # not JSON, or not an update
+            raise web.HTTPBadRequest()
+        await application.update_queue.put(update)
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_get("/ws", websocket_handler)
+    app.router.add_get("/", static_handler)
+    app.router.add_get(r"/party/{party:\d+}/ws", websocket_handler)
+    app.router.add_get(r"/party/{party:\d+}", static_handler)
+    app.router.add_get("/metrics", metrics_handler)
+    if application is not None:
+        app.router.add_post(WEBHOOK_PATH, webhook_handler)
+    return app
+
+
 def main() -> None:
-    application = Application.builder().token(TOKEN).build()
-    bot = KaraokeBot(shelve.open("bot"))
+    # Handlers that change a party's queue take the party's lock; searches,
+    # song lists and /queue run alongside them.
+    with startup.phase("build application"):
+        application = (
+            Application.builder()
+            .token(TOKEN)
+            .concurrent_updates(CONCURRENT_UPDATES)
+            .build()
+        )
+    with startup.phase("open storage"):
+        bot = KaraokeBot(open_storage(STORAGE), coalesce_writes=COALESCE_WRITES)
+        bot.register_metrics()
 
     application.add_handler(CommandHandler("start", bot.start))
     application.add_handler(CommandHandler("help", bot.start))
@@ -491,6 +866,8 @@ def main() -> None:
     application.add_handler(CommandHandler("undo", bot.undo))
     application.add_handler(CommandHandler("tell", bot.tell))
     application.add_handler(CommandHandler("bcast", bot.bcast))
+    application.add_handler(CommandHandler("newparty", bot.new_party))
+    application.add_handler(CommandHandler("join", bot.join))
 
     application.add_handler(
         MessageHandler(
@@ -507,45 +884,48 @@ def main() -> None:
 
     application.add_handler(CallbackQueryHandler(bot.button_callback))
 
-    application.add_error_handler(error_handler)
+    if COALESCE_WRITES:
+        # runs after the handler of every update (handlers above are in group 0)
+        application.add_handler(TypeHandler(object, bot.flush_state), group=1)
 
-    async def websocket_handler(request):
-        print("running websocket_handler")
-        ws = web.WebSocketResponse()
-        print("preparing request")
-        await ws.prepare(request)
-        bot.websockets.append(ws)
-        await bot.update_websockets([ws])  # Send initial queue state
+    application.add_error_handler(error_handler)
 
-        try:
-            async for msg in ws:
-                print("Received message:", msg)
-        finally:
-            bot.websockets.remove(ws)
-            await ws.close()
-        return ws
+    webhook_secret = WEBHOOK_SECRET or secrets.token_urlsafe(32)
 
-    async def static_handler(request):
-        return web.FileResponse("queue.html")
+    async def start_http_server():
+        from aiohttp import web
 
-    async def init_http_server():
-        app = web.Application()
-        app.router.add_get("/ws", websocket_handler)
-        app.router.add_get("/", static_handler)
+        app = init_web_app(bot, application if WEBHOOK_URL else None, webhook_secret)
         runner = web.AppRunner(app)
         await runner.setup()
         site = web.TCPSite(runner, "0.0.0.0", 8080)
         await site.start()
         print("HTTP server running on http://0.0.0.0:8080")
-        while True:
-            await asyncio.sleep(3600)  # Keep the server running
+
+    async def start_updates():
+        await application.start()
+        if WEBHOOK_URL:
+            await application.bot.set_webhook(
+                WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+                secret_token=webhook_secret,
+                allowed_updates=Update.ALL_TYPES,
+            )
+        else:
+            await application.updater.start_polling()
 
     # Run both the Telegram bot and the HTTP server concurrently
     async def run():
-        await application.initialize()
-        await application.start()
-        await application.updater.start_polling()
-        await init_http_server()
+        with startup.phase("connect to Telegram, load party 0"):
+            await bot.initialize(application)
+        with startup.phase("start updates and web server"):
+            await asyncio.gather(start_updates(), start_http_server())
+        startup.report()
+        while True:
+            await asyncio.sleep(60)  # Keep the server running
+            try:
+                bot.parties.evict_idle()
+            except Exception as e:
+                logger.error(f"Error evicting idle parties: {e}")
 
     asyncio.run(run())
 
@@ -1,17 +1,27 @@
 import asyncio
+import json
+import threading
 import websockets
 import argparse
 from selenium import webdriver
+from selenium.common.exceptions import TimeoutException
 from selenium.webdriver.common.by import By
 from selenium.webdriver.chrome.service import Service
 from selenium.webdriver.chrome.options import Options
-import time
+from selenium.webdriver.support import expected_conditions as EC
+from selenium.webdriver.support.ui import WebDriverWait
 
 # WebSocket server settings
 WEBSOCKET_SERVER_URI = (
     "ws://karaoke.myltsev.ru:8080/ws"  # Replace with your WebSocket server URI
 )
 
+# How long to wait for the video player to show up on a page
+READY_TIMEOUT = 15
+
+FULLSCREEN_BUTTON = "button.ytp-fullscreen-button"
+AUTONAV_BUTTON = ".ytp-autonav-toggle-button"
+
 
 # Initialize Selenium WebDriver
 def setup_driver():
@@ -19,6 +29,8 @@ def setup_driver():
     options.add_argument("--disable-infobars")
     options.add_argument("--disable-extensions")
     options.add_argument("--start-maximized")
+    # return from get() once the DOM is there; the player is waited for below
+    options.page_load_strategy = "eager"
     service = Service(
         "/usr/local/bin/chromedriver"
     )  # Replace with the path to your WebDriver
@@ -26,35 +38,198 @@ def setup_driver():
     return driver
 
 
-# WebSocket client to receive URLs
-async def websocket_client(driver, uri):
+class QueueFollower:
+    """The current and the next song, as told by the queue frames.
+
+    The server sends a snapshot when we connect and deltas after that.
+    """
+
+    def __init__(self):
+        self.version: int | None = None
+        self.current_url = ""
+        self.next_url = ""
+
+    def feed(self, message: str | bytes) -> bool:
+        """Apply a frame; False when it does not follow the last one or
+        cannot be read"""
+        try:
+            return self._apply(json.loads(message))
+        except (ValueError, KeyError, TypeError) as e:
+            print(f"Bad frame {message!r}: {e}")
+            return False
+
+    def _apply(self, frame: dict) -> bool:
+        if frame["type"] == "snapshot":
+            self.version = frame["version"]
+            self.current_url = frame["current"]["url"]
+            self.next_url = (frame.get("next") or {}).get("url", "")
+            return True
+        if frame["from"] != self.version:
+            return False
+        self.version = frame["version"]
+        for op in frame["ops"]:
+            if op["op"] == "current":
+                self.current_url = op["current"]["url"]
+            elif op["op"] == "next":
+                self.next_url = (op["next"] or {}).get("url", "")
+        return True
+
+
+class Player:
+    """Drives the browser from a thread of its own.
+
+    `play()` and `preload()` return at once. The worker opens only the
+    latest URL it was given: URLs that arrive while a page loads replace
+    the ones not yet opened, and a page that is superseded while its
+    player loads is left alone.
+
+    The song to preload is opened in a background tab. When it is then
+    played, that tab is brought to the front instead of loading the page
+    again.
+
+    The last URLs given are remembered across reconnects, so the song on
+    screen is not opened again when the server tells us about it anew.
+    """
+
+    def __init__(self, driver, ready_timeout: float = READY_TIMEOUT):
+        self.driver = driver
+        self.ready_timeout = ready_timeout
+        self._changed = threading.Condition()
+        self._latest: str | None = None
+        self._preload: str | None = None
+        self._generation = 0
+        self._stopping = False
+        self.playing: str | None = None
+        self.preloading: str | None = None
+        # the background tab and the URL it was opened with
+        self._preloaded: tuple[str, str] | None = None
+        self._thread = threading.Thread(target=self._run, name="player", daemon=True)
+        self._thread.start()
+
+    def play(self, url: str) -> None:
+        if url == self.playing:
+            return
+        print(f"Playing {url}")
+        self.playing = url
+        with self._changed:
+            self._latest = url
+            self._generation += 1
+            self._changed.notify()
+
+    def preload(self, url: str) -> None:
+        if url == self.preloading:
+            return
+        self.preloading = url
+        with self._changed:
+            self._preload = url
+            self._changed.notify()
+
+    def stop(self) -> None:
+        with self._changed:
+            self._stopping = True
+            self._changed.notify()
+        self._thread.join()
+
+    def _superseded(self, generation: int) -> bool:
+        return self._stopping or self._generation != generation
+
+    def _run(self) -> None:
+        while True:
+            with self._changed:
+                self._changed.wait_for(
+                    lambda: self._stopping or self._latest or self._preload is not None
+                )
+                if self._stopping:
+                    return
+                # playing goes first: the room is waiting for it
+                url, self._latest = self._latest, None
+                preload, self._preload = self._preload, None
+                if url is not None:
+                    self._preload = preload
+                generation = self._generation
+            try:
+                if url is not None:
+                    self._open(url, generation)
+                elif preload is not None:
+                    self._open_in_background(preload)
+            except Exception as e:
+                print(f"Error: {e}")
+
+    def _open_in_background(self, url: str) -> None:
+        if self._preloaded and self._preloaded[1] == url:
+            return
+        self._close_background_tab()
+        if not url:
+            return
+        print(f"Preloading {url}")
+        # Target.createTarget opens the tab without bringing it to the
+        # front, and Chrome holds its video until the tab is shown
+        target = self.driver.execute_cdp_cmd(
+            "Target.createTarget", {"url": url, "background": True}
+        )
+        self._preloaded = (target["targetId"], url)
+
+    def _close_background_tab(self) -> None:
+        if self._preloaded is not None:
+            target, _ = self._preloaded
+            self._preloaded = None
+            self.driver.execute_cdp_cmd("Target.closeTarget", {"targetId": target})
+
+    def _open(self, url: str, generation: int) -> None:
+        if self._preloaded and self._preloaded[1] == url:
+            print(f"Switching to {url}")
+            tab, _ = self._preloaded
+            self._preloaded = None
+            previous = self.driver.current_window_handle
+            self.driver.switch_to.window(tab)
+            self.driver.execute_cdp_cmd("Target.activateTarget", {"targetId": tab})
+            self.driver.execute_cdp_cmd("Target.closeTarget", {"targetId": previous})
+            self.driver.execute_script("document.querySelector('video')?.play()")
+        else:
+            print(f"Opening {url}")
+            self.driver.get(url)
+
+        fullscreen_ready = EC.element_to_be_clickable(
+            (By.CSS_SELECTOR, FULLSCREEN_BUTTON)
+        )
+        try:
+            WebDriverWait(self.driver, self.ready_timeout, poll_frequency=0.1).until(
+                lambda driver: self._superseded(generation) or fullscreen_ready(driver)
+            )
+        except TimeoutException:
+            print(f"Player did not load in {self.ready_timeout} s: {url}")
+            return
+        if self._superseded(generation):
+            return
+
+        try:
+            autonav = self.driver.find_element(By.CSS_SELECTOR, AUTONAV_BUTTON)
+            if autonav.get_attribute("aria-checked") == "true":
+                autonav.click()
+        except Exception as e:
+            print(f"Error: {e}")
+
+        try:
+            play_button = self.driver.find_element(By.CSS_SELECTOR, FULLSCREEN_BUTTON)
+            play_button.click()
+        except Exception as e:
+            print(f"Error: {e}")
+
+
+# WebSocket client to follow the queue
+async def websocket_client(player, uri):
     async with websockets.connect(uri) as websocket:
         print(f"Connected to WebSocket server at {uri}")
+        queue = QueueFollower()
         try:
             async for message in websocket:
-                print(f"Received URL: {message}")
-                # Navigate to the received URL
-                driver.get(message)
-
-                # Wait for the video player to load
-                time.sleep(3)
-
-                try:
-                    autonav = driver.find_element(
-                        By.CSS_SELECTOR, ".ytp-autonav-toggle-button"
-                    )
-                    if autonav.get_attribute("aria-checked") == "true":
-                        autonav.click()
-                except Exception as e:
-                    print(f"Error: {e}")
-
-                try:
-                    play_button = driver.find_element(
-                        By.CSS_SELECTOR, "button.ytp-fullscreen-button"
-                    )
-                    play_button.click()
-                except Exception as e:
-                    print(f"Error: {e}")
+                if not queue.feed(message):
+                    await websocket.send("resync")
+                    continue
+                # the player thread loads them; the loop stays free for pings
+                if queue.current_url:
+                    player.play(queue.current_url)
+                player.preload(queue.next_url)
 
         except websockets.ConnectionClosed:
             print("WebSocket connection closed.")
@@ -64,16 +239,19 @@ async def websocket_client(driver, uri):
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--uri", default=WEBSOCKET_SERVER_URI)
+    parser.add_argument("--ready-timeout", type=float, default=READY_TIMEOUT)
     args = parser.parse_args()
 
     driver = setup_driver()
+    player = Player(driver, args.ready_timeout)
     try:
         while True:
             try:
-                asyncio.run(websocket_client(driver, args.uri))
+                asyncio.run(websocket_client(player, args.uri))
             except Exception as e:
                 print(f"Error: {e}")
     finally:
+        player.stop()
         driver.quit()
 
 
@@ -0,0 +1,198 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from datetime import timedelta
+from typing import Any, Awaitable, Callable, Iterable
+
+from telegram.error import Forbidden, RetryAfter
+
+logger = logging.getLogger(__name__)
+
+# Telegram lets a bot send about 30 messages per second overall and about
+# one per second to the same chat, with short bursts allowed.
+GLOBAL_RATE = 25.0
+CHAT_RATE = 1.0
+CHAT_BURST = 3
+
+
+class TokenBucket:
+    def __init__(
+        self, rate: float, burst: float, clock: Callable[[], float] = time.monotonic
+    ):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.tokens = float(burst)
+        self.updated = clock()
+
+    def reserve(self) -> float:
+        """Take a token; returns how long to wait before using it"""
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return max(0.0, -self.tokens / self.rate)
+
+    def hold(self, seconds: float) -> None:
+        """Hand out no tokens for `seconds`"""
+        self.reserve()
+        self.tokens = min(self.tokens + 1, 0.0) - seconds * self.rate
+
+
+class Delivery:
+    """Progress of a batch of messages"""
+
+    def __init__(self, total: int, on_blocked: Callable[[int], None] | None = None):
+        self.total = total
+        # called with the chats that blocked the bot, instead of the
+        # dispatcher's own on_blocked
+        self.on_blocked = on_blocked
+        self.delivered = 0
+        self.failed = 0
+        self.blocked: list[int] = []
+        self._done = asyncio.Event()
+        if not total:
+            self._done.set()
+
+    @property
+    def sent(self) -> int:
+        return self.delivered + self.failed
+
+    def _count(self, delivered: bool) -> None:
+        if delivered:
+            self.delivered += 1
+        else:
+            self.failed += 1
+        if self.sent == self.total:
+            self._done.set()
+
+    async def wait(self, timeout: float | None = None) -> bool:
+        """Whether all messages were sent (or given up on) within `timeout`"""
+        try:
+            await asyncio.wait_for(self._done.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    def __str__(self) -> str:
+        text = f"delivered {self.delivered} of {self.total}"
+        if self.failed:
+            text += f", {self.failed} failed"
+        if self.blocked:
+            text += f" ({len(self.blocked)} users blocked the bot)"
+        return text
+
+
+class Dispatcher:
+    """Sends messages in the background within Telegram's rate limits.
+
+    Each chat has a lane of its own so its messages keep their order;
+    at most `concurrency` requests are in flight at a time. Chats that
+    blocked the bot are reported to `on_blocked`.
+    """
+
+    def __init__(
+        self,
+        concurrency: int = 8,
+        global_rate: float = GLOBAL_RATE,
+        chat_rate: float = CHAT_RATE,
+        chat_burst: int = CHAT_BURST,
+        max_retries: int = 3,
+        on_blocked: Callable[[int], None] | None = None,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], Awaitable[Any]] = asyncio.sleep,
+    ):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.on_blocked = on_blocked
+        self.clock = clock
+        self.sleep = sleep
+        self._global = TokenBucket(global_rate, global_rate, clock)
+        self._chats: dict[int, TokenBucket] = {}
+        self._lanes: dict[int, deque[tuple[Any, str, dict, Delivery]]] = {}
+        self._slots = asyncio.Semaphore(concurrency)
+        self._tasks: set[asyncio.Task] = set()
+
+    def submit(
+        self,
+        bot,
+        messages: Iterable[tuple[int, str]],
+        on_blocked: Callable[[int], None] | None = None,
+        **kwargs,
+    ) -> Delivery:
+        """Queue (chat id, text) pairs; kwargs go to send_message"""
+        messages = list(messages)
+        delivery = Delivery(len(messages), on_blocked)
+        for chat_id, text in messages:
+            if (lane := self._lanes.get(chat_id)) is None:
+                lane = self._lanes[chat_id] = deque()
+                task = asyncio.create_task(self._drain(chat_id, lane))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+            lane.append((bot, text, kwargs, delivery))
+        return delivery
+
+    async def send(
+        self, bot, messages: Iterable[tuple[int, str]], **kwargs
+    ) -> Delivery:
+        delivery = self.submit(bot, messages, **kwargs)
+        await delivery.wait()
+        return delivery
+
+    async def drain(self) -> None:
+        while self._tasks:
+            await asyncio.gather(*self._tasks)
+
+    async def _drain(self, chat_id: int, lane: deque) -> None:
+        try:
+            while lane:
+                bot, text, kwargs, delivery = lane.popleft()
+                outcome = await self._send(bot, chat_id, text, kwargs)
+                if outcome != "blocked":
+                    delivery._count(outcome == "delivered")
+                    continue
+                # nothing else will get through either
+                dropped = [delivery] + [entry[3] for entry in lane]
+                lane.clear()
+                callbacks = [each.on_blocked or self.on_blocked for each in dropped]
+                for callback in dict.fromkeys(callbacks):
+                    if callback:
+                        callback(chat_id)
+                for each in dict.fromkeys(dropped):
+                    each.blocked.append(chat_id)
+                for each in dropped:
+                    each._count(False)
+        finally:
+            del self._lanes[chat_id]
+            self._chats.pop(chat_id, None)
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        if (bucket := self._chats.get(chat_id)) is None:
+            bucket = self._chats[chat_id] = TokenBucket(
+                self.chat_rate, self.chat_burst, self.clock
+            )
+        return bucket
+
+    async def _send(self, bot, chat_id: int, text: str, kwargs: dict) -> str:
+        for _ in range(self.max_retries + 1):
+            delay = max(self._chat_bucket(chat_id).reserve(), self._global.reserve())
+            if delay:
+                await self.sleep(delay)
+            async with self._slots:
+                try:
+                    await bot.send_message(chat_id=chat_id, text=text, **kwargs)
+                    return "delivered"
+                except RetryAfter as e:
+                    retry_after = e.retry_after
+                    if isinstance(retry_after, timedelta):
+                        retry_after = retry_after.total_seconds()
+                    logger.warning(f"Flood control, pausing for {retry_after}s")
+                    self._global.hold(retry_after)
+                except Forbidden:
+                    return "blocked"
+                except Exception as e:
+                    logger.error(f"Error sending message to {chat_id}: {e}")
+                    return "failed"
+        return "failed"
@@ -0,0 +1,97 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+SEND_LAG = metrics.Histogram(
+    "display_send_lag_seconds", "Time from a queue change to a display getting it"
+)
+
+
+class Display:
+    """A connected queue display with its own outbox and sender task.
+
+    When the display falls behind and its outbox is full, the queued frames
+    are replaced with the full latest state.
+    """
+
+    def __init__(self, hub: "DisplayHub", ws, outbox_size: int):
+        self.hub = hub
+        self.ws = ws
+        # frames with the time they were queued
+        self.outbox: deque[tuple[bytes, float]] = deque(maxlen=outbox_size)
+        self._ready = asyncio.Event()
+        self.task = asyncio.create_task(self._run())
+
+    def send(self, frame: bytes, latest_state: bytes | None = None) -> None:
+        if latest_state is not None and len(self.outbox) == self.outbox.maxlen:
+            self.outbox.clear()
+            frame = latest_state
+        self.outbox.append((frame, time.perf_counter()))
+        self._ready.set()
+
+    async def _run(self) -> None:
+        from aiohttp import WSMsgType  # loaded by the web server by now
+
+        while True:
+            await self._ready.wait()
+            self._ready.clear()
+            while self.outbox:
+                frame, queued = self.outbox.popleft()
+                try:
+                    await asyncio.wait_for(
+                        self.ws.send_frame(frame, WSMsgType.TEXT),
+                        self.hub.send_timeout,
+                    )
+                except Exception as e:
+                    logger.error(f"Dropping display after failed send: {e!r}")
+                    self.hub.remove(self.ws)
+                    await self._close()
+                    return
+                SEND_LAG.observe(time.perf_counter() - queued)
+
+    async def _close(self) -> None:
+        try:
+            await asyncio.wait_for(self.ws.close(), self.hub.send_timeout)
+        except Exception as e:
+            logger.error(f"Error closing websocket: {e!r}")
+
+
+class DisplayHub:
+    """Fans frames out to all connected displays without waiting for any of them.
+
+    Frames are UTF-8 encoded text, sent as is so that every display shares
+    the same buffer.
+    """
+
+    def __init__(self, send_timeout: float = 5.0, outbox_size: int = 1):
+        self.send_timeout = send_timeout
+        self.outbox_size = outbox_size
+        self.displays: dict[object, Display] = {}
+
+    def add(self, ws, initial_frame: bytes) -> Display:
+        display = Display(self, ws, self.outbox_size)
+        self.displays[ws] = display
+        display.send(initial_frame)
+        return display
+
+    def remove(self, ws) -> None:
+        if display := self.displays.pop(ws, None):
+            if display.task is not asyncio.current_task():
+                display.task.cancel()
+
+    def send(self, ws, frame: bytes) -> None:
+        if display := self.displays.get(ws):
+            display.send(frame)
+
+    def broadcast(self, frame: bytes, latest_state: bytes | None = None) -> None:
+        """Send `frame` to everyone, or `latest_state` to displays that are behind"""
+        for display in self.displays.values():
+            display.send(frame, latest_state)
+
+    def __len__(self) -> int:
+        return len(self.displays)
@@ -1,39 +1,181 @@
-from collections import defaultdict
-from youtube import VideoFormatter, SongInfo
 from gettext import ngettext
 from telegram_markdown_text import MarkdownText
-from collections import namedtuple
+from collections import OrderedDict, namedtuple
 from party import Party
+from queue_delta import diff_queue
+from rotation import Rotation
+from eta import EtaTracker
+from journal import Journal, Record
+from song_lists import SongLists
+from itertools import chain, islice
+from dataclasses import dataclass
+from functools import wraps
+from typing import TYPE_CHECKING, Any, Iterable, Iterator
 import json
 
+if TYPE_CHECKING:
+    from youtube import VideoFormatter, SongInfo
+
 QueueEntry = namedtuple("QueueEntry", ["singer", "is_ready"])
 
 
+@dataclass(frozen=True)
+class QueueSnapshot:
+    version: int
+    state: dict[str, Any]
+    text: str
+    data: bytes
+
+
+# Assumed length of songs we know nothing about, in seconds
+DEFAULT_SONG_DURATION = 240
+
+# DJ attributes that are persisted under the party key of the same name
+GLOBALS = ("admins", "names", "queue", "new_users", "current", "paused", "undo_list")
+
+# Song lists kept in memory, not counting those of the singers at the head
+# of the rotation, who are always kept
+RESIDENT_SONG_LISTS = 256
+RESIDENT_HEAD = 16
+
+# How many steps back /undo can go
+UNDO_DEPTH = 50
+
+# With a journal: the admin commands that /undo takes back, and how to
+# describe them. What guests did in the meantime stays.
+UNDOABLE = {
+    "next": "/next",
+    "notready": "/notready",
+    "remove": "/remove",
+    "remove_with_id": "removal of {user}",
+    "reset": "/reset",
+}
+
+# Journal records kept before the journal is compacted into a snapshot
+COMPACT_AFTER = 500
+
+
+def operation(method):
+    """Record calls that change the DJ's state in its journal, if it has one"""
+
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.journal is None or self._in_operation:
+            return method(self, *args, **kwargs)
+        version = self.version
+        self._in_operation = True
+        try:
+            result = method(self, *args, **kwargs)
+        finally:
+            self._in_operation = False
+        if self.version != version:
+            record = {"op": method.__name__, "args": list(args)}
+            if kwargs:
+                record["kwargs"] = kwargs
+            self._record(record)
+        return result
+
+    return wrapper
+
+
 class DJ:
-    def __init__(self, party: Party, formatter: VideoFormatter | None = None):
+    def __init__(
+        self,
+        party: Party,
+        formatter: "VideoFormatter | None" = None,
+        coalesce_writes: bool = False,
+        journal: Journal | None = None,
+    ):
         self.party = party
         self.formatter = formatter
+        # When set, the state is kept in the journal instead of the party
+        self.journal = journal
+        self._in_operation = False
+        # When set, changes are only written out by an explicit flush()
+        self.coalesce_writes = coalesce_writes
+        self._dirty: set[str] = set()
+        self._dirty_song_lists: set[int] = set()
+        # bumped on every change so that derived views can be cached
+        self.version = 0
+        self._snapshot: QueueSnapshot | None = None
+        self._snapshot_key: tuple[int, int] | None = None
         self.admins: set[str] = self.party.get("admins")
         self.names: dict[int, str] = self.party.get("names", {})
-        self.queue: list[int] = self.party.get("queue", [])
-        self.new_users: list[int] = self.party.get("new_users", [])
+        # singers who have sung and are waiting for their next turn
+        self._queue = Rotation(self.party.get("queue", []))
+        # singers who have not sung yet; they go before everyone in the queue
+        self._new_users = Rotation(self.party.get("new_users", []))
         self.paused: set[int] = self.party.get("paused", set())
-        self.user_song_lists: dict[int, list[str]] = self.load_song_lists()
+        self.user_song_lists = self.load_song_lists()
         self.current: tuple[int, str] = self.party.get("current")
         self.undo_list: list[tuple[str, int]] = self.party.get("undo_list", [])
+        # user -> first song, formatter generation and the song's duration
+        # for as many singers as there are resident song lists
+        self._head_durations: OrderedDict[int, tuple[str, int, float]] = OrderedDict()
+        self._etas = EtaTracker(self._next_song_duration)
+        self._etas_generation = 0
+        if journal is not None:
+            self._open_journal()
+
+    @property
+    def queue(self) -> Rotation:
+        return self._queue
+
+    @queue.setter
+    def queue(self, users: Iterable[int]) -> None:
+        self._queue = Rotation(users)
+        self._etas.invalidate()
+        self._changed("queue")
+
+    @property
+    def new_users(self) -> Rotation:
+        return self._new_users
+
+    @new_users.setter
+    def new_users(self, users: Iterable[int]) -> None:
+        self._new_users = Rotation(users)
+        self._etas.invalidate()
+        self._changed("new_users")
+
+    def _rotation(self) -> Iterator[int]:
+        return chain(self.new_users, self.queue)
+
+    def _in_rotation(self, user: int) -> bool:
+        return user in self.new_users or user in self.queue
+
+    def _changed(self, *fields: str) -> None:
+        self._dirty.update(fields)
+        self.version += 1
 
     def save_global(self):
-        self.party["admins"] = self.admins
-        self.party["names"] = self.names
-        self.party["queue"] = self.queue
-        self.party["new_users"] = self.new_users
-        self.party["current"] = self.current
-        self.party["paused"] = self.paused
-        self.party["undo_list"] = self.undo_list
+        if not self.coalesce_writes:
+            self.flush()
+
+    def flush(self) -> None:
+        """Write the fields and song lists that changed since the last flush"""
+        if self.journal is not None:
+            # already in the journal
+            self._dirty.clear()
+            self._dirty_song_lists.clear()
+            return
+        if not (self._dirty or self._dirty_song_lists):
+            return
+        with self.party.batch():
+            for field in GLOBALS:
+                if field in self._dirty:
+                    value = getattr(self, field)
+                    if isinstance(value, Rotation):
+                        value = list(value)
+                    self.party[field] = value
+            for user in self._dirty_song_lists:
+                self.party.save_song_list(user, self.user_song_lists.peek(user))
+        self._dirty.clear()
+        self._dirty_song_lists.clear()
 
     def is_admin(self, user: str) -> bool:
         return user in self.admins
 
+    @operation
     def admins_cmd(self, modifications: list[str]):
         if not modifications:
             return self._format_admins()
@@ -44,15 +186,27 @@ class DJ:
                 self.admins.remove(mod[1:])
             else:
                 return "Invalid modification: " + mod
+            self._changed("admins")
         self.save_global()
         return self._format_admins()
 
     def _format_admins(self) -> str:
         return f"Admins: @{', @'.join(sorted(self.admins))}"
 
-    def load_song_lists(self):
-        loaded = {user: self.load_song_list(user) for user in self._known_users()}
-        return defaultdict(list, loaded)
+    def load_song_lists(self) -> SongLists:
+        return SongLists(
+            self.load_song_list,
+            self._evict_song_list,
+            # a journal is read once and then has all the lists
+            capacity=None if self.journal else RESIDENT_SONG_LISTS,
+            pinned=lambda: islice(self._rotation(), RESIDENT_HEAD),
+        )
+
+    def _evict_song_list(self, user: int, songs: list[str]) -> None:
+        if user in self._dirty_song_lists:
+            self._dirty_song_lists.discard(user)
+            if self.journal is None:
+                self.party.save_song_list(user, songs)
 
     def _song_list_key(self, user: int) -> str:
         return f"user:{user}"
@@ -61,11 +215,17 @@ class DJ:
         return self.party.load_song_list(user)
 
     def save_song_list(self, user: int) -> None:
-        self.party.save_song_list(user, self.user_song_lists.get(user, []))
+        self._dirty_song_lists.add(user)
+        self.version += 1
+        if self._in_rotation(user):
+            self._etas.song_changed(user)
+        if not self.coalesce_writes:
+            self.flush()
 
     def _name(self, chat_id: int) -> str:
         return self.names.get(chat_id, str(chat_id))
 
+    @operation
     def clear(self, user: int) -> str:
         if self.user_song_lists.get(user):
             self.user_song_lists[user].clear()
@@ -73,12 +233,17 @@ class DJ:
             return "Your song list has been cleared"
         return "You don't have any songs in your list"
 
+    @operation
     def reset(self) -> list[tuple[int | None, str]]:
+        users = self._known_users().union(self.user_song_lists)
         self.queue.clear()
         self.new_users.clear()
         self.paused.clear()
+        self._etas.invalidate()
+        self._changed("queue", "new_users", "paused")
         messages: list[tuple[int | None, str]] = []
-        for user, song_list in self.user_song_lists.items():
+        for user in sorted(users):
+            song_list = self.user_song_lists[user]
             if not song_list:
                 continue
             messages.append(
@@ -95,24 +260,31 @@ class DJ:
         return messages
 
     def undo(self) -> list[tuple[int | None, str]]:
+        if self.journal is not None:
+            return self._undo_operation()
         if not self.undo_list:
             return [(None, "Nothing to undo")]
         action, user = self.undo_list.pop()
+        self._changed("undo_list")
         if action == "paused":
             messages: list[tuple[int | None, str]] = [
                 (None, f"{self._name(user)} is now unpaused")
             ]
             if user not in self.paused:
+                self.save_global()
                 return messages
             self.paused.remove(user)
-            if user not in (self.new_users + self.queue):
+            self._etas.invalidate()
+            if not self._in_rotation(user):
                 self.queue.append(user)
+            self._changed("paused", "queue")
             self.save_global()
             return messages + [
                 (user, "You are now unpaused"),
             ]
         return [(None, "Unknown undo action")]
 
+    @operation
     def notready(self) -> list[tuple[int | None, str]]:
         if self.current is None:
             return [(None, "No current singer")]
@@ -121,9 +293,12 @@ class DJ:
         if user in self.paused:
             return []
         self.paused.add(user)
-        if user in self.queue:
-            self.queue.remove(user)
+        self.queue.discard(user)
+        self._etas.invalidate()
         self.undo_list.append(("paused", user))
+        del self.undo_list[:-UNDO_DEPTH]
+        self._changed("paused", "queue", "undo_list")
+        self.save_global()
         messages = [
             (
                 user,
@@ -134,19 +309,26 @@ class DJ:
         ]
         return messages
 
+    @operation
     def pause(self, user: int) -> str:
         if user in self.paused:
             return "You are already paused"
         self.paused.add(user)
+        self._etas.invalidate()
+        self._changed("paused")
         self.save_global()
         return "OK, you are now paused"
 
+    @operation
     def unpause(self, user) -> str:
         if user not in self.paused:
             return "You are not paused"
         self.paused.remove(user)
-        if user not in (self.new_users + self.queue):
+        self._etas.invalidate()
+        self._changed("paused")
+        if not self._in_rotation(user):
             self.new_users.append(user)
+            self._changed("new_users")
         self.save_global()
         return "OK, you are now unpaused"
 
@@ -154,17 +336,21 @@ class DJ:
         self.user_song_lists[user].insert(0, song)
         self.save_song_list(user)
 
+    @operation
     def remove(self) -> str:
         if self.current is None:
             return "No current singer"
         user, _ = self.current
         return self.remove_with_id(user)
 
+    @operation
     def remove_with_id(self, user: int) -> str:
-        if user in self._known_users():
-            remove_if_present(self.new_users, user)
-            remove_if_present(self.queue, user)
-            remove_if_present(self.paused, user)
+        if self._is_known(user):
+            self.new_users.discard(user)
+            self.queue.discard(user)
+            self.paused.discard(user)
+            self._etas.invalidate()
+            self._changed("new_users", "queue", "paused")
             self.save_global()
             if user in self.user_song_lists:
                 del self.user_song_lists[user]
@@ -172,9 +358,16 @@ class DJ:
             return f"{self._name(user)} removed from the queue"
         return f"{self._name(user)} was not on the queue :-o"
 
-    def _song_info(self, url: str) -> SongInfo:
+    @operation
+    def leave(self, user: int) -> None:
+        """The user went to another party; unlike a removal, /undo keeps it"""
+        self.remove_with_id(user)
+
+    def _song_info(self, url: str) -> "SongInfo":
         if self.formatter:
             return self.formatter.song_info(url)
+        from youtube import SongInfo  # the bot may run without YouTube
+
         return SongInfo(title=url, duration=0, url=url)
 
     def _format_song(self, url: str) -> MarkdownText:
@@ -188,37 +381,53 @@ class DJ:
     def show_queue(
         self, user: int, show_songs: bool = False, show_remove: bool = False
     ) -> str:
-        their_queue = self.user_song_lists.get(user)
         remove = "" if not show_remove else f" /remove{user} /list{user}"
         user_str = f"{self._format_singer(user)}{remove}:\n"
-        if not their_queue:
+        _, n = self.user_song_lists.head(user)
+        if not n:
             return user_str + r"\(queue empty\)"
         if not show_songs:
-            n = len(their_queue)
             return user_str + ngettext(r"\(%d song\)", r"\(%d songs\)", n) % n
         return user_str + "\n".join(
-            self._format_song(song).escaped_text() for song in their_queue
+            self._format_song(song).escaped_text()
+            for song in self.user_song_lists.peek(user)
         )
 
-    def get_queue(self, user: int) -> list[SongInfo]:
-        their_queue = self.user_song_lists.get(user)
-        return [self._song_info(song) for song in their_queue or []]
+    def get_queue(self, user: int) -> "list[SongInfo]":
+        their_queue = self.user_song_lists.peek(user)
+        return [self._song_info(song) for song in their_queue]
 
     def remove_song(self, user: int, index: int) -> bool:
-        their_queue = self.user_song_lists.get(user)
-        if not their_queue:
-            return False
         try:
-            their_queue.pop(index)
-            self.save_song_list(user)
+            song = self.user_song_lists.peek(user)[index]
         except IndexError:
             return False
+        return self.remove_song_url(user, song)
+
+    # Songs are journaled by URL rather than by position: after an /undo
+    # puts a sung song back, the positions of the others have moved.
+    @operation
+    def remove_song_url(self, user: int, song: str) -> bool:
+        their_queue = self.user_song_lists.get(user)
+        if not their_queue or song not in their_queue:
+            return False
+        their_queue.remove(song)
+        self.save_song_list(user)
         return True
 
     def move_song(self, user: int, action: str, index: int) -> bool:
+        try:
+            song = self.user_song_lists.peek(user)[index]
+        except IndexError:
+            return False
+        return self.move_song_url(user, action, song)
+
+    @operation
+    def move_song_url(self, user: int, action: str, song: str) -> bool:
         their_queue = self.user_song_lists.get(user)
-        if not their_queue:
+        if not their_queue or song not in their_queue:
             return False
+        index = their_queue.index(song)
         if action == "move_up":
             if index <= 0:
                 return False
@@ -227,17 +436,13 @@ class DJ:
             if index >= len(their_queue) - 1:
                 return False
             idx = index
-        try:
-            their_queue[idx : idx + 2] = their_queue[idx + 1], their_queue[idx]
-            self.save_song_list(user)
-        except IndexError:
-            return False
+        their_queue[idx : idx + 2] = their_queue[idx + 1], their_queue[idx]
+        self.save_song_list(user)
         return True
 
     def show_all_queues(
         self, requester: int | None = None, is_admin: bool = False
     ) -> str:
-        all_queues = self.new_users + self.queue
         queues_str = (
             (
                 "All singers:\n\n"
@@ -247,10 +452,10 @@ class DJ:
                         show_songs=(is_admin or (u == requester)),
                         show_remove=is_admin,
                     )
-                    for u in all_queues
+                    for u in self._rotation()
                 )
             )
-            if all_queues
+            if self.new_users or self.queue
             else "No active singers"
         )
         paused_str = (
@@ -263,46 +468,65 @@ class DJ:
         )
         return f"{queues_str}\n\n{paused_str}"
 
+    @operation
     def register(self, user: int, name: str) -> None:
-        self.names[user] = name
+        if self.names.get(user) != name:
+            self.names[user] = name
+            self._changed("names")
+
+    @operation
+    def unregister(self, user: int) -> None:
+        """Stop messaging a user that blocked the bot"""
+        if user in self.names and not self._is_known(user):
+            del self.names[user]
+            self._changed("names")
+            self.save_global()
 
     def _known_users(self) -> set[int]:
         return self.paused.union(self.new_users).union(self.queue)
 
+    def _is_known(self, user: int) -> bool:
+        return user in self.paused or self._in_rotation(user)
+
+    @operation
     def enqueue(self, user: int, link: str) -> bool:
         song_list = self.user_song_lists[user]
         if link in song_list:
             return False
         song_list.append(link)
         self.save_song_list(user)
-        if user not in self._known_users():
+        if not self._is_known(user):
             self.new_users.append(user)
+            self._etas.append("new_users", user)
+            self._changed("new_users")
             self.save_global()
         return True
 
+    @operation
     def peek_next(self) -> int | None:
         if len(self.new_users) + len(self.queue) <= 2:
             return None
         next = self._pop_next_singer()
         if next is not None:
             # save them a place at the front
-            self.new_users.insert(0, next)
+            self.new_users.appendleft(next)
+            self._etas.appendleft("new_users", next)
+            self._changed("new_users")
             self.save_global()
         return next
 
     def get_upcoming_singers(self) -> list[QueueEntry]:
-        all_queues = self.new_users + self.queue
         result: list[QueueEntry] = []
-        for singer in all_queues:
+        for singer in self._rotation():
             if singer in self.paused:
                 continue
-            their_queue = self.user_song_lists.get(singer)
-            ready = bool(their_queue)
+            ready = singer in self.user_song_lists
             result.append(QueueEntry(singer, ready))
             if ready or len(result) >= 3:
                 break
         return result
 
+    @operation
     def next(self) -> tuple[str, str]:
         ready = self._get_ready_singer()
         if ready is None:
@@ -310,7 +534,9 @@ class DJ:
             return ("The queue is empty", "")
         singer, song = ready
         self.queue.append(singer)
+        self._etas.append("queue", singer)
         self.current = (singer, song)
+        self._changed("queue", "current")
         self.save_global()
         return (
             f"Singer: {self._format_singer(singer)}\n"
@@ -319,29 +545,220 @@ class DJ:
         )
 
     def get_queue_json(self) -> str:
-        current_singer, current_song = self.current or (None, None)
+        return self.get_queue_snapshot().text
+
+    def get_queue_snapshot(self) -> QueueSnapshot:
+        """The queue as shown on displays, rebuilt only when the state has changed.
+
+        Snapshots are numbered separately from DJ.version: the number only
+        goes up when what the displays show is different.
+        """
+        key = (self.version, getattr(self.formatter, "generation", 0))
+        if self._snapshot is not None and key == self._snapshot_key:
+            return self._snapshot
+        self._snapshot_key = key
+        state = self._queue_state()
+        if self._snapshot is not None and state == self._snapshot.state:
+            return self._snapshot
+        version = self._snapshot.version + 1 if self._snapshot else 1
+        text = json.dumps(
+            {"type": "snapshot", "version": version} | state, ensure_ascii=False
+        )
+        self._snapshot = QueueSnapshot(version, state, text, text.encode())
+        return self._snapshot
+
+    def get_queue_delta(self, since: QueueSnapshot) -> bytes:
+        """Encoded delta frame that turns `since` into the current snapshot"""
+        current = self.get_queue_snapshot()
+        delta = {
+            "type": "delta",
+            "from": since.version,
+            "version": current.version,
+            "ops": diff_queue(since.state, current.state),
+        }
+        return json.dumps(delta, ensure_ascii=False).encode()
+
+    def _next_song_duration(self, user: int) -> float:
+        """How long the user will take when their turn comes, 0 if they will be skipped"""
+        if user in self.paused:
+            return 0
+        song, _ = self.user_song_lists.head(user)
+        if song is None:
+            return 0
+        generation = getattr(self.formatter, "generation", 0)
+        cached = self._head_durations.get(user)
+        if cached is None or cached[:2] != (song, generation):
+            cached = (song, generation, self._song_duration(song))
+            self._head_durations[user] = cached
+            if len(self._head_durations) > RESIDENT_SONG_LISTS:
+                self._head_durations.popitem(last=False)
+        self._head_durations.move_to_end(user)
+        return cached[2]
+
+    def _song_duration(self, url: str) -> float:
+        data = self.formatter.get_data(url) if self.formatter else None
+        return (data and data.duration) or DEFAULT_SONG_DURATION
+
+    def _eta(self, singer: int) -> int | None:
+        """Seconds from the start of the current song until the singer's turn"""
+        generation = getattr(self.formatter, "generation", 0)
+        if not self._etas.valid or generation != self._etas_generation:
+            self._etas.rebuild(self.new_users, self.queue)
+            self._etas_generation = generation
+        if (eta := self._etas.eta(singer)) is None:
+            return None
+        if self.current:
+            _, song = self.current
+            eta += self._song_duration(song)
+        return round(eta)
+
+    def _likely_next(self) -> tuple[int, str] | None:
+        """The singer and song that next() would pick if called now"""
+        for singer in self._rotation():
+            if singer in self.paused:
+                continue
+            song, _ = self.user_song_lists.head(singer)
+            if song is not None:
+                return singer, song
+        return None
+
+    def _display_song(self, singer: int | None, song: str | None) -> dict[str, str]:
         data = None
-        if current_song and self.formatter:
-            data = self.formatter.get_data(current_song)
-        all_queues = self.new_users + self.queue
-        queue = {
-            "current": {
-                "singer": self._name(current_singer) if current_singer else "No singer",
-                "title": data.title if data else current_song or "",
-                "url": data.url if data else current_song or "",
-            },
+        if song and self.formatter:
+            data = self.formatter.get_data(song)
+        return {
+            "singer": self._name(singer) if singer else "No singer",
+            "title": data.title if data else song or "",
+            "url": data.url if data else song or "",
+        }
+
+    def _queue_state(self) -> dict[str, Any]:
+        likely_next = self._likely_next()
+        return {
+            "current": self._display_song(*(self.current or (None, None))),
+            # so that a display can load the song before it is called
+            "next": self._display_song(*likely_next) if likely_next else None,
             "queue": [
-                {"singer": self._name(singer), "paused": singer in self.paused}
-                for singer in all_queues
+                {
+                    "id": singer,
+                    "singer": self._name(singer),
+                    "paused": singer in self.paused,
+                    "eta": self._eta(singer),
+                }
+                for singer in self._rotation()
+            ],
+        }
+
+    def _dump_state(self) -> dict[str, Any]:
+        return {
+            "admins": sorted(self.admins or ()),
+            "names": [[user, name] for user, name in self.names.items()],
+            "queue": list(self.queue),
+            "new_users": list(self.new_users),
+            "current": self.current,
+            "paused": sorted(self.paused),
+            "song_lists": [
+                [user, songs]
+                for user in sorted(self._known_users().union(self.user_song_lists))
+                if (songs := self.user_song_lists.peek(user))
             ],
         }
-        return json.dumps(queue, ensure_ascii=False)
+
+    def _load_state(self, state: dict[str, Any]) -> None:
+        self.admins = set(state["admins"])
+        self.names = {user: name for user, name in state["names"]}
+        self._queue = Rotation(state["queue"])
+        self._new_users = Rotation(state["new_users"])
+        self.current = tuple(state["current"]) if state["current"] else None
+        self.paused = set(state["paused"])
+        self.user_song_lists = SongLists(lambda user: [])
+        for user, songs in state["song_lists"]:
+            self.user_song_lists[user] = list(songs)
+        self._etas.invalidate()
+        self._changed(*GLOBALS)
+
+    def _apply(self, ops: list[Record]) -> None:
+        self._in_operation = True
+        try:
+            for op in ops:
+                getattr(self, op["op"])(*op["args"], **op.get("kwargs", {}))
+        finally:
+            self._in_operation = False
+
+    def _open_journal(self) -> None:
+        """Load the state from the snapshot and replay the journal on top"""
+        assert self.journal is not None
+        snapshot, records = self.journal.load()
+        if snapshot is None:
+            # start from what the party has stored
+            self._base = self._dump_state()
+            self._ops: list[Record] = []
+        else:
+            self._base = snapshot["state"]
+            self._ops = snapshot["ops"]
+        for record in records:
+            if record["op"] == "undo":
+                self._drop_last_undoable()
+            else:
+                self._ops.append({k: v for k, v in record.items() if k != "n"})
+        self._load_state(self._base)
+        self._apply(self._ops)
+        if snapshot is None:
+            self.journal.write_snapshot({"state": self._base, "ops": self._ops})
+
+    def _record(self, op: Record) -> None:
+        assert self.journal is not None
+        self.journal.append(op)
+        self._ops.append(op)
+        if len(self._ops) >= COMPACT_AFTER:
+            # keep the last steps replayable so that they can be undone
+            scratch = DJ(Party({}, self.party.id), coalesce_writes=True)
+            scratch._load_state(self._base)
+            scratch._apply(self._ops[:-UNDO_DEPTH])
+            self._base = scratch._dump_state()
+            self._ops = self._ops[-UNDO_DEPTH:]
+            self.journal.write_snapshot({"state": self._base, "ops": self._ops})
+
+    def _drop_last_undoable(self) -> Record | None:
+        for i in reversed(range(len(self._ops))):
+            if self._ops[i]["op"] in UNDOABLE:
+                end = i + 1
+                # the spot saved for the next singer goes with the /next
+                while end < len(self._ops) and self._ops[end]["op"] == "peek_next":
+                    end += 1
+                op = self._ops[i]
+                del self._ops[i:end]
+                return op
+        return None
+
+    def _undo_operation(self) -> list[tuple[int | None, str]]:
+        assert self.journal is not None
+        paused = set(self.paused)
+        if (op := self._drop_last_undoable()) is None:
+            return [(None, "Nothing to undo")]
+        self.journal.append({"op": "undo"})
+        self._load_state(self._base)
+        self._apply(self._ops)
+        user = self._name(op["args"][0]) if op["args"] else ""
+        messages: list[tuple[int | None, str]] = [
+            (None, "Undone: " + UNDOABLE[op["op"]].format(user=user))
+        ]
+        for user in paused - self.paused:
+            messages.append((user, "You are now unpaused"))
+        return messages
+
+    def close(self) -> None:
+        self.flush()
+        if self.journal is not None:
+            self.journal.close()
 
     def _pop_next_singer(self) -> int | None:
-        if self.new_users:
-            return self.new_users.pop(0)
-        if self.queue:
-            return self.queue.pop(0)
+        for part, rotation in (("new_users", self.new_users), ("queue", self.queue)):
+            if rotation:
+                singer = rotation.popleft()
+                self._etas.popleft(part, singer)
+                self._changed(part)
+                return singer
         return None
 
     def _get_ready_singer(self) -> tuple[int, str] | None:
@@ -360,8 +777,3 @@ class DJ:
             break
 
         return return_value
-
-
-def remove_if_present(queue: list[int] | set[int], user: int) -> None:
-    if user in queue:
-        queue.remove(user)
@@ -0,0 +1,98 @@
+from typing import Callable, Iterable
+
+
+class Timeline:
+    """Start times of consecutive songs, relative to an origin that moves.
+
+    Taking the first singer off or putting one at either end is O(1): only
+    the origin or the end moves, everyone else keeps their start time.
+    """
+
+    def __init__(self):
+        self.start: dict[int, float] = {}
+        self.duration: dict[int, float] = {}
+        self.head = 0.0
+        self.tail = 0.0
+
+    def append(self, user: int, duration: float) -> None:
+        if duration:
+            self.start[user] = self.tail
+            self.duration[user] = duration
+            self.tail += duration
+
+    def appendleft(self, user: int, duration: float) -> None:
+        if duration:
+            self.head -= duration
+            self.start[user] = self.head
+            self.duration[user] = duration
+
+    def popleft(self, user: int) -> None:
+        if user in self.start:
+            self.head = self.start.pop(user) + self.duration.pop(user)
+
+    def eta(self, user: int) -> float | None:
+        if user not in self.start:
+            return None
+        return self.start[user] - self.head
+
+    def total(self) -> float:
+        return self.tail - self.head
+
+
+class EtaTracker:
+    """When each singer in the rotation is due, counting from the current song.
+
+    `duration(user)` is how long the user's next song takes, or 0 if they
+    will be skipped. New users go before the queue, so each part of the
+    rotation has a timeline of its own. Changes in the middle of the
+    rotation call invalidate() and the timelines are rebuilt on next use.
+    """
+
+    def __init__(self, duration: Callable[[int], float]):
+        self.duration = duration
+        self.new_users = Timeline()
+        self.queue = Timeline()
+        self.valid = False
+
+    def invalidate(self) -> None:
+        self.valid = False
+
+    def rebuild(self, new_users: Iterable[int], queue: Iterable[int]) -> None:
+        self.new_users = Timeline()
+        self.queue = Timeline()
+        for user in new_users:
+            self.new_users.append(user, self.duration(user))
+        for user in queue:
+            self.queue.append(user, self.duration(user))
+        self.valid = True
+
+    def _timeline(self, part: str) -> Timeline:
+        return self.new_users if part == "new_users" else self.queue
+
+    def append(self, part: str, user: int) -> None:
+        if self.valid:
+            self._timeline(part).append(user, self.duration(user))
+
+    def appendleft(self, part: str, user: int) -> None:
+        if self.valid:
+            self._timeline(part).appendleft(user, self.duration(user))
+
+    def popleft(self, part: str, user: int) -> None:
+        if self.valid:
+            self._timeline(part).popleft(user)
+
+    def song_changed(self, user: int) -> None:
+        """The user's next song may be different now"""
+        if not self.valid:
+            return
+        recorded = self.new_users.duration.get(user, self.queue.duration.get(user, 0))
+        if self.duration(user) != recorded:
+            self.invalidate()
+
+    def eta(self, user: int) -> float | None:
+        assert self.valid
+        if (eta := self.new_users.eta(user)) is not None:
+            return eta
+        if (eta := self.queue.eta(user)) is not None:
+            return self.new_users.total() + eta
+        return None
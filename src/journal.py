@@ -0,0 +1,73 @@
+import json
+import os
+from typing import Any, TextIO
+
+Record = dict[str, Any]
+
+
+class Journal:
+    """Records appended to a JSON lines file, compacted into a snapshot.
+
+    Every record is numbered. The snapshot, kept next to the journal as
+    PATH.snapshot, remembers the number of the last record it includes,
+    so records left behind by a compaction that was cut short are skipped.
+    """
+
+    def __init__(self, path: str, fsync: bool = False):
+        self.path = path
+        self.snapshot_path = path + ".snapshot"
+        self.fsync = fsync
+        self.last = 0
+        self._file: TextIO | None = None
+
+    def load(self) -> tuple[Record | None, list[Record]]:
+        """The latest snapshot, if any, and the records that came after it"""
+        snapshot = None
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, encoding="utf-8") as f:
+                snapshot = json.load(f)
+            self.last = snapshot["n"]
+        records = []
+        if not os.path.exists(self.path):
+            return snapshot, records
+        with open(self.path, "rb") as f:
+            good = 0
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                good += len(line)
+                if record["n"] > self.last:
+                    records.append(record)
+                    self.last = record["n"]
+        if good != os.path.getsize(self.path):
+            # the last append was cut short; later ones must not follow it
+            os.truncate(self.path, good)
+        return snapshot, records
+
+    def append(self, record: Record) -> None:
+        self.last += 1
+        if self._file is None:
+            self._file = open(self.path, "a", encoding="utf-8")
+        self._file.write(json.dumps({"n": self.last} | record, ensure_ascii=False))
+        self._file.write("\n")
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+
+    def write_snapshot(self, snapshot: Record) -> None:
+        """Replace the snapshot and empty the journal"""
+        temp_path = self.snapshot_path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump({"n": self.last} | snapshot, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.snapshot_path)
+        self.close()
+        open(self.path, "w").close()
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -1,19 +1,37 @@
 #!./venv/bin/python3
 import os
+import subprocess
 
 
-def create_service(service_name, exec_start, working_directory):
+def python_command(working_directory):
+    """The project's interpreter; `poetry run` would add its own startup time"""
     localbin = os.path.expanduser("~/.local/bin")
+    try:
+        return subprocess.run(
+            [f"{localbin}/poetry", "env", "info", "--executable"],
+            cwd=working_directory,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return f"{localbin}/poetry run python"
+
+
+def create_service(service_name, exec_start, working_directory):
+    python = python_command(working_directory)
     service_content = f"""
     [Unit]
     Description={service_name}
     After=network.target
+    # keep restarting however often it fails
+    StartLimitIntervalSec=0
 
     [Service]
     WorkingDirectory={working_directory}
-    ExecStart={localbin}/poetry run python {exec_start}
+    ExecStart={python} {exec_start}
     Restart=always
-    RestartSec=10
+    RestartSec=1
 
     [Install]
     WantedBy=default.target
@@ -0,0 +1,106 @@
+import asyncio
+import time
+from typing import Callable
+
+from telegram import Message
+
+from displays import DisplayHub
+from dj import DJ, QueueSnapshot
+from party import Party
+from storage import Storage
+
+
+class ActiveParty:
+    """A party that is loaded in memory, with its DJ and connected displays"""
+
+    def __init__(self, dj: DJ):
+        self.dj = dj
+        self.id: int = dj.party.id
+        # held by handlers that change the queue and report the result
+        self.lock = asyncio.Lock()
+        self.displays = DisplayHub()
+        # the queue snapshot that connected displays have been sent
+        self.published: QueueSnapshot | None = None
+        self.last_msg_with_buttons: Message | None = None
+        self.last_used = 0.0
+
+
+class PartyRegistry:
+    """All parties hosted by the bot.
+
+    Party 0 always exists; others are created with create(). A party is
+    loaded on first use and dropped from memory after `idle_timeout`
+    seconds without updates or displays. Each user belongs to one party,
+    remembered under `member:<user id>`; everyone starts in party 0.
+    """
+
+    PARTIES_KEY = "parties"
+
+    def __init__(
+        self,
+        db: Storage,
+        make_dj: Callable[[Party], DJ],
+        default_admins: set[str] = set(),
+        idle_timeout: float = 3600,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.db = db
+        self.make_dj = make_dj
+        self.default_admins = default_admins
+        self.idle_timeout = idle_timeout
+        self.clock = clock
+        self.active: dict[int, ActiveParty] = {}
+        self._members: dict[int, int] = {}
+
+    def exists(self, party_id: int) -> bool:
+        return party_id == 0 or party_id in self.db.get(self.PARTIES_KEY, set())
+
+    def get(self, party_id: int) -> ActiveParty:
+        if (party := self.active.get(party_id)) is None:
+            if not self.exists(party_id):
+                raise KeyError(party_id)
+            admins = self.default_admins if party_id == 0 else set()
+            party = ActiveParty(self.make_dj(Party(self.db, party_id, admins)))
+            self.active[party_id] = party
+        party.last_used = self.clock()
+        return party
+
+    def create(self, admin: str) -> ActiveParty:
+        parties: set[int] = self.db.get(self.PARTIES_KEY, set())
+        party_id = max(parties, default=0) + 1
+        self.db[self.PARTIES_KEY] = parties | {party_id}
+        self.active[party_id] = party = ActiveParty(
+            self.make_dj(Party(self.db, party_id, {admin}))
+        )
+        party.last_used = self.clock()
+        return party
+
+    def party_of(self, user_id: int) -> int:
+        if (party_id := self._members.get(user_id)) is None:
+            party_id = self._members[user_id] = self.db.get(f"member:{user_id}", 0)
+        return party_id
+
+    def join(self, user_id: int, party_id: int) -> ActiveParty:
+        party = self.get(party_id)
+        self._members[user_id] = party_id
+        self.db[f"member:{user_id}"] = party_id
+        return party
+
+    def for_user(self, user_id: int) -> ActiveParty:
+        try:
+            return self.get(self.party_of(user_id))
+        except KeyError:
+            return self.join(user_id, 0)
+
+    def evict_idle(self) -> list[int]:
+        deadline = self.clock() - self.idle_timeout
+        evicted = [
+            party_id
+            for party_id, party in self.active.items()
+            if party.last_used < deadline
+            and not party.displays
+            and not party.lock.locked()
+        ]
+        for party_id in evicted:
+            self.active.pop(party_id).dj.close()
+        return evicted
@@ -1,6 +1,19 @@
+from contextlib import AbstractContextManager
+
+import metrics
+from storage import Storage, as_storage
+
+DB_SECONDS = metrics.Histogram(
+    "party_db_seconds",
+    "Party storage calls by kind",
+    ["op"],
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5),
+)
+
+
 class Party:
-    def __init__(self, db, id: int, admins: set[str] = set()):
-        self.db = db
+    def __init__(self, db: Storage | dict, id: int, admins: set[str] = set()):
+        self.db: Storage = as_storage(db)
         self.id: int = id
         if admins and ("admins" not in self):
             self["admins"] = admins
@@ -11,29 +24,39 @@ class Party:
         return f"party{self.id}:{key}"
 
     def load_song_list(self, user_id: int) -> list[str]:
-        return self.db.get(f"user:{user_id}", [])
+        with DB_SECONDS.time(op="read"):
+            return self.db.get(self._getkey(f"user:{user_id}"), [])
 
     def save_song_list(self, user_id: int, song_list: list[str]) -> None:
-        key = f"user:{user_id}"
-        if (not song_list) and key in self.db:
-            del self.db[key]
-        elif song_list:
-            self.db[key] = song_list
+        key = self._getkey(f"user:{user_id}")
+        with DB_SECONDS.time(op="write"):
+            if (not song_list) and key in self.db:
+                del self.db[key]
+            elif song_list:
+                self.db[key] = song_list
+
+    def batch(self) -> AbstractContextManager[None]:
+        return self.db.batch()
 
     def __getattr__(self, name):
         return getattr(self.db, name)
 
     def __contains__(self, key):
-        return self._getkey(key) in self.db
+        with DB_SECONDS.time(op="read"):
+            return self._getkey(key) in self.db
 
     def __getitem__(self, key):
-        return self.db[self._getkey(key)]
+        with DB_SECONDS.time(op="read"):
+            return self.db[self._getkey(key)]
 
     def __setitem__(self, key, value):
-        self.db[self._getkey(key)] = value
+        with DB_SECONDS.time(op="write"):
+            self.db[self._getkey(key)] = value
 
     def __delitem__(self, key):
-        del self.db[self._getkey(key)]
+        with DB_SECONDS.time(op="write"):
+            del self.db[self._getkey(key)]
 
     def get(self, key, default=None):
-        return self.db.get(self._getkey(key), default)
+        with DB_SECONDS.time(op="read"):
+            return self.db.get(self._getkey(key), default)
@@ -0,0 +1,91 @@
+"""Versioned queue updates for displays.
+
+A display gets a full snapshot when it connects (or asks to "resync"):
+
+    {"type": "snapshot", "version": 7, "current": {...}, "next": {...},
+     "queue": [entry, ...]}
+
+"next" is the song that is likely to be called next, or null.
+
+and deltas afterwards, each applying to the version named in "from":
+
+    {"type": "delta", "from": 7, "version": 8, "ops": [op, ...]}
+
+Ops are applied in order:
+
+    {"op": "remove", "id": 3}
+    {"op": "add", "before": 5, "id": 4, "singer": "...", "paused": false}
+    {"op": "move", "id": 1, "before": null}
+    {"op": "update", "id": 2, "paused": true}
+    {"op": "current", "current": {...}}
+    {"op": "next", "next": {...}}
+
+`before` is the id of the entry to insert in front of, null meaning the end.
+"""
+
+from bisect import bisect_left
+from typing import Any
+
+Entry = dict[str, Any]
+
+
+def _stable_positions(positions: list[int]) -> set[int]:
+    """The longest increasing subsequence of `positions`"""
+    tails: list[int] = []  # smallest tail of an increasing run of each length
+    tail_index: list[int] = []
+    parents: list[int] = []
+    for i, position in enumerate(positions):
+        length = bisect_left(tails, position)
+        if length == len(tails):
+            tails.append(position)
+            tail_index.append(i)
+        else:
+            tails[length] = position
+            tail_index[length] = i
+        parents.append(tail_index[length - 1] if length else -1)
+    stable: set[int] = set()
+    i = tail_index[-1] if tail_index else -1
+    while i >= 0:
+        stable.add(positions[i])
+        i = parents[i]
+    return stable
+
+
+def diff_queue(old: dict[str, Any], new: dict[str, Any]) -> list[Entry]:
+    old_entries = {entry["id"]: entry for entry in old["queue"]}
+    new_entries = {entry["id"]: entry for entry in new["queue"]}
+    new_ids = [entry["id"] for entry in new["queue"]]
+    ops: list[Entry] = [
+        {"op": "remove", "id": id} for id in old_entries if id not in new_entries
+    ]
+
+    # Singers whose relative order did not change stay where they are;
+    # everyone else is put in front of their new successor, last one first.
+    remaining = [id for id in old_entries if id in new_entries]
+    old_position = {id: i for i, id in enumerate(remaining)}
+    stable = _stable_positions(
+        [old_position[id] for id in new_ids if id in old_position]
+    )
+    for i in reversed(range(len(new_ids))):
+        id = new_ids[i]
+        before = new_ids[i + 1] if i + 1 < len(new_ids) else None
+        if id not in old_entries:
+            ops.append({"op": "add", "before": before} | new_entries[id])
+        elif old_position[id] not in stable:
+            ops.append({"op": "move", "id": id, "before": before})
+
+    for id in new_ids:
+        if id in old_entries:
+            changed = {
+                key: value
+                for key, value in new_entries[id].items()
+                if old_entries[id].get(key) != value
+            }
+            if changed:
+                ops.append({"op": "update", "id": id} | changed)
+
+    if old["current"] != new["current"]:
+        ops.append({"op": "current", "current": new["current"]})
+    if old.get("next") != new.get("next"):
+        ops.append({"op": "next", "next": new.get("next")})
+    return ops
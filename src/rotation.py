@@ -0,0 +1,54 @@
+from collections import OrderedDict
+from typing import Iterable, Iterator
+
+
+class Rotation:
+    """Ordered set of user ids.
+
+    Appending at either end, popping from the front, membership tests and
+    removal by id are all O(1), unlike the lists this replaces.
+    """
+
+    def __init__(self, users: Iterable[int] = ()):
+        self._users: OrderedDict[int, None] = OrderedDict.fromkeys(users)
+
+    def append(self, user: int) -> None:
+        self._users[user] = None
+
+    def appendleft(self, user: int) -> None:
+        self._users[user] = None
+        self._users.move_to_end(user, last=False)
+
+    def popleft(self) -> int:
+        return self._users.popitem(last=False)[0]
+
+    def first(self) -> int | None:
+        return next(iter(self._users), None)
+
+    def remove(self, user: int) -> None:
+        del self._users[user]
+
+    def discard(self, user: int) -> None:
+        self._users.pop(user, None)
+
+    def clear(self) -> None:
+        self._users.clear()
+
+    def __contains__(self, user: object) -> bool:
+        return user in self._users
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self._users)
+
+    def __len__(self) -> int:
+        return len(self._users)
+
+    def __eq__(self, other: object) -> bool:
+        if isinstance(other, Rotation):
+            return list(self._users) == list(other._users)
+        if isinstance(other, list):
+            return list(self._users) == other
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        return f"Rotation({list(self._users)})"
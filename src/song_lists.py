@@ -0,0 +1,124 @@
+from collections import OrderedDict
+from typing import Callable, Iterable, Iterator
+
+
+class SongLists:
+    """Song lists of a party's users, read from storage on first use.
+
+    At most `capacity` lists stay in memory; the least recently used one
+    goes first, unless its user is among `pinned()`. Every list that is
+    dropped is passed to `evict` so that unsaved changes can be written.
+    A user without songs has an empty list, and deleting a list empties it.
+
+    For up to `capacity` users whose lists are not in memory, the first
+    song and the number of songs are remembered, so that looking at the
+    head of the rotation over and over reads each list from storage once.
+    """
+
+    def __init__(
+        self,
+        load: Callable[[int], list[str]],
+        evict: Callable[[int, list[str]], None] | None = None,
+        capacity: int | None = None,
+        pinned: Callable[[], Iterable[int]] = lambda: (),
+    ):
+        self._load = load
+        self._evict = evict
+        self.capacity = capacity
+        self.pinned = pinned
+        self._lists: OrderedDict[int, list[str]] = OrderedDict()
+        # user -> first song and number of songs, for lists not in memory
+        self._heads: OrderedDict[int, tuple[str | None, int]] = OrderedDict()
+        self.loads = 0
+
+    def __getitem__(self, user: int) -> list[str]:
+        if (songs := self._lists.get(user)) is not None:
+            self._lists.move_to_end(user)
+            return songs
+        self.loads += 1
+        self._heads.pop(user, None)
+        songs = self._lists[user] = self._load(user)
+        self._shrink()
+        return songs
+
+    def __setitem__(self, user: int, songs: list[str]) -> None:
+        self._heads.pop(user, None)
+        self._lists[user] = songs
+        self._lists.move_to_end(user)
+        self._shrink()
+
+    def __delitem__(self, user: int) -> None:
+        self[user] = []
+
+    def __contains__(self, user: int) -> bool:
+        return bool(self.head(user)[1])
+
+    def __iter__(self) -> Iterator[int]:
+        """Users whose lists are in memory"""
+        return iter(list(self._lists))
+
+    def __len__(self) -> int:
+        return len(self._lists)
+
+    def get(self, user: int, default: list[str] | None = None) -> list[str] | None:
+        return self[user] or default
+
+    def peek(self, user: int) -> list[str]:
+        """The user's songs, without keeping them in memory"""
+        if (songs := self._lists.get(user)) is not None:
+            return songs
+        songs = self._load(user)
+        self._remember_head(user, songs)
+        return songs
+
+    def head(self, user: int) -> tuple[str | None, int]:
+        """The user's first song, or None, and how many songs they have"""
+        if (songs := self._lists.get(user)) is not None:
+            return _head(songs)
+        if (head := self._heads.get(user)) is not None:
+            self._heads.move_to_end(user)
+            return head
+        songs = self._load(user)
+        self._remember_head(user, songs)
+        return _head(songs)
+
+    def _remember_head(self, user: int, songs: list[str]) -> None:
+        self._heads[user] = _head(songs)
+        self._heads.move_to_end(user)
+        if self.capacity is not None and len(self._heads) > self.capacity:
+            self._heads.popitem(last=False)
+
+    def pop(self, user: int, default: list[str] | None = None) -> list[str] | None:
+        songs = self.peek(user)
+        self[user] = []
+        return songs or default
+
+    def items(self) -> Iterator[tuple[int, list[str]]]:
+        return iter(list(self._lists.items()))
+
+    def clear(self) -> None:
+        """Drop every list from memory"""
+        lists, self._lists = self._lists, OrderedDict()
+        for user, songs in lists.items():
+            self._remember_head(user, songs)
+            if self._evict:
+                self._evict(user, songs)
+
+    def _shrink(self) -> None:
+        if self.capacity is None or len(self._lists) <= self.capacity:
+            return
+        pinned = set(self.pinned())
+        newest = next(reversed(self._lists))
+        for user in list(self._lists):
+            if len(self._lists) <= self.capacity:
+                break
+            if user in pinned or user == newest:
+                continue
+            songs = self._lists.pop(user)
+            self._remember_head(user, songs)
+            if self._evict:
+                self._evict(user, songs)
+
+
+def _head(songs: list[str]) -> tuple[str | None, int]:
+    return (songs[0] if songs else None, len(songs))
@@ -0,0 +1,60 @@
+"""Where the time goes between exec and serving, for --profile-startup.
+
+Import this module before anything else. With --profile-startup on the
+command line it times each import statement of the __main__ module
+(including everything that import pulls in) and the phases marked with
+`phase()`, and `report()` prints both.
+"""
+
+import builtins
+import sys
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
+ENABLED = "--profile-startup" in sys.argv
+
+started = time.perf_counter()
+imports: list[tuple[str, float]] = []
+phases: list[tuple[str, float]] = []
+
+_import = builtins.__import__
+
+
+def _timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+    if not globals or globals.get("__name__") != "__main__":
+        return _import(name, globals, locals, fromlist, level)
+    start = time.perf_counter()
+    try:
+        return _import(name, globals, locals, fromlist, level)
+    finally:
+        imports.append((name, time.perf_counter() - start))
+
+
+if ENABLED:
+    builtins.__import__ = _timed_import
+
+
+@contextmanager
+def phase(name: str) -> Iterator[None]:
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        phases.append((name, time.perf_counter() - start))
+
+
+def report() -> None:
+    """Print the breakdown and stop timing imports"""
+    if not ENABLED:
+        return
+    builtins.__import__ = _import
+    total = time.perf_counter() - started
+    lines = ["Startup profile (ms):"]
+    for title, timings in (("imports", imports), ("phases", phases)):
+        lines.append(f"  {title}: {sum(t for _, t in timings) * 1000:8.1f}")
+        for name, seconds in sorted(timings, key=lambda item: -item[1]):
+            if seconds >= 0.001:
+                lines.append(f"    {name:<30}{seconds * 1000:8.1f}")
+    lines.append(f"  serving after {total * 1000:.1f} ms")
+    print("\n".join(lines), file=sys.stderr)
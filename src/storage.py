@@ -0,0 +1,309 @@
+import pickle
+import re
+import shelve
+import sqlite3
+import sys
+import threading
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Any, Iterator
+
+
+class Storage(ABC):
+    """Key-value store that Party and VideoFormatter persist their state into.
+
+    Keys look like `queue`, `party3:names`, `user:42` or `youtube:<id>`.
+    Writes made inside `batch()` may be committed together on exit.
+    """
+
+    def get(self, key: str, default: Any = None) -> Any:
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    @abstractmethod
+    def __getitem__(self, key: str) -> Any: ...
+
+    @abstractmethod
+    def __setitem__(self, key: str, value: Any) -> None: ...
+
+    @abstractmethod
+    def __delitem__(self, key: str) -> None: ...
+
+    @abstractmethod
+    def __contains__(self, key: str) -> bool: ...
+
+    @abstractmethod
+    def keys(self) -> Iterator[str]: ...
+
+    def scan(self, prefix: str) -> Iterator[tuple[str, Any]]:
+        """The keys that start with `prefix`, with their values"""
+        for key in self.keys():
+            if key.startswith(prefix):
+                yield key, self[key]
+
+    @contextmanager
+    def batch(self) -> Iterator[None]:
+        yield
+
+    def close(self) -> None:
+        pass
+
+
+class MappingStorage(Storage):
+    """Storage on top of a dict, a shelf or anything else that quacks like one."""
+
+    def __init__(self, data):
+        self.data = data
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return self.data.get(key, default)
+
+    def __getitem__(self, key: str) -> Any:
+        return self.data[key]
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        self.data[key] = value
+
+    def __delitem__(self, key: str) -> None:
+        del self.data[key]
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.data
+
+    def keys(self) -> Iterator[str]:
+        return iter(list(self.data.keys()))
+
+
+class ShelveStorage(MappingStorage):
+    def __init__(self, filename: str):
+        super().__init__(shelve.open(filename))
+
+    @contextmanager
+    def batch(self) -> Iterator[None]:
+        yield
+        self.data.sync()
+
+    def close(self) -> None:
+        self.data.close()
+
+
+SONG_LIST_KEY = re.compile(r"(party\d+:)?user:-?\d+")
+QUEUE_KEY = re.compile(r"(party\d+:)?(queue|new_users)")
+YOUTUBE_PREFIX = "youtube:"
+# a prefix such as `search:` that only keys kept in `kv` can start with
+KV_PREFIX = re.compile(r"(?!user:)[a-z_]+:")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS kv (
+    key TEXT PRIMARY KEY,
+    value BLOB NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS song_lists (
+    owner TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    url TEXT NOT NULL,
+    PRIMARY KEY (owner, position)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS queues (
+    name TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    PRIMARY KEY (name, position)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS youtube (
+    yt_id TEXT PRIMARY KEY,
+    record TEXT NOT NULL
+) WITHOUT ROWID;
+"""
+
+
+class SqliteStorage(Storage):
+    """SQLite database in WAL mode.
+
+    Song lists, queues and the YouTube metadata cache are kept as rows of
+    their own tables; everything else is pickled into `kv`. An empty song
+    list or queue is indistinguishable from a missing one.
+    """
+
+    def __init__(self, filename: str):
+        # may be used from worker threads, one at a time: a batch holds the
+        # lock until it is committed
+        self.conn = sqlite3.connect(
+            filename, isolation_level=None, check_same_thread=False
+        )
+        self._lock = threading.RLock()
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        self._batch_depth = 0
+
+    @contextmanager
+    def batch(self) -> Iterator[None]:
+        with self._lock:
+            if self._batch_depth == 0:
+                self.conn.execute("BEGIN")
+            self._batch_depth += 1
+            try:
+                yield
+            except BaseException:
+                self._batch_depth -= 1
+                if self._batch_depth == 0:
+                    self.conn.execute("ROLLBACK")
+                raise
+            self._batch_depth -= 1
+            if self._batch_depth == 0:
+                self.conn.execute("COMMIT")
+
+    def _select(self, sql: str, *params) -> list[tuple]:
+        with self._lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def __getitem__(self, key: str) -> Any:
+        if SONG_LIST_KEY.fullmatch(key):
+            rows = self._select(
+                "SELECT url FROM song_lists WHERE owner = ? ORDER BY position", key
+            )
+            if rows:
+                return [url for (url,) in rows]
+        elif QUEUE_KEY.fullmatch(key):
+            rows = self._select(
+                "SELECT user_id FROM queues WHERE name = ? ORDER BY position", key
+            )
+            if rows:
+                return [user for (user,) in rows]
+        elif key.startswith(YOUTUBE_PREFIX):
+            rows = self._select(
+                "SELECT record FROM youtube WHERE yt_id = ?",
+                key.removeprefix(YOUTUBE_PREFIX),
+            )
+            if rows:
+                return rows[0][0]
+        else:
+            rows = self._select("SELECT value FROM kv WHERE key = ?", key)
+            if rows:
+                return pickle.loads(rows[0][0])
+        raise KeyError(key)
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        with self.batch():
+            if SONG_LIST_KEY.fullmatch(key):
+                self.conn.execute("DELETE FROM song_lists WHERE owner = ?", (key,))
+                self.conn.executemany(
+                    "INSERT INTO song_lists (owner, position, url) VALUES (?, ?, ?)",
+                    ((key, i, url) for i, url in enumerate(value)),
+                )
+            elif QUEUE_KEY.fullmatch(key):
+                self.conn.execute("DELETE FROM queues WHERE name = ?", (key,))
+                self.conn.executemany(
+                    "INSERT INTO queues (name, position, user_id) VALUES (?, ?, ?)",
+                    ((key, i, user) for i, user in enumerate(value)),
+                )
+            elif key.startswith(YOUTUBE_PREFIX):
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO youtube (yt_id, record) VALUES (?, ?)",
+                    (key.removeprefix(YOUTUBE_PREFIX), value),
+                )
+            else:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)",
+                    (key, pickle.dumps(value)),
+                )
+
+    def __delitem__(self, key: str) -> None:
+        with self.batch():
+            if key not in self:
+                raise KeyError(key)
+            if SONG_LIST_KEY.fullmatch(key):
+                self.conn.execute("DELETE FROM song_lists WHERE owner = ?", (key,))
+            elif QUEUE_KEY.fullmatch(key):
+                self.conn.execute("DELETE FROM queues WHERE name = ?", (key,))
+            elif key.startswith(YOUTUBE_PREFIX):
+                self.conn.execute(
+                    "DELETE FROM youtube WHERE yt_id = ?",
+                    (key.removeprefix(YOUTUBE_PREFIX),),
+                )
+            else:
+                self.conn.execute("DELETE FROM kv WHERE key = ?", (key,))
+
+    def __contains__(self, key: str) -> bool:
+        if SONG_LIST_KEY.fullmatch(key):
+            sql = "SELECT 1 FROM song_lists WHERE owner = ? LIMIT 1"
+        elif QUEUE_KEY.fullmatch(key):
+            sql = "SELECT 1 FROM queues WHERE name = ? LIMIT 1"
+        elif key.startswith(YOUTUBE_PREFIX):
+            sql = "SELECT 1 FROM youtube WHERE yt_id = ?"
+            key = key.removeprefix(YOUTUBE_PREFIX)
+        else:
+            sql = "SELECT 1 FROM kv WHERE key = ?"
+        return bool(self._select(sql, key))
+
+    def keys(self) -> Iterator[str]:
+        yield from (key for (key,) in self._select("SELECT key FROM kv"))
+        yield from (
+            name for (name,) in self._select("SELECT DISTINCT name FROM queues")
+        )
+        yield from (
+            owner for (owner,) in self._select("SELECT DISTINCT owner FROM song_lists")
+        )
+        yield from (
+            YOUTUBE_PREFIX + yt_id
+            for (yt_id,) in self._select("SELECT yt_id FROM youtube")
+        )
+
+    def scan(self, prefix: str) -> Iterator[tuple[str, Any]]:
+        if not KV_PREFIX.fullmatch(prefix) or prefix == YOUTUBE_PREFIX:
+            yield from super().scan(prefix)
+            return
+        # a range of the primary key: everything from `prefix` up to the
+        # next string of the same length
+        end = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        rows = self._select(
+            "SELECT key, value FROM kv WHERE key >= ? AND key < ?", prefix, end
+        )
+        for key, value in rows:
+            yield key, pickle.loads(value)
+
+    def close(self) -> None:
+        with self._lock:
+            self.conn.close()
+
+
+def as_storage(db) -> Storage:
+    if isinstance(db, Storage):
+        return db
+    return MappingStorage(db)
+
+
+def open_storage(spec: str) -> Storage:
+    """Open a storage from a spec like `shelve:bot`, `sqlite:bot.sqlite` or `memory:`."""
+    backend, _, path = spec.partition(":")
+    match backend:
+        case "shelve":
+            return ShelveStorage(path)
+        case "sqlite":
+            return SqliteStorage(path)
+        case "memory":
+            return MappingStorage({})
+    raise ValueError(f"Unknown storage backend: {backend}")
+
+
+def copy_storage(source: Storage, target: Storage) -> int:
+    count = 0
+    with target.batch():
+        for key in source.keys():
+            target[key] = source[key]
+            count += 1
+    return count
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        sys.exit(
+            f"Usage: {sys.argv[0]} SOURCE TARGET, e.g. shelve:bot sqlite:bot.sqlite"
+        )
+    source, target = open_storage(sys.argv[1]), open_storage(sys.argv[2])
+    print(f"Copied {copy_storage(source, target)} keys")
+    source.close()
+    target.close()
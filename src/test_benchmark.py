@@ -0,0 +1,60 @@
+import argparse
+import pytest
+
+import bench_bot
+import bench_dj
+import benchmark
+
+
+def test_percentile():
+    samples = [0.005, 0.001, 0.003, 0.002, 0.004]
+    assert benchmark.percentile(samples, 50) == 0.003
+    assert benchmark.percentile(samples, 99) == 0.005
+    assert benchmark.percentile(samples, 0) == 0.001
+    summary = benchmark.summarize(samples)
+    assert summary["count"] == 5
+    assert summary["calls_per_sec_serial"] == pytest.approx(5 / 0.015)
+
+
+def test_history(tmp_path):
+    path = str(tmp_path / "history.jsonl")
+    fast = {"next": {"p99_ms": 1.0}, "list_songs": {"p99_ms": 2.0}}
+    slow = {"next": {"p99_ms": 1.1}, "list_songs": {"p99_ms": 3.0}}
+    assert benchmark.record("bot", {"guests": 10}, fast, path) is None
+    assert benchmark.record("bot", {"guests": 20}, slow, path) is None
+    previous = benchmark.record("bot", {"guests": 10}, slow, path)
+    assert previous["results"] == fast
+    assert benchmark.regressions(previous["results"], slow, "p99_ms", 0.2) == [
+        "list_songs: p99_ms 2.000 -> 3.000"
+    ]
+
+
+@pytest.mark.asyncio
+async def test_bench_bot():
+    args = argparse.Namespace(
+        guests=20,
+        songs=50,
+        updates=300,
+        next_every=10,
+        storage="memory",
+        coalesce_writes=True,
+        concurrency=4,
+        api_latency=0,
+        seed=1,
+    )
+    results = await bench_bot.run(args)
+    assert results["total"]["count"] == 300
+    assert results["total"]["ops_per_sec"] > 0
+    assert results["next"]["count"] == 30
+    assert sum(row["count"] for name, row in results.items() if name != "total") == 300
+    assert "request_song" in bench_bot.format_results(results)
+
+
+def test_bench_dj():
+    assert bench_dj.growth([10, 100, 1000], [1e-6, 1e-5, 1e-4]) == pytest.approx(1)
+    assert bench_dj.growth([10, 100], [2e-6, 2e-6]) == pytest.approx(0)
+    curves = bench_dj.run("memory", [5, 20], list(bench_dj.CASES), calls=5)
+    assert set(curves) == set(bench_dj.CASES)
+    assert all(list(curve) == [5, 20] for curve in curves.values())
+    assert all(seconds > 0 for curve in curves.values() for seconds in curve.values())
+    assert "show_all_queues ~n^" in bench_dj.plot(curves)
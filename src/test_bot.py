@@ -1,10 +1,21 @@
-from bot import KaraokeBot
+from bot import KaraokeBot, init_web_app
 import bot as modbot
+from storage import open_storage
 from youtube import VideoFormatter, SongInfo
 from unittest.mock import AsyncMock
 from telegram import Update, Message, CallbackQuery, Chat
+from telegram.error import Forbidden
+from telegram.ext import Application
+from aiohttp.test_utils import TestClient, TestServer
+from types import SimpleNamespace
+import asyncio
 import datetime
+import json
+import logging
+import os
 import pytest
+import subprocess
+import sys
 
 
 @pytest.mark.asyncio
@@ -80,12 +91,14 @@ async def test_markdown():
 
     update = Update(update_id=200, message=make_message(100, "/next"))
     await bot.next(update, context=None)
+    await bot.drain()
 
     bot.dj.new_users = [2]
     bot.dj.user_song_lists[2].append("https://youtu.be/fizzbuzz")
 
     update = Update(update_id=201, message=make_message(101, "/next"))
     await bot.next(update, context=None)
+    await bot.drain()
 
     update = Update(update_id=202, message=make_message(102, "/list"))
     update.set_bot(tgbot)
@@ -140,12 +153,14 @@ async def test_buttons():
     callback_query.set_bot(tgbot)
     update = Update(update_id=200, callback_query=callback_query)
     await bot.button_callback(update, context=None)
+    await bot.drain()
 
     bot.dj.new_users = [2, 3]
     bot.dj.user_song_lists[2].append("https://youtu.be/fizzbuzz")
 
     update = Update(update_id=201, message=make_message(101, "/next"))
     await bot.next(update, context=None)
+    await bot.drain()
 
     assert [call.kwargs["text"] for call in tgbot.send_message.call_args_list] == [
         "Singer: @user\\_name\nSong: https://youtu\\.be/xyzzy42",
@@ -188,6 +203,7 @@ async def test_notready():
 
     update = Update(update_id=201, message=make_message(101, "/next"))
     await bot.next(update, context=None)
+    await bot.drain()
 
     callback_query = CallbackQuery(
         from_user=admin,
@@ -200,10 +216,12 @@ async def test_notready():
     update = Update(update_id=200, callback_query=callback_query)
     update.set_bot(tgbot)
     await bot.button_callback(update, context=None)
+    await bot.drain()
 
     update = Update(update_id=202, message=make_message(102, "/undo"))
     update.set_bot(tgbot)
     await bot.undo(update, context=None)
+    await bot.drain()
 
     assert [
         (call.kwargs["chat_id"], call.kwargs["text"])
@@ -307,3 +325,454 @@ def test_youtube():
         url="https://music.yandex.ru/somesong",
         duration=0,
     )
+
+
+class FakeDisplay:
+    def __init__(self):
+        self.frames = []
+
+    async def send_frame(self, frame, opcode):
+        self.frames.append(json.loads(frame))
+
+
+@pytest.mark.asyncio
+async def test_display_updates():
+    bot = KaraokeBot({"names": {1: "@user_name"}})
+    singer = Chat(id=1, first_name="Joe", username="user_name", type="private")
+    tgbot = AsyncMock()
+    display = FakeDisplay()
+    await bot.add_display(display)
+    await asyncio.sleep(0.01)
+
+    message = Message(
+        from_user=singer,
+        message_id=100,
+        date=datetime.datetime.now(),
+        chat=singer,
+        text="https://youtu.be/xyzzy42",
+    )
+    message.set_bot(tgbot)
+    await bot.request_song(Update(update_id=200, message=message), context=None)
+    await asyncio.sleep(0.01)
+    bot.display_message(display, "resync")
+    await asyncio.sleep(0.01)
+
+    snapshot, delta, resync = display.frames
+    assert snapshot == {
+        "type": "snapshot",
+        "version": 1,
+        "current": {"singer": "No singer", "title": "", "url": ""},
+        "next": None,
+        "queue": [],
+    }
+    assert delta == {
+        "type": "delta",
+        "from": 1,
+        "version": 2,
+        "ops": [
+            {
+                "op": "add",
+                "before": None,
+                "id": 1,
+                "singer": "@user_name",
+                "paused": False,
+                "eta": 0,
+            },
+            {
+                "op": "next",
+                "next": {
+                    "singer": "@user_name",
+                    "title": "https://youtu.be/xyzzy42",
+                    "url": "https://youtu.be/xyzzy42",
+                },
+            },
+        ],
+    }
+    assert resync["type"] == "snapshot" and resync["version"] == 2
+
+
+@pytest.mark.asyncio
+async def test_concurrent_updates():
+    db = {
+        "queue": [1, 3],
+        "user:1": ["https://youtu.be/xyzzy42"],
+        "user:3": ["https://youtu.be/fizzbuzz"],
+        "names": {1: "@user_name", 2: "@admin_user", 3: "@random"},
+        "admins": {"admin_user"},
+    }
+    bot = KaraokeBot(db)
+    tgbot = AsyncMock()
+    unblock = asyncio.Event()
+    sent = []
+
+    async def send_message(chat_id, text, **kwargs):
+        if text.startswith("Singer:"):
+            await unblock.wait()
+        sent.append(text)
+        return AsyncMock()
+
+    tgbot.send_message.side_effect = send_message
+    admin = Chat(id=2, first_name="Admin", type="private", username="admin_user")
+    admin.set_bot(tgbot)
+
+    def make_update(update_id, text):
+        msg = Message(
+            from_user=admin,
+            message_id=update_id,
+            date=datetime.datetime.now(),
+            chat=admin,
+            text=text,
+        )
+        msg.set_bot(tgbot)
+        update = Update(update_id=update_id, message=msg)
+        update.set_bot(tgbot)
+        return update
+
+    first = asyncio.create_task(bot.next(make_update(1, "/next"), context=None))
+    second = asyncio.create_task(bot.next(make_update(2, "/next"), context=None))
+    await asyncio.sleep(0.01)
+    # the second /next waits for the first one; reading a list does not
+    assert bot.dj.current == (1, "https://youtu.be/xyzzy42")
+    await bot.list_songs(make_update(3, "/list"), context=None)
+    assert sent == ["Song list is empty"]
+
+    unblock.set()
+    await asyncio.gather(first, second)
+    await bot.drain()
+    assert sent[1:] == [
+        "Singer: @user\\_name\nSong: https://youtu\\.be/xyzzy42",
+        "You are next in the queue. Get ready to sing!",
+        "Singer: @random\nSong: https://youtu\\.be/fizzbuzz",
+        "You are next in the queue. Add a song to your list to sing next!",
+        "You may be called to sing next if the singer ahead of you is not ready",
+    ]
+
+
+@pytest.mark.asyncio
+async def test_webhook():
+    bot = KaraokeBot({})
+    application = Application.builder().token("123:TOKEN").build()
+    with pytest.raises(ValueError):
+        init_web_app(bot, application)
+    app = init_web_app(bot, application, secret_token="s3cret")
+    recorded = {
+        "update_id": 300,
+        "message": {
+            "message_id": 10,
+            "date": 1700000000,
+            "chat": {"id": 1, "type": "private", "first_name": "Joe"},
+            "from": {"id": 1, "is_bot": False, "first_name": "Joe"},
+            "text": "/list",
+        },
+    }
+    async with TestClient(TestServer(app)) as client:
+        response = await client.post("/telegram", json=recorded)
+        assert response.status == 403
+        headers = {"X-Telegram-Bot-Api-Secret-Token": "s3cret"}
+        response = await client.post("/telegram", data="{", headers=headers)
+        assert response.status == 400
+        for not_an_update in ({}, {"update_id": 1, "message": {}}, [1]):
+            response = await client.post(
+                "/telegram", json=not_an_update, headers=headers
+            )
+            assert response.status == 400
+        response = await client.post("/telegram", json=recorded, headers=headers)
+        assert response.status == 200
+
+    update = application.update_queue.get_nowait()
+    assert update.update_id == 300
+    assert update.message.text == "/list"
+    assert update.message.from_user.id == 1
+    assert application.update_queue.empty()
+
+
+@pytest.mark.asyncio
+async def test_metrics_endpoint():
+    bot = KaraokeBot({"queue": [1], "user:1": ["https://youtu.be/xyzzy42"]})
+    tgbot = AsyncMock()
+    singer = Chat(id=1, first_name="Joe", type="private")
+    singer.set_bot(tgbot)
+    message = Message(
+        from_user=singer,
+        message_id=100,
+        date=datetime.datetime.now(),
+        chat=singer,
+        text="/list",
+    )
+    message.set_bot(tgbot)
+    update = Update(update_id=200, message=message)
+    update.set_bot(tgbot)
+    await bot.list_songs(update, context=None)
+    bot.register_metrics()
+    # bots made later do not take over the gauges
+    KaraokeBot({})
+    async with TestClient(TestServer(init_web_app(bot))) as client:
+        response = await client.get("/metrics")
+        assert response.status == 200
+        assert response.content_type == "text/plain"
+        text = await response.text()
+    assert 'bot_handler_seconds_count{handler="list_songs"}' in text
+    assert 'queue_singers{party="0"} 1' in text
+    assert 'displays_connected{party="0"} 0' in text
+
+
+@pytest.mark.asyncio
+async def test_search_results():
+    bot = KaraokeBot({})
+    results = [
+        {
+            "thumbnail": f"https://i.ytimg.com/vi/id{i}/default.jpg",
+            "title": f"Song <{i}>",
+            "channel": "Karaoke & Co",
+            "url": f"https://www.youtube.com/watch?v=id{i}",
+        }
+        for i in range(1, 4)
+    ]
+    bot.formatter = SimpleNamespace(
+        search_youtube=AsyncMock(side_effect=[results, results[:1]])
+    )
+    tgbot = AsyncMock()
+    context = SimpleNamespace(bot=tgbot)
+    singer = Chat(id=1, first_name="Joe", type="private")
+
+    for update_id in (200, 201):
+        message = Message(
+            from_user=singer,
+            message_id=update_id,
+            date=datetime.datetime.now(),
+            chat=singer,
+            text="my way",
+        )
+        message.set_bot(tgbot)
+        await bot.request_song(Update(update_id=update_id, message=message), context)
+
+    # one album and one message with the buttons
+    [album] = tgbot.send_media_group.call_args_list
+    assert [media.caption for media in album.args[1]] == [
+        "1. Song &lt;1&gt;\n<i>Karaoke &amp; Co</i>",
+        "2. Song &lt;2&gt;\n<i>Karaoke &amp; Co</i>",
+        "3. Song &lt;3&gt;\n<i>Karaoke &amp; Co</i>",
+    ]
+    [buttons] = tgbot.send_message.call_args_list
+    keyboard = buttons.kwargs["reply_markup"].inline_keyboard
+    assert [row[0].text for row in keyboard] == [
+        "➕ 1. Song <1>",
+        "➕ 2. Song <2>",
+        "➕ 3. Song <3>",
+    ]
+    assert json.loads(keyboard[1][0].callback_data) == {
+        "a": "add",
+        "u": "https://www.youtube.com/watch?v=id2",
+    }
+
+    # a single result is one captioned photo
+    [photo] = tgbot.send_photo.call_args_list
+    assert photo.kwargs["caption"] == "Song &lt;1&gt;\n<i>Karaoke &amp; Co</i>"
+    assert photo.kwargs["reply_markup"].inline_keyboard[0][0].text == "Add to my list"
+
+
+@pytest.mark.asyncio
+async def test_next_side_effects(caplog):
+    db = {
+        "queue": [1, 3],
+        "user:1": ["https://youtu.be/xyzzy42"],
+        "user:3": ["https://youtu.be/fizzbuzz"],
+        "names": {1: "@user_name", 3: "@random"},
+        "admins": {"admin_user"},
+    }
+    bot = KaraokeBot(db)
+    tgbot = AsyncMock()
+    admin = Chat(id=2, first_name="Admin", type="private", username="admin_user")
+    admin.set_bot(tgbot)
+    unblock = asyncio.Event()
+    old_card = AsyncMock()
+
+    async def edit_reply_markup(**kwargs):
+        await unblock.wait()
+
+    old_card.edit_reply_markup.side_effect = edit_reply_markup
+    bot.parties.get(0).last_msg_with_buttons = old_card
+
+    message = Message(
+        from_user=admin,
+        message_id=100,
+        date=datetime.datetime.now(),
+        chat=admin,
+        text="/next",
+    )
+    message.set_bot(tgbot)
+    await asyncio.wait_for(bot.next(Update(update_id=200, message=message), None), 1)
+    # the new card is out while the old one is still being edited
+    assert tgbot.send_message.call_args_list[0].kwargs["text"].startswith("Singer:")
+    old_card.edit_reply_markup.assert_called_once_with(reply_markup=None)
+    assert bot._background
+
+    unblock.set()
+    await bot.drain()
+    assert not bot._background
+    assert [call.kwargs["chat_id"] for call in tgbot.send_message.call_args_list] == [
+        2,
+        3,
+    ]
+
+    # every side effect that fails is logged
+    old_card.edit_reply_markup.side_effect = RuntimeError("message is gone")
+    bot.parties.get(0).last_msg_with_buttons = old_card
+    bot.update_websockets = AsyncMock(side_effect=RuntimeError("display is gone"))
+    with caplog.at_level(logging.ERROR, logger="bot"):
+        await bot.next(Update(update_id=201, message=message), None)
+        await bot.drain()
+    assert "message is gone" in caplog.text
+    assert "display is gone" in caplog.text
+
+
+@pytest.mark.asyncio
+async def test_reset_does_not_wait_for_delivery():
+    db = {
+        "queue": [1, 3],
+        "user:1": ["https://youtu.be/xyzzy42"],
+        "user:3": ["https://youtu.be/fizzbuzz"],
+        "names": {1: "@user_name", 3: "@random"},
+        "admins": {"admin_user"},
+    }
+    bot = KaraokeBot(db)
+    tgbot = AsyncMock()
+    unblock = asyncio.Event()
+    delivered = []
+
+    async def send_message(**kwargs):
+        await unblock.wait()
+        delivered.append(kwargs["chat_id"])
+
+    tgbot.send_message.side_effect = send_message
+    admin = Chat(id=2, first_name="Admin", type="private", username="admin_user")
+    admin.set_bot(tgbot)
+    message = Message(
+        from_user=admin,
+        message_id=100,
+        date=datetime.datetime.now(),
+        chat=admin,
+        text="/reset",
+    )
+    message.set_bot(tgbot)
+    update = Update(update_id=200, message=message)
+    update.set_bot(tgbot)
+
+    await asyncio.wait_for(bot.reset(update, context=None), 1)
+    assert not bot.parties.get(0).lock.locked()
+    assert delivered == []
+    unblock.set()
+    await bot.drain()
+    assert sorted(delivered) == [1, 2, 3]
+
+
+@pytest.mark.asyncio
+async def test_join_leaves_old_party():
+    bot = KaraokeBot({"queue": [1, 3], "user:1": ["Elvis"], "user:3": ["Sting"]})
+    party = bot.parties.create("host")
+    tgbot = AsyncMock()
+    singer = Chat(id=1, first_name="Joe", type="private")
+    singer.set_bot(tgbot)
+    message = Message(
+        from_user=singer,
+        message_id=100,
+        date=datetime.datetime.now(),
+        chat=singer,
+        text=f"/join {party.id}",
+    )
+    message.set_bot(tgbot)
+    update = Update(update_id=200, message=message)
+    update.set_bot(tgbot)
+
+    await bot.join(update, context=None)
+    assert bot.parties.party_of(1) == party.id
+    assert list(bot.dj.queue) == [3] and bot.dj.user_song_lists.peek(1) == []
+    assert bot.dj.next()[1] == "Sting"
+
+
+@pytest.mark.asyncio
+async def test_initialize_sqlite(tmp_path):
+    db = open_storage(f"sqlite:{tmp_path / 'bot.sqlite'}")
+    db["queue"] = [1]
+    db["user:1"] = ["Elvis"]
+    bot = KaraokeBot(db)
+    application = AsyncMock()
+    await bot.initialize(application)
+    application.initialize.assert_awaited_once()
+    # the party read in a worker thread is used from the event loop
+    assert 0 in bot.parties.active
+    bot.dj.enqueue(2, "Sting")
+    assert db["user:2"] == ["Sting"]
+    assert [bot.dj.next()[1] for _ in range(2)] == ["Sting", "Elvis"]
+    db.close()
+
+
+def test_lazy_imports():
+    code = "import sys, bot; print(*sorted({'aiohttp', 'youtube'} & set(sys.modules)))"
+    env = os.environ | {"YOUTUBE_API_KEY": ""}
+    loaded = subprocess.run(
+        [sys.executable, "-c", code],
+        capture_output=True,
+        text=True,
+        check=True,
+        cwd=os.path.dirname(__file__) or ".",
+        env=env,
+    ).stdout
+    assert loaded.split() == []
+
+
+@pytest.mark.asyncio
+async def test_blocked_user_leaves_the_sending_party():
+    bot = KaraokeBot({"names": {5: "joe"}})
+    main = bot.parties.get(0)
+    other = bot.parties.create("host")
+    bot.parties.join(5, other.id)
+    other.dj.register(5, "joe")
+    tgbot = AsyncMock()
+    tgbot.send_message.side_effect = Forbidden("bot was blocked by the user")
+
+    delivery = bot.send_to_party(main, tgbot, [(5, "hello")])
+    await bot.drain()
+    assert delivery.blocked == [5]
+    assert 5 not in main.dj.names
+    assert other.dj.names[5] == "joe"
+
+
+@pytest.mark.asyncio
+async def test_replies_after_releasing_the_lock():
+    bot = KaraokeBot({})
+    party = bot.parties.get(0)
+    tgbot = AsyncMock()
+    unblock = asyncio.Event()
+
+    async def send_message(**kwargs):
+        await unblock.wait()
+
+    tgbot.send_message.side_effect = send_message
+    singer = Chat(id=1, first_name="Joe", type="private")
+    singer.set_bot(tgbot)
+
+    def make_update(update_id, text):
+        message = Message(
+            from_user=singer,
+            message_id=update_id,
+            date=datetime.datetime.now(),
+            chat=singer,
+            text=text,
+        )
+        message.set_bot(tgbot)
+        update = Update(update_id=update_id, message=message)
+        update.set_bot(tgbot)
+        return update
+
+    requests = [
+        asyncio.create_task(bot.request_song(make_update(1, "https://a.b/c"), None)),
+        asyncio.create_task(bot.pause(make_update(2, "/pause"), None)),
+    ]
+    await asyncio.sleep(0.05)
+    # both changes are made while their replies are still on the way
+    assert not party.lock.locked()
+    assert bot.dj.user_song_lists[1] == ["https://a.b/c"] and 1 in bot.dj.paused
+    unblock.set()
+    await asyncio.gather(*requests)
+    assert tgbot.send_message.await_count == 2
@@ -89,3 +89,48 @@ def test_reload():
     dj.remove()
     assert db["queue"] == []
     assert "user:2" not in db
+
+
+class CountingDict(CopyingDict):
+    def __init__(self):
+        super().__init__()
+        self.writes = []
+
+    def __setitem__(self, key, value):
+        self.writes.append(key)
+        super().__setitem__(key, value)
+
+
+def test_dirty_fields():
+    db = CountingDict()
+    dj = DJ(Party(db, 0))
+    dj.register(1, "avm")
+    dj.enqueue(1, "Elvis")
+    assert db.writes == ["names", "user:1", "new_users"]
+    db.writes.clear()
+    dj.register(1, "avm")
+    dj.pause(1)
+    assert db.writes == ["paused"]
+    db.writes.clear()
+    dj.unpause(1)
+    dj.next()
+    assert db.writes == ["paused", "new_users", "queue", "current"]
+    assert "user:1" not in db
+    assert db["queue"] == [1]
+    assert db["current"] == (1, "Elvis")
+
+
+def test_coalesce_writes():
+    db = CountingDict()
+    dj = DJ(Party(db, 0), coalesce_writes=True)
+    dj.register(1, "avm")
+    dj.enqueue(1, "Elvis")
+    dj.enqueue(1, "Doors")
+    dj.pause(1)
+    assert db.writes == []
+    dj.flush()
+    assert sorted(db.writes) == ["names", "new_users", "paused", "user:1"]
+    assert db["user:1"] == ["Elvis", "Doors"]
+    db.writes.clear()
+    dj.flush()
+    assert db.writes == []
@@ -0,0 +1,109 @@
+import asyncio
+import time
+
+import pytest
+from telegram.error import BadRequest, Forbidden, RetryAfter
+
+from dispatch import Dispatcher, TokenBucket
+from dj import DJ
+from party import Party
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_token_bucket():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=2, burst=3, clock=clock)
+    assert [bucket.reserve() for _ in range(5)] == [0, 0, 0, 0.5, 1.0]
+    clock.now = 10
+    assert [bucket.reserve() for _ in range(4)] == [0, 0, 0, 0.5]
+    clock.now = 20
+    bucket.hold(4)
+    assert bucket.reserve() == 4.5
+
+
+class FakeBot:
+    def __init__(self, errors={}):
+        self.sent = []
+        self.errors = dict(errors)
+
+    async def send_message(self, chat_id, text):
+        await asyncio.sleep(0.001)
+        if error := self.errors.pop((chat_id, text), None):
+            raise error
+        self.sent.append((time.monotonic(), chat_id, text))
+
+
+@pytest.mark.asyncio
+async def test_rate_limits():
+    dispatcher = Dispatcher(concurrency=4, global_rate=200, chat_rate=50, chat_burst=3)
+    bot = FakeBot()
+    start = time.monotonic()
+    delivery = await dispatcher.send(bot, [(1, f"message {i}") for i in range(10)])
+    assert (delivery.delivered, delivery.failed) == (10, 0)
+    assert [text for _, _, text in bot.sent] == [f"message {i}" for i in range(10)]
+    # 3 at once, then one every 1/50 s
+    assert time.monotonic() - start >= 7 / 50
+
+    bot = FakeBot()
+    start = time.monotonic()
+    await dispatcher.send(bot, [(chat, "hi") for chat in range(100, 400)])
+    assert len(bot.sent) == 300
+    assert time.monotonic() - start >= 100 / 200
+    assert not dispatcher._lanes and not dispatcher._chats
+
+
+@pytest.mark.asyncio
+async def test_errors():
+    blocked = []
+    dispatcher = Dispatcher(on_blocked=blocked.append)
+    bot = FakeBot(
+        {
+            (1, "a"): RetryAfter(1),
+            (2, "a"): Forbidden("bot was blocked by the user"),
+            (3, "a"): BadRequest("chat not found"),
+        }
+    )
+    start = time.monotonic()
+    first = dispatcher.submit(bot, [(1, "a"), (2, "a"), (3, "a"), (1, "b")])
+    second = dispatcher.submit(bot, [(2, "b"), (3, "b")])
+    assert await first.wait(3) and await second.wait(3)
+    bot.sent.sort(key=lambda sent: sent[1])
+    assert [(chat, text) for _, chat, text in bot.sent] == [
+        (1, "a"),
+        (1, "b"),
+        (3, "b"),
+    ]
+    assert bot.sent[0][0] - start >= 1  # after flood control
+    assert blocked == [2]
+    assert (first.delivered, first.failed, first.blocked) == (2, 2, [2])
+    assert (second.delivered, second.failed, second.blocked) == (1, 1, [2])
+    assert str(first) == "delivered 2 of 4, 2 failed (1 users blocked the bot)"
+
+
+@pytest.mark.asyncio
+async def test_blocked_per_delivery():
+    default, party1, party2 = [], [], []
+    dispatcher = Dispatcher(on_blocked=default.append)
+    bot = FakeBot({(2, "a"): Forbidden("bot was blocked by the user")})
+    first = dispatcher.submit(bot, [(2, "a")], on_blocked=party1.append)
+    second = dispatcher.submit(bot, [(2, "b")], on_blocked=party2.append)
+    third = dispatcher.submit(bot, [(2, "c")])
+    assert await first.wait(3) and await second.wait(3) and await third.wait(3)
+    assert (default, party1, party2) == ([2], [2], [2])
+
+
+def test_unregister():
+    dj = DJ(Party({}, 0))
+    dj.register(1, "singer")
+    dj.register(2, "lurker")
+    dj.enqueue(1, "Elvis")
+    dj.unregister(1)
+    dj.unregister(2)
+    assert dj.names == {1: "singer"}
@@ -0,0 +1,52 @@
+from displays import DisplayHub
+import asyncio
+import pytest
+
+
+class FakeSocket:
+    def __init__(self, delay: float = 0):
+        self.delay = delay
+        self.frames: list[bytes] = []
+        self.closed = False
+
+    async def send_frame(self, frame: bytes, opcode) -> None:
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        self.frames.append(frame)
+
+    async def close(self) -> None:
+        self.closed = True
+
+
+class BrokenSocket(FakeSocket):
+    async def send_frame(self, frame: bytes, opcode) -> None:
+        raise ConnectionResetError("gone")
+
+
+@pytest.mark.asyncio
+async def test_broadcast():
+    hub = DisplayHub(send_timeout=0.2)
+    fast, slow, stalled, broken = (
+        FakeSocket(),
+        FakeSocket(0.05),
+        FakeSocket(10),
+        BrokenSocket(),
+    )
+    for ws in (fast, slow, stalled, broken):
+        hub.add(ws, b"state 0")
+    await asyncio.sleep(0.01)
+    for i in range(1, 4):
+        hub.broadcast(f"state {i}".encode())
+        await asyncio.sleep(0.005)
+    await asyncio.sleep(0.3)
+
+    assert fast.frames == [b"state 0", b"state 1", b"state 2", b"state 3"]
+    # the slow display skipped the states it was too busy to show
+    assert slow.frames == [b"state 0", b"state 3"]
+    assert stalled.frames == [] and stalled.closed
+    assert broken.closed
+    assert set(hub.displays) == {fast, slow}
+
+    hub.remove(fast)
+    hub.remove(slow)
+    assert len(hub) == 0
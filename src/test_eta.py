@@ -0,0 +1,76 @@
+from dj import DJ, DEFAULT_SONG_DURATION
+from party import Party
+from youtube import SongInfo
+from telegram_markdown_text import MarkdownText
+import random
+
+
+class DurationFormatter:
+    def tg_format(self, url: str) -> MarkdownText:
+        return MarkdownText(url)
+
+    def get_data(self, url: str) -> SongInfo:
+        return SongInfo(title=url, url=url, duration=int(url.split("/")[-1]))
+
+
+def expected_etas(dj: DJ) -> dict[int, int | None]:
+    elapsed = dj._song_duration(dj.current[1]) if dj.current else 0
+    etas: dict[int, int | None] = {}
+    for singer in dj._rotation():
+        songs = dj.user_song_lists.get(singer)
+        if singer in dj.paused or not songs:
+            etas[singer] = None
+            continue
+        etas[singer] = elapsed
+        elapsed += dj._song_duration(songs[0])
+    return etas
+
+
+def test_etas_follow_the_rotation():
+    rng = random.Random(42)
+    dj = DJ(Party({}, 0), formatter=DurationFormatter())
+    rebuilds = 0
+    rebuild = dj._etas.rebuild
+
+    def counting_rebuild(*args):
+        nonlocal rebuilds
+        rebuilds += 1
+        rebuild(*args)
+
+    dj._etas.rebuild = counting_rebuild
+    for step in range(2000):
+        user = rng.randrange(1, 30)
+        action = rng.random()
+        if action < 0.4:
+            dj.enqueue(user, f"https://example.com/{rng.randrange(60, 400)}")
+        elif action < 0.8:
+            dj.next()
+            if rng.random() < 0.5:
+                dj.peek_next()
+        elif action < 0.85:
+            dj.pause(user)
+        elif action < 0.9:
+            dj.unpause(user)
+        elif action < 0.93:
+            dj.notready()
+        elif action < 0.96:
+            dj.remove_song(user, 0)
+        else:
+            dj.remove_with_id(user)
+        etas = {entry["id"]: entry["eta"] for entry in dj._queue_state()["queue"]}
+        assert etas == expected_etas(dj), step
+    # most steps were handled without walking the whole rotation
+    assert rebuilds < 500
+
+
+def test_eta_without_metadata():
+    dj = DJ(Party({}, 0))
+    dj.enqueue(1, "01")
+    dj.enqueue(2, "02")
+    dj.enqueue(1, "03")
+    dj.next()
+    queue = dj._queue_state()["queue"]
+    assert [entry["eta"] for entry in queue] == [
+        DEFAULT_SONG_DURATION,
+        2 * DEFAULT_SONG_DURATION,
+    ]
@@ -0,0 +1,172 @@
+import json
+
+import dj as moddj
+from dj import DJ
+from journal import Journal
+from party import Party
+
+
+def open_dj(tmp_path, db=None):
+    return DJ(Party(db or {}, 0), journal=Journal(str(tmp_path / "party0.jsonl")))
+
+
+def test_journal_file(tmp_path):
+    journal = Journal(str(tmp_path / "j.jsonl"))
+    assert journal.load() == (None, [])
+    journal.append({"op": "a"})
+    journal.append({"op": "b"})
+    journal.write_snapshot({"state": 1})
+    journal.append({"op": "c"})
+    journal.close()
+    with open(journal.path, "a") as f:
+        f.write('{"n": 4, "op": "cut sh')
+
+    journal = Journal(journal.path)
+    snapshot, records = journal.load()
+    assert snapshot == {"n": 2, "state": 1}
+    assert records == [{"n": 3, "op": "c"}]
+    # the torn record is gone and appends go after the good ones
+    journal.append({"op": "d"})
+    journal.close()
+    assert [json.loads(line)["op"] for line in open(journal.path)] == ["c", "d"]
+
+    # records already in the snapshot are skipped
+    with open(journal.path, "w") as f:
+        f.write('{"n": 2, "op": "b"}\n{"n": 3, "op": "c"}\n')
+    assert Journal(journal.path).load()[1] == [{"n": 3, "op": "c"}]
+
+
+def test_replay(tmp_path):
+    db = {"queue": [7], "user:7": ["Sting"], "names": {7: "old"}, "admins": {"a"}}
+    dj = open_dj(tmp_path, db)
+    dj.register(1, "avm")
+    dj.enqueue(1, "Elvis")
+    dj.enqueue(2, "Amanda Palmer")
+    dj.enqueue(2, "Bowie")
+    dj.move_song(2, "move_up", 1)
+    dj.next()
+    dj.peek_next()
+    dj.pause(7)
+    dj.enqueue(2, "Bowie")  # already there: nothing to record
+    state = dj._dump_state()
+    dj.close()
+    lines = open(tmp_path / "party0.jsonl").read().splitlines()
+    assert [json.loads(line)["op"] for line in lines] == [
+        "register",
+        "enqueue",
+        "enqueue",
+        "enqueue",
+        "move_song_url",
+        "next",
+        "peek_next",
+        "pause",
+    ]
+    # the party storage is not written to
+    assert "user:1" not in db and db["queue"] == [7]
+
+    dj = open_dj(tmp_path)
+    assert dj._dump_state() == state
+    assert dj.current == (1, "Elvis")
+    assert dj.user_song_lists[2] == ["Bowie", "Amanda Palmer"]
+
+
+def test_undo_everything(tmp_path):
+    dj = open_dj(tmp_path)
+    dj.enqueue(1, "Elvis")
+    dj.enqueue(2, "Amanda Palmer")
+    dj.enqueue(3, "Bowie")
+    states = [dj._dump_state()]
+    dj.next()
+    dj.peek_next()
+    states.append(dj._dump_state())
+    dj.register(2, "alice")
+    dj.notready()  # not ready for another /next yet
+    dj.next()
+    states.append(dj._dump_state())
+    dj.notready()
+
+    assert dj.undo() == [(None, "Undone: /notready"), (2, "You are now unpaused")]
+    assert dj.undo() == [(None, "Undone: /next")]
+    assert dj.undo() == [(None, "Undone: /notready"), (1, "You are now unpaused")]
+    for state in reversed(states[:-1]):
+        assert dj._dump_state() == state | {"names": [[2, "alice"]]}
+        dj.undo()
+
+    assert dj.undo() == [(None, "Nothing to undo")]
+    dj.close()
+    dj = open_dj(tmp_path)
+    assert dj._dump_state() == states[0] | {"names": [[2, "alice"]]}
+    assert dj.undo() == [(None, "Nothing to undo")]
+
+
+def test_undo_keeps_guest_changes(tmp_path):
+    dj = open_dj(tmp_path)
+    dj.enqueue(1, "Elvis")
+    dj.enqueue(1, "Presley")
+    dj.enqueue(2, "Bowie")
+    dj.next()
+    dj.notready()
+    dj.enqueue(2, "Amanda Palmer")
+    dj.move_song(2, action="move_down", index=0)
+
+    assert dj.undo() == [(None, "Undone: /notready"), (1, "You are now unpaused")]
+    assert dj.current == (1, "Elvis")
+    assert dj.user_song_lists[2] == ["Amanda Palmer", "Bowie"]
+
+    dj.close()
+    dj = open_dj(tmp_path)
+    assert dj.current == (1, "Elvis")
+    assert dj.user_song_lists[2] == ["Amanda Palmer", "Bowie"]
+
+
+def test_undo_next_keeps_song_edits(tmp_path):
+    dj = open_dj(tmp_path)
+    for song in ("A1", "A2", "A3"):
+        dj.enqueue(1, song)
+    dj.enqueue(2, "B1")
+    dj.next()
+    assert dj.remove_song(1, 0)  # A2
+    assert dj.move_song(2, "move_up", 0) is False
+    assert dj.undo() == [(None, "Undone: /next")]
+    assert dj.current is None
+    assert dj.user_song_lists[1] == ["A1", "A3"]
+
+    # journals written before songs were recorded by URL still replay
+    dj.close()
+    with open(tmp_path / "party0.jsonl", "a") as f:
+        f.write(json.dumps({"n": 99, "op": "remove_song", "args": [1, 1]}) + "\n")
+    dj = open_dj(tmp_path)
+    assert dj.user_song_lists[1] == ["A1"]
+
+
+def test_compaction(tmp_path, monkeypatch):
+    monkeypatch.setattr(moddj, "COMPACT_AFTER", 20)
+    monkeypatch.setattr(moddj, "UNDO_DEPTH", 5)
+    dj = open_dj(tmp_path)
+    for i in range(30):
+        dj.enqueue(i % 3, f"song {i}")
+        dj.next()
+    state = dj._dump_state()
+    journal = dj.journal
+    snapshot, records = Journal(journal.path).load()
+    assert len(snapshot["ops"]) == 5
+    assert len(records) < 20
+
+    dj.close()
+    dj = open_dj(tmp_path)
+    assert dj._dump_state() == state
+    undoable = [op for op in snapshot["ops"] + records if op["op"] in moddj.UNDOABLE]
+    for _ in undoable:
+        assert dj.undo() != [(None, "Nothing to undo")]
+    assert dj.undo() == [(None, "Nothing to undo")]
+
+
+def test_undo_keeps_leaving(tmp_path):
+    dj = open_dj(tmp_path)
+    dj.enqueue(1, "Elvis")
+    dj.enqueue(2, "Bowie")
+    dj.next()
+    dj.leave(2)
+    assert dj.undo() == [(None, "Undone: /next")]
+    assert dj.current is None
+    assert 2 not in dj.user_song_lists and list(dj.new_users) == [1]
@@ -0,0 +1,55 @@
+import pytest
+
+import metrics
+
+
+def test_render():
+    registry = metrics.Registry()
+    requests = metrics.Counter(
+        "requests_total", "Requests", ["kind"], registry=registry
+    )
+    depth = metrics.Gauge("depth", "Depth", ["party"], registry=registry)
+    latency = metrics.Histogram(
+        "latency_seconds", "Latency", buckets=(0.1, 1), registry=registry
+    )
+    requests.inc(kind="search")
+    requests.inc(2, kind='say "hi"')
+    depth.callback = lambda: {("0",): 3, ("7",): 0}
+    latency.observe(0.05)
+    latency.observe(0.5)
+    latency.observe(5)
+
+    assert requests.get(kind="search") == 1
+    assert latency.count() == 3
+    assert registry.render().splitlines() == [
+        "# HELP requests_total Requests",
+        "# TYPE requests_total counter",
+        'requests_total{kind="search"} 1',
+        'requests_total{kind="say \\"hi\\""} 2',
+        "# HELP depth Depth",
+        "# TYPE depth gauge",
+        'depth{party="0"} 3',
+        'depth{party="7"} 0',
+        "# HELP latency_seconds Latency",
+        "# TYPE latency_seconds histogram",
+        'latency_seconds_bucket{le="0.1"} 1',
+        'latency_seconds_bucket{le="1"} 2',
+        'latency_seconds_bucket{le="+Inf"} 3',
+        "latency_seconds_sum 5.55",
+        "latency_seconds_count 3",
+    ]
+
+
+@pytest.mark.asyncio
+async def test_timed():
+    registry = metrics.Registry()
+    latency = metrics.Histogram("latency", "Latency", ["op"], registry=registry)
+
+    @metrics.timed(latency, op="fail")
+    async def fail():
+        raise ValueError
+
+    with pytest.raises(ValueError):
+        await fail()
+    assert latency.count(op="fail") == 1
+    assert latency.count(op="other") == 0
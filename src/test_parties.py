@@ -0,0 +1,67 @@
+from dj import DJ
+from parties import PartyRegistry
+from storage import SqliteStorage
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_parties():
+    db = {}
+    clock = FakeClock()
+    made = []
+
+    def make_dj(party):
+        made.append(party.id)
+        return DJ(party)
+
+    parties = PartyRegistry(db, make_dj, {"host"}, idle_timeout=60, clock=clock)
+    main = parties.for_user(1)
+    assert main.id == 0 and main.dj.is_admin("host")
+    main.dj.enqueue(1, "Elvis")
+
+    second = parties.create("guest_host")
+    assert second.id == 1 and parties.exists(1) and not parties.exists(2)
+    assert second.dj.is_admin("guest_host") and not second.dj.is_admin("host")
+    assert parties.join(2, 1) is second
+    second.dj.enqueue(2, "Amanda Palmer")
+    assert parties.for_user(2) is second
+    assert db["user:1"] == ["Elvis"]
+    assert db["party1:user:2"] == ["Amanda Palmer"]
+    assert db["party1:new_users"] == [2]
+    assert db["new_users"] == [1]
+
+    clock.now = 30
+    parties.for_user(1)
+    clock.now = 70
+    assert parties.evict_idle() == [1]
+    assert list(parties.active) == [0]
+
+    # a fresh registry finds the members and parties in storage
+    parties = PartyRegistry(db, make_dj, clock=clock)
+    party = parties.for_user(2)
+    assert party.id == 1 and party.dj.next()[1] == "Amanda Palmer"
+    assert made == [0, 1, 1]
+
+
+def test_parties_sqlite(tmp_path):
+    db = SqliteStorage(str(tmp_path / "bot.sqlite"))
+    parties = PartyRegistry(db, DJ)
+    party = parties.create("host")
+    parties.join(5, party.id)
+    party.dj.enqueue(5, "Elvis")
+    party.dj.enqueue(6, "Sting")
+    db.close()
+
+    db = SqliteStorage(str(tmp_path / "bot.sqlite"))
+    parties = PartyRegistry(db, DJ)
+    party = parties.for_user(5)
+    assert party.id == 1
+    assert party.dj.user_song_lists[5] == ["Elvis"]
+    assert list(party.dj.new_users) == [5, 6]
+    assert parties.for_user(6).id == 0
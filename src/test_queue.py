@@ -233,7 +233,24 @@ def test_formatter():
     dj.enqueue(1, "03")
     assert dj.next() == format_next("avm", "Baseballs — Umbrella", "01")
     assert dj.get_queue_json() == (
-        '{"current": {"singer": "avm", "title": "Baseballs — Umbrella", "url": "01"}, '
-        '"queue": [{"singer": "avm", "paused": false}]}'
+        '{"type": "snapshot", "version": 1, '
+        '"current": {"singer": "avm", "title": "Baseballs — Umbrella", "url": "01"}, '
+        '"next": {"singer": "avm", "title": "03", "url": "03"}, '
+        '"queue": [{"id": 1, "singer": "avm", "paused": false, "eta": 240}]}'
     )
     assert dj.next() == format_next("avm", "03")
+
+
+def test_queue_snapshot():
+    fmt = DummyFormatter({"01": "Baseballs — Umbrella"})
+    dj = DJ(Party({}, 0), formatter=fmt)
+    dj.register(1, "avm")
+    dj.enqueue(1, "01")
+    first = dj.get_queue_snapshot()
+    assert dj.get_queue_snapshot() is first
+    assert first.data == first.text.encode()
+    dj.next()
+    second = dj.get_queue_snapshot()
+    assert second.version > first.version
+    assert "Baseballs" in second.text
+    assert dj.get_queue_snapshot() is second
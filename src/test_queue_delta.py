@@ -0,0 +1,85 @@
+from queue_delta import diff_queue
+from dj import DJ
+from party import Party
+import itertools
+import json
+
+
+def apply_delta(state, ops):
+    """Apply ops the way queue.html does"""
+    state = dict(state)
+    queue = [dict(entry) for entry in state["queue"]]
+    for op in ops:
+        match op["op"]:
+            case "remove":
+                queue = [entry for entry in queue if entry["id"] != op["id"]]
+            case "add" | "move":
+                if op["op"] == "add":
+                    entry = {k: v for k, v in op.items() if k not in ("op", "before")}
+                else:
+                    entry = next(entry for entry in queue if entry["id"] == op["id"])
+                    queue.remove(entry)
+                ids = [entry["id"] for entry in queue]
+                index = len(queue) if op["before"] is None else ids.index(op["before"])
+                queue.insert(index, entry)
+            case "update":
+                entry = next(entry for entry in queue if entry["id"] == op["id"])
+                entry.update((k, v) for k, v in op.items() if k not in ("op", "id"))
+            case "current" | "next":
+                state[op["op"]] = op[op["op"]]
+    return state | {"queue": queue}
+
+
+def entries(*ids, paused=()):
+    return [{"id": id, "singer": f"s{id}", "paused": id in paused} for id in ids]
+
+
+def check(old_ids, new_ids, paused=()):
+    old = {"current": {"singer": "a"}, "queue": entries(*old_ids)}
+    new = {"current": {"singer": "b"}, "queue": entries(*new_ids, paused=paused)}
+    ops = diff_queue(old, new)
+    assert apply_delta(old, ops) == new
+    return ops
+
+
+def test_rotation_is_one_move():
+    ops = check([1, 2, 3, 4], [2, 3, 4, 1])
+    assert ops[:-1] == [{"op": "move", "id": 1, "before": None}]
+
+
+def test_pause_and_add():
+    ops = check([1, 2], [1, 2, 3], paused={2})
+    assert ops == [
+        {"op": "add", "before": None, "id": 3, "singer": "s3", "paused": False},
+        {"op": "update", "id": 2, "paused": True},
+        {"op": "current", "current": {"singer": "b"}},
+    ]
+
+
+def test_all_permutations():
+    for old in itertools.permutations(range(4)):
+        for n in range(5):
+            for new in itertools.permutations(range(1, 5), n):
+                check(list(old), list(new), paused={2})
+
+
+def test_dj_deltas():
+    dj = DJ(Party({}, 0))
+    dj.register(1, "avm")
+    dj.register(2, "alice")
+    dj.enqueue(1, "01")
+    dj.enqueue(2, "02")
+    dj.enqueue(1, "03")
+    first = dj.get_queue_snapshot()
+    dj.next()
+    dj.pause(2)
+    delta = json.loads(dj.get_queue_delta(first))
+    second = dj.get_queue_snapshot()
+    assert (delta["from"], delta["version"]) == (first.version, second.version)
+    assert apply_delta(first.state, delta["ops"]) == second.state
+    assert second.state["next"] == {"singer": "avm", "title": "03", "url": "03"}
+    assert {"op": "next", "next": second.state["next"]} in delta["ops"]
+
+    # no visible change, no new version
+    dj.enqueue(2, "04")
+    assert dj.get_queue_snapshot() is second
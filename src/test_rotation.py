@@ -0,0 +1,20 @@
+from rotation import Rotation
+
+
+def test_rotation():
+    r = Rotation([1, 2, 3])
+    r.append(4)
+    r.appendleft(5)
+    assert list(r) == [5, 1, 2, 3, 4]
+    assert r.popleft() == 5
+    assert r.first() == 1
+    r.remove(3)
+    r.discard(3)
+    assert 3 not in r and 2 in r
+    assert r == [1, 2, 4]
+    r.append(1)  # already present, keeps its place
+    assert r == Rotation([1, 2, 4])
+    assert len(r) == 3
+    r.clear()
+    assert not r
+    assert r.first() is None
@@ -0,0 +1,100 @@
+import dj as moddj
+from dj import DJ
+from party import Party
+from song_lists import SongLists
+from storage import open_storage
+
+
+def test_song_lists():
+    stored = {1: ["a"], 2: ["b"], 3: ["c"], 4: ["d"]}
+    evicted = []
+    lists = SongLists(
+        lambda user: list(stored.get(user, [])),
+        lambda user, songs: evicted.append((user, songs)),
+        capacity=2,
+        pinned=lambda: [1],
+    )
+    assert lists[1] == ["a"] and lists[2] == ["b"]
+    lists[3].append("e")
+    # 1 is pinned, so 2 has to go
+    assert evicted == [(2, ["b"])] and list(lists) == [1, 3]
+    assert lists.peek(4) == ["d"] and list(lists) == [1, 3]
+    assert 4 in lists and 5 not in lists
+    assert lists.get(5) is None
+    assert evicted == [(2, ["b"]), (3, ["c", "e"])]
+
+    del lists[1]
+    assert lists[1] == [] and 1 not in lists
+    assert lists.pop(4) == ["d"] and lists.peek(4) == []
+    lists.clear()
+    assert len(lists) == 0
+    assert evicted[-2:] == [(1, []), (4, [])]
+
+
+def test_resident_song_lists(monkeypatch, tmp_path):
+    monkeypatch.setattr(moddj, "RESIDENT_SONG_LISTS", 10)
+    monkeypatch.setattr(moddj, "RESIDENT_HEAD", 3)
+    db = open_storage(f"shelve:{tmp_path / 'bot'}")
+    db["queue"] = list(range(1, 1001))
+    for user in range(1, 1001):
+        db[f"user:{user}"] = [f"song {user}"]
+
+    dj = DJ(Party(db, 0), coalesce_writes=True)
+    assert dj.user_song_lists.loads == 0
+
+    for user in range(1, 1001):
+        dj.enqueue(user, f"another song {user}")
+        dj.next()
+        assert len(dj.user_song_lists) <= 10
+    for user in range(1, 4):
+        dj.enqueue(user, "third song")
+    # lists written before they leave memory; the rest on flush
+    assert db["user:1"] == ["another song 1"]
+    assert db["user:500"] == ["another song 500"]
+    dj.flush()
+    assert db["user:1"] == ["another song 1", "third song"]
+
+    dj = DJ(Party(db, 0))
+    assert [dj.next()[1] for _ in range(3)] == [
+        "another song 1",
+        "another song 2",
+        "another song 3",
+    ]
+    assert db["user:1000"] == ["another song 1000"] and "user:1" in db
+    assert dj.user_song_lists.loads == 3
+
+
+def test_heads_of_lists_not_in_memory(monkeypatch):
+    monkeypatch.setattr(moddj, "RESIDENT_SONG_LISTS", 4)
+    monkeypatch.setattr(moddj, "RESIDENT_HEAD", 1)
+    db = {"queue": list(range(1, 5))}
+    for user in range(1, 31):
+        db[f"user:{user}"] = [f"song {user}", "encore"]
+    reads = []
+    dj = DJ(Party(db, 0))
+    load = dj.user_song_lists._load
+    monkeypatch.setattr(
+        dj.user_song_lists, "_load", lambda u: reads.append(u) or load(u)
+    )
+
+    for _ in range(3):
+        # as if the queue had changed
+        dj._snapshot = None
+        dj._etas.invalidate()
+        dj.get_queue_json()
+        dj.show_queue(3)
+    assert sorted(reads) == [1, 2, 3, 4]
+
+    # a list that was in memory is not read again once it is dropped
+    for user in range(1, 7):
+        dj.enqueue(user, "first")
+    assert 2 not in dj.user_song_lists._lists
+    reads.clear()
+    assert dj.show_queue(2).endswith(r"\(3 songs\)")
+    assert reads == []
+
+    # what is remembered does not grow with the party
+    dj.queue = list(range(1, 31))
+    dj.get_queue_json()
+    assert len(dj.user_song_lists._heads) <= 4
+    assert len(dj._head_durations) <= 4
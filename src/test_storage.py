@@ -0,0 +1,103 @@
+from dj import DJ
+from party import Party
+from storage import (
+    SqliteStorage,
+    ShelveStorage,
+    MappingStorage,
+    Storage,
+    copy_storage,
+)
+import pytest
+
+
+def test_sqlite_tables(tmp_path):
+    db = SqliteStorage(str(tmp_path / "bot.sqlite"))
+    db["user:1"] = ["Elvis", "Doors"]
+    db["party3:queue"] = [2, 1]
+    db["youtube:xyzzy"] = '{"title":"Title","duration":70}'
+    db["names"] = {1: "avm"}
+    db["paused"] = {3}
+
+    assert db["user:1"] == ["Elvis", "Doors"]
+    assert db["party3:queue"] == [2, 1]
+    assert db["youtube:xyzzy"] == '{"title":"Title","duration":70}'
+    assert db["names"] == {1: "avm"}
+    assert db.get("paused") == {3}
+    assert db.get("queue", []) == []
+    assert "user:1" in db and "user:2" not in db
+    assert db.conn.execute("SELECT COUNT(*) FROM song_lists").fetchone() == (2,)
+
+    db["user:1"] = ["Doors"]
+    assert db["user:1"] == ["Doors"]
+    del db["user:1"]
+    assert "user:1" not in db
+    with pytest.raises(KeyError):
+        del db["user:1"]
+
+
+def test_sqlite_batch_rollback(tmp_path):
+    db = SqliteStorage(str(tmp_path / "bot.sqlite"))
+    db["queue"] = [1]
+    with pytest.raises(RuntimeError):
+        with db.batch():
+            db["queue"] = [1, 2]
+            db["current"] = (1, "Elvis")
+            raise RuntimeError
+    assert db["queue"] == [1]
+    assert "current" not in db
+
+
+def test_sqlite_dj(tmp_path):
+    path = str(tmp_path / "bot.sqlite")
+    dj = DJ(Party(SqliteStorage(path), 0))
+    dj.register(1, "avm")
+    dj.register(2, "alice")
+    dj.enqueue(1, "Elvis")
+    dj.enqueue(2, "Amanda Palmer")
+    dj.enqueue(2, "Nickelback")
+    dj.next()  # Elvis
+    dj.party.db.close()
+
+    db = SqliteStorage(path)
+    dj = DJ(Party(db, 0))
+    assert db["queue"] == [1]
+    assert db["new_users"] == [2]
+    assert dj.next()[1] == "Amanda Palmer"
+    assert dj.next()[1] == "Nickelback"
+    assert dj.next()[1] == ""
+    assert "user:2" not in db
+
+
+def test_copy_storage(tmp_path):
+    shelf = ShelveStorage(str(tmp_path / "bot"))
+    shelf["user:1"] = ["Elvis"]
+    shelf["names"] = {1: "avm"}
+    target = MappingStorage({})
+    assert copy_storage(shelf, target) == 2
+    assert target.data == {"user:1": ["Elvis"], "names": {1: "avm"}}
+
+
+def test_storage_is_abstract():
+    class NoKeys(MappingStorage):
+        keys = Storage.keys
+
+    with pytest.raises(TypeError):
+        NoKeys({})
+
+
+def test_scan(tmp_path):
+    sqlite = SqliteStorage(str(tmp_path / "bot.sqlite"))
+    for db in (MappingStorage({}), sqlite):
+        db["search:a"] = {"time": 1}
+        db["search:b"] = {"time": 2}
+        db["searches"] = 3
+        db["searchz:c"] = 4
+        db["user:1"] = ["Elvis"]
+        db["youtube:xyz"] = "Title"
+        assert sorted(db.scan("search:")) == [
+            ("search:a", {"time": 1}),
+            ("search:b", {"time": 2}),
+        ]
+        assert list(db.scan("user:")) == [("user:1", ["Elvis"])]
+        assert list(db.scan("youtube:")) == [("youtube:xyz", "Title")]
+    sqlite.close()
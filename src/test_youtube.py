@@ -0,0 +1,173 @@
+from youtube import VideoFormatter, SongInfo, SearchCache
+import httpx
+import json
+import pytest
+
+
+def fake_youtube(requests: list[httpx.Request]) -> httpx.AsyncClient:
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        ids = request.url.params["id"].split(",")
+        items = [
+            {
+                "id": yt_id,
+                "snippet": {"title": f"Song {yt_id}"},
+                "contentDetails": {"duration": "PT3M30S"},
+            }
+            for yt_id in ids
+            if yt_id != "missing"
+        ]
+        return httpx.Response(200, json={"items": items})
+
+    return httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+
+@pytest.mark.asyncio
+async def test_batched_fetch():
+    requests: list[httpx.Request] = []
+    db = {"youtube:known": json.dumps({"title": "Known", "duration": 60})}
+    vf = VideoFormatter("key", db, http=fake_youtube(requests), batch_window=0.01)
+
+    await vf.register_url("https://youtu.be/aaa")
+    await vf.register_url("https://www.youtube.com/watch?v=bbb")
+    await vf.register_url("https://youtu.be/aaa")
+    await vf.register_url("https://youtu.be/known")
+    await vf.register_url("https://youtu.be/missing")
+    await vf.register_url("https://music.yandex.ru/somesong")
+    await vf.drain()
+
+    assert [r.url.params["id"] for r in requests] == ["aaa,bbb,missing"]
+    assert "maxResults" not in requests[0].url.params
+    assert vf.song_info("https://youtu.be/bbb") == SongInfo(
+        title="Song bbb", url="https://youtu.be/bbb", duration=210
+    )
+    assert "youtube:missing" not in db
+
+    await vf.register_url("https://youtu.be/aaa")
+    await vf.drain()
+    assert len(requests) == 1
+
+
+@pytest.mark.asyncio
+async def test_malformed_details():
+    bodies = [b"<html>Service Unavailable</html>", b"[]", b'{"items": 1}']
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(200, content=bodies.pop(0))
+
+    http = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    db: dict[str, str] = {}
+    vf = VideoFormatter("key", db, http=http, batch_window=0.01)
+    for body in list(bodies):
+        await vf.register_url("https://youtu.be/aaa")
+        await vf.drain()
+    assert not bodies
+    assert not db
+
+    vf.http = fake_youtube([])
+    await vf.register_url("https://youtu.be/aaa")
+    await vf.drain()
+    assert vf.song_info("https://youtu.be/aaa").title == "Song aaa"
+
+
+@pytest.mark.asyncio
+async def test_batch_size_limit():
+    requests: list[httpx.Request] = []
+    vf = VideoFormatter("key", {}, http=fake_youtube(requests), batch_window=0.01)
+    for i in range(120):
+        await vf.register_url(f"https://youtu.be/v{i}")
+    await vf.drain()
+    assert [len(r.url.params["id"].split(",")) for r in requests] == [50, 50, 20]
+
+
+@pytest.mark.asyncio
+async def test_song_info_cache():
+    requests: list[httpx.Request] = []
+    db = {"youtube:aaa": "Plain title"}
+    vf = VideoFormatter(
+        "key", db, http=fake_youtube(requests), batch_window=0.01, cache_size=2
+    )
+
+    assert vf.get_data("https://youtu.be/aaa").title == "Plain title"
+    assert vf.get_data("https://youtube.com/watch?v=aaa") == SongInfo(
+        title="Plain title", url="https://youtube.com/watch?v=aaa", duration=0
+    )
+    assert vf.get_data("https://youtu.be/nothing") is None
+    assert (vf.cache_hits, vf.cache_misses) == (1, 2)
+
+    # a fetched record replaces the cached one
+    await vf.register_url("https://youtu.be/aaa")
+    await vf.drain()
+    assert vf.song_info("https://youtu.be/aaa").title == "Song aaa"
+
+    db["youtube:bbb"] = "B"
+    db["youtube:ccc"] = "C"
+    vf.get_data("https://youtu.be/bbb")
+    vf.get_data("https://youtu.be/ccc")
+    assert list(vf._cache) == ["bbb", "ccc"]
+
+
+def test_search_cache():
+    now = [1000.0]
+    db: dict = {}
+    cache = SearchCache(db, ttl=60, max_entries=2, clock=lambda: now[0])
+    results = [{"title": "Dancing Queen", "url": "https://youtu.be/dq"}]
+    cache.put("Dancing  Queen karaoke", results)
+    assert cache.get("dancing queen KARAOKE") == results
+    assert db["search:dancing queen karaoke"]["results"] == results
+
+    # survives a restart
+    cache = SearchCache(db, ttl=60, max_entries=2, clock=lambda: now[0])
+    assert cache.get("dancing queen karaoke") == results
+
+    now[0] += 61
+    assert cache.get("dancing queen karaoke") is None
+    assert "search:dancing queen karaoke" not in db
+
+    # nothing found is not remembered: it may have been an API error
+    cache.put("z karaoke", [])
+    assert "search:z karaoke" not in db
+
+    cache.put("a karaoke", results)
+    cache.put("b karaoke", results)
+    cache.put("c karaoke", results)
+    assert cache.get("a karaoke") is None
+    assert [key for key in db if key.startswith("search:")] == [
+        "search:b karaoke",
+        "search:c karaoke",
+    ]
+    assert (cache.hits, cache.misses) == (1, 2)
+
+    # the oldest query still goes first after a restart
+    cache = SearchCache(db, ttl=60, max_entries=2, clock=lambda: now[0])
+    assert cache.get("b karaoke") == results
+    del db["search:c karaoke"]
+    assert cache.get("c karaoke") is None
+    cache.put("d karaoke", results)
+    cache.put("e karaoke", results)
+    assert "search:b karaoke" not in db
+
+
+@pytest.mark.asyncio
+async def test_search_youtube_cached():
+    requests: list[httpx.Request] = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        item = {
+            "id": {"videoId": "dq"},
+            "snippet": {
+                "title": "Dancing Queen",
+                "channelTitle": "Sing King",
+                "thumbnails": {"default": {"url": "https://i.ytimg.com/dq.jpg"}},
+            },
+        }
+        return httpx.Response(200, json={"items": [item]})
+
+    http = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    vf = VideoFormatter("key", {}, http=http)
+    first = await vf.search_youtube("dancing queen")
+    second = await vf.search_youtube("Dancing Queen ")
+    assert first == second
+    assert first[0]["url"] == "https://www.youtube.com/watch?v=dq"
+    assert len(requests) == 1
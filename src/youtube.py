@@ -1,10 +1,16 @@
-from dataclasses import dataclass
+from collections import OrderedDict
+from dataclasses import dataclass, replace
+from itertools import islice
+from typing import Callable
+import asyncio
+import time
 import httpx
 from urllib.parse import urlparse, parse_qs
 from telegram_markdown_text import MarkdownText, InlineUrl
-import isodate
 import json
 import html
+import metrics
+from storage import as_storage
 
 
 def extract_youtube_id(url: str) -> str | None:
@@ -22,6 +28,20 @@ def extract_youtube_id(url: str) -> str | None:
     return None
 
 
+# The videos endpoint accepts at most this many ids per request
+MAX_BATCH_SIZE = 50
+
+# Daily quota units that a request to each API endpoint costs
+QUOTA_COST = {"search": 100, "videos": 1}
+
+API_SECONDS = metrics.Histogram(
+    "youtube_request_seconds", "YouTube Data API request latency", ["endpoint"]
+)
+QUOTA_UNITS = metrics.Counter(
+    "youtube_quota_units_total", "YouTube Data API quota units spent", ["endpoint"]
+)
+
+
 @dataclass
 class SongInfo:
     title: str
@@ -29,15 +49,140 @@ class SongInfo:
     duration: float
 
 
+class SearchCache:
+    """Search results kept in the db under `search:<query>` for `ttl` seconds.
+
+    At most `max_entries` queries are stored; the oldest go first. Each
+    record holds the time it was stored, and the index of all queries is
+    rebuilt from the `search:` records on first use, so a search writes
+    only its own record. Searches that found nothing are not kept: that is
+    as likely an API error or an exhausted quota as a real answer.
+    """
+
+    PREFIX = "search:"
+    # where older versions kept the index
+    INDEX_KEY = "search_index"
+
+    def __init__(
+        self,
+        db,
+        ttl: float = 7 * 24 * 3600,
+        max_entries: int = 2000,
+        clock: Callable[[], float] = time.time,
+    ):
+        self.db = as_storage(db)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.clock = clock
+        # query -> time stored, oldest first
+        self._index: OrderedDict[str, float] | None = None
+        self._results: dict[str, list[dict[str, str]]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize(query: str) -> str:
+        return " ".join(query.lower().split())
+
+    @classmethod
+    def _db_key(cls, query: str) -> str:
+        return cls.PREFIX + query
+
+    def _entries(self) -> OrderedDict[str, float]:
+        if self._index is None:
+            stored = [
+                (key.removeprefix(self.PREFIX), record.get("time", 0))
+                for key, record in self.db.scan(self.PREFIX)
+            ]
+            self._index = OrderedDict(sorted(stored, key=lambda item: item[1]))
+            if self.INDEX_KEY in self.db:
+                del self.db[self.INDEX_KEY]
+        return self._index
+
+    def get(self, query: str) -> list[dict[str, str]] | None:
+        query = self.normalize(query)
+        stored = self._entries().get(query)
+        if stored is not None and self.clock() - stored > self.ttl:
+            self._forget(query)
+            stored = None
+        results = None
+        if stored is not None:
+            results = self._results.get(query)
+            if results is None:
+                record = self.db.get(self._db_key(query))
+                if record is None:
+                    # removed behind our back
+                    self._forget(query)
+                else:
+                    results = self._results[query] = record["results"]
+        if results is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return results
+
+    def put(self, query: str, results: list[dict[str, str]]) -> None:
+        if not results:
+            return
+        query = self.normalize(query)
+        now = self.clock()
+        index = self._entries()
+        index.pop(query, None)
+        index[query] = now
+        self._results[query] = results
+        self.db[self._db_key(query)] = {"time": now, "results": results}
+        while len(index) > self.max_entries:
+            oldest = next(iter(index))
+            self._forget(oldest)
+
+    def _forget(self, query: str) -> None:
+        del self._entries()[query]
+        self._results.pop(query, None)
+        if self._db_key(query) in self.db:
+            del self.db[self._db_key(query)]
+
+
 class VideoFormatter:
-    def __init__(self, yt_api_key: str, db={}):
+    def __init__(
+        self,
+        yt_api_key: str,
+        db={},
+        http: httpx.AsyncClient | None = None,
+        batch_window: float = 0.2,
+        cache_size: int = 4096,
+    ):
         self.db = db
         self.yt_api_key = yt_api_key
-        self.http = httpx.AsyncClient()
+        self.http = http or httpx.AsyncClient()
+        # how long to collect video ids before asking YouTube about all of them
+        self.batch_window = batch_window
+        self._pending: dict[str, None] = {}
+        self._batcher: asyncio.Task | None = None
+        # decoded db records by YouTube id, least recently used first
+        self._cache: OrderedDict[str, SongInfo] = OrderedDict()
+        self.cache_size = cache_size
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.searches = SearchCache(db)
+        # bumped whenever new video details are stored
+        self.generation = 0
 
     def get_data(self, url: str) -> SongInfo | None:
         if not (yt_id := extract_youtube_id(url)):
             return None
+        if (info := self._cache.get(yt_id)) is not None:
+            self._cache.move_to_end(yt_id)
+            self.cache_hits += 1
+        else:
+            self.cache_misses += 1
+            if (info := self._load(yt_id, url)) is None:
+                return None
+            self._cache[yt_id] = info
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return info if info.url == url else replace(info, url=url)
+
+    def _load(self, yt_id: str, url: str) -> SongInfo | None:
         record = self.db.get(self._db_key(yt_id))
         if record and record.startswith("{"):
             data = json.loads(record)
@@ -68,29 +213,42 @@ class VideoFormatter:
     def _db_key(yt_id: str) -> str:
         return f"youtube:{yt_id}"
 
-    async def _fetch_details(self, yt_id: str) -> None:
-        url = "https://www.googleapis.com/youtube/v3/videos"
-        response = await self.http.get(
-            url,
-            params=dict(part="snippet,contentDetails", id=yt_id, key=self.yt_api_key),
+    async def _api_get(self, endpoint: str, **params) -> httpx.Response:
+        url = f"https://www.googleapis.com/youtube/v3/{endpoint}"
+        with API_SECONDS.time(endpoint=endpoint):
+            response = await self.http.get(url, params=params)
+        QUOTA_UNITS.inc(QUOTA_COST[endpoint], endpoint=endpoint)
+        return response
+
+    async def _fetch_details(self, yt_ids: list[str]) -> None:
+        import isodate  # not needed until the first lookup
+
+        response = await self._api_get(
+            "videos",
+            part="snippet,contentDetails",
+            id=",".join(yt_ids),
+            key=self.yt_api_key,
         )
         data = response.json()
 
-        # Extract video title and thumbnail URL
-        try:
-            title = data["items"][0]["snippet"]["title"]
-            duration = isodate.parse_duration(
-                data["items"][0]["contentDetails"]["duration"]
-            )
-            seconds = duration.total_seconds()
-            print("Got title for", yt_id, title, "duration", seconds)
-            self.db[self._db_key(yt_id)] = json.dumps(
-                {"title": title, "duration": seconds}
-            )
-        except (KeyError, IndexError):
-            print("data format error", data)
+        # Extract video titles and durations
+        for item in data.get("items", []):
+            try:
+                yt_id = item["id"]
+                title = item["snippet"]["title"]
+                duration = isodate.parse_duration(item["contentDetails"]["duration"])
+                seconds = duration.total_seconds()
+                print("Got title for", yt_id, title, "duration", seconds)
+                self.db[self._db_key(yt_id)] = json.dumps(
+                    {"title": title, "duration": seconds}
+                )
+                self._cache.pop(yt_id, None)
+                self.generation += 1
+            except (KeyError, IndexError, ValueError):
+                print("data format error", item)
 
     async def register_url(self, url: str) -> None:
+        """Queue the video for a metadata lookup; returns without waiting for it"""
         yt_id = extract_youtube_id(url)
         if not yt_id:
             return
@@ -98,20 +256,46 @@ class VideoFormatter:
         if isinstance(entry, str) and entry.startswith("{"):
             # we are already storing the details
             return
-        await self._fetch_details(yt_id)
+        self._pending[yt_id] = None
+        if self._batcher is None or self._batcher.done():
+            self._batcher = asyncio.create_task(self._fetch_pending())
+
+    async def _fetch_pending(self) -> None:
+        while self._pending:
+            await asyncio.sleep(self.batch_window)
+            while self._pending:
+                batch = list(islice(self._pending, MAX_BATCH_SIZE))
+                for yt_id in batch:
+                    del self._pending[yt_id]
+                # a failed batch is dropped: its videos are looked up
+                # again when someone next adds them
+                try:
+                    await self._fetch_details(batch)
+                except httpx.HTTPError as e:
+                    print("failed to fetch video details", batch, e)
+                except (ValueError, KeyError, TypeError, AttributeError) as e:
+                    print("malformed video details", batch, e)
+
+    async def drain(self) -> None:
+        """Wait until all queued metadata lookups are done"""
+        if self._batcher is not None:
+            await self._batcher
 
     async def search_youtube(self, query: str) -> list[dict[str, str]]:
         if "karaoke" not in query.lower():
             query += " karaoke"
-        url = "https://www.googleapis.com/youtube/v3/search"
-        response = await self.http.get(
-            url,
-            params=dict(
-                part="snippet", q=query, key=self.yt_api_key, type="video", maxResults=3
-            ),
+        if (cached := self.searches.get(query)) is not None:
+            return cached
+        response = await self._api_get(
+            "search",
+            part="snippet",
+            q=query,
+            key=self.yt_api_key,
+            type="video",
+            maxResults=3,
         )
         data = response.json()
-        return [
+        results = [
             {
                 "thumbnail": html.unescape(
                     item["snippet"]["thumbnails"]["default"]["url"]
@@ -122,3 +306,5 @@ class VideoFormatter:
             }
             for item in data["items"]
         ][:3]
+        self.searches.put(query, results)
+        return results
@@ -1,42 +1,223 @@
+import codecs
 import json
 import re
+from datetime import datetime
 from pathlib import Path
 import argparse
 from dataclasses import dataclass
+from typing import BinaryIO, Iterable, Iterator
 
+SINGER_RE = re.compile(r"Singer: (.+?)\nSong:")
 
-def parse_messages(messages):
+CHUNK_SIZE = 1 << 16
+
+# Telegram pretty-prints exports: every message starts on a line of its own
+MESSAGE_START = b"\n  {"
+
+
+def parse_message(msg):
+    """The track announced by the message, or None"""
+    if not (
+        msg.get("type") == "message"
+        and msg.get("from") == "Karaoke Host Bot"
+        and isinstance(msg.get("text"), list)
+    ):
+        return None
+    singer = None
+    song = None
+
+    for part in msg["text"]:
+        if isinstance(part, dict):
+            if part.get("type") == "mention":
+                singer = part["text"]
+            elif part.get("type") == "text_link":
+                song = part["text"]
+        elif isinstance(part, str):
+            # Look for "Singer: NAME\nSong:"
+            m = SINGER_RE.search(part)
+            if m:
+                singer = m.group(1).strip()
+
+    if singer and song:
+        timestamp = int(msg["date_unixtime"])
+        return {"time": timestamp, "singer": singer, "song": song}
+    return None
+
+
+def iter_tracks(messages: Iterable[dict]) -> Iterator[dict]:
     # Filter messages from the bot that contain singer and song
-    tracks = []
     for msg in messages:
-        if (
-            msg.get("type") == "message"
-            and msg.get("from") == "Karaoke Host Bot"
-            and isinstance(msg.get("text"), list)
-        ):
-            singer = None
-            song = None
-
-            for part in msg["text"]:
-                if isinstance(part, dict):
-                    if part.get("type") == "mention":
-                        singer = part["text"]
-                    elif part.get("type") == "text_link":
-                        song = part["text"]
-                elif isinstance(part, str):
-                    # Look for "Singer: NAME\nSong:"
-                    m = re.search(r"Singer: (.+?)\nSong:", part)
-                    if m:
-                        singer = m.group(1).strip()
-
-            if singer and song:
-                timestamp = int(msg["date_unixtime"])
-                tracks.append({"time": timestamp, "singer": singer, "song": song})
+        if track := parse_message(msg):
+            yield track
+
+
+def parse_messages(messages):
+    tracks = list(iter_tracks(messages))
     # Sort by timestamp just in case
     tracks.sort(key=lambda x: x["time"])
     return tracks
 
 
+class MessageReader:
+    """Reads the messages of an export one at a time, in constant memory.
+
+    Only the "messages" array is streamed; the other top-level fields
+    are small and are decoded whole.
+    """
+
+    def __init__(self, f: BinaryIO):
+        self.f = f
+        self.decoder = json.JSONDecoder()
+        self.text_decoder = codecs.getincrementaldecoder("utf-8")()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self) -> bool:
+        """Read another chunk; False at the end of the file"""
+        if self.eof:
+            return False
+        data = self.f.read(CHUNK_SIZE)
+        self.eof = not data
+        self.buffer = self.buffer[self.pos :] + self.text_decoder.decode(
+            data, final=self.eof
+        )
+        self.pos = 0
+        return bool(data)
+
+    def _skip(self, separators: str = "") -> str:
+        """Skip whitespace and separators; return the next character"""
+        while True:
+            while self.pos < len(self.buffer):
+                char = self.buffer[self.pos]
+                if not (char.isspace() or char in separators):
+                    return char
+                self.pos += 1
+            if not self._fill():
+                return ""
+
+    def _expect(self, char: str, separators: str = "") -> None:
+        if self._skip(separators) != char:
+            raise ValueError(f"Expected {char!r} at {self.f.tell()}")
+        self.pos += 1
+
+    def _value(self):
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                # a value can be cut short only by the end of the buffer
+                if self._fill():
+                    continue
+                raise
+            if end == len(self.buffer) and self._fill():
+                # a number may go on in the next chunk
+                continue
+            self.pos = end
+            return value
+
+    def find_messages(self) -> None:
+        """Move to the start of the "messages" array. An export without
+        one reads as having no messages."""
+        self._expect("{")
+        while self._skip(",") == '"':
+            key = self._value()
+            self._expect(":")
+            if key == "messages":
+                self._expect("[")
+                return
+            self._skip()
+            self._value()
+        # nothing left to iterate over
+        self.buffer = ""
+        self.pos = 0
+        self.eof = True
+
+    def seek(self, offset: int) -> None:
+        """Continue from a message that starts at `offset` of the file"""
+        self.f.seek(offset)
+        self.text_decoder.reset()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def __iter__(self) -> Iterator[dict]:
+        while self._skip(",") not in ("]", ""):
+            yield self._value()
+
+
+def message_time(msg) -> int:
+    return int(msg.get("date_unixtime", 0))
+
+
+def message_after(f: BinaryIO, offset: int) -> tuple[int, dict] | None:
+    """The first message that starts after `offset` of the file, and where"""
+    f.seek(offset)
+    data = b""
+    keep = len(MESSAGE_START) - 1  # in case a chunk ends inside the marker
+    while (start := data.find(MESSAGE_START)) < 0:
+        chunk = f.read(CHUNK_SIZE)
+        if not chunk:
+            return None
+        offset += max(len(data) - keep, 0)
+        data = data[-keep:] + chunk
+    start += offset + 1  # past the newline
+    reader = MessageReader(f)
+    reader.seek(start)
+    for msg in reader:
+        return start, msg
+    return None
+
+
+def seek_messages(f: BinaryIO, since: int) -> MessageReader:
+    """A reader at or shortly before the first message sent at `since` or
+    later. Messages are in chronological order, so the file is bisected."""
+    first = message_after(f, 0)
+    # a reader of its own: message_after() moved the file under any other
+    f.seek(0)
+    reader = MessageReader(f)
+    reader.find_messages()
+    if (
+        first is None
+        or first[1] != next(iter(reader), None)
+        or message_time(first[1]) >= since
+    ):
+        # not laid out the way Telegram writes it, or nothing to skip
+        f.seek(0)
+        reader = MessageReader(f)
+        reader.find_messages()
+        return reader
+    low, high = first[0], f.seek(0, 2)
+    while high - low > CHUNK_SIZE:
+        middle = (low + high) // 2
+        found = message_after(f, middle)
+        if found is None or found[0] >= high or message_time(found[1]) >= since:
+            high = middle
+        else:
+            low = found[0]
+    reader.seek(low)
+    return reader
+
+
+def read_messages(
+    f: BinaryIO, since: int | None = None, until: int | None = None
+) -> Iterator[dict]:
+    """Messages sent from `since` up to `until`, as unix times"""
+    if since is None:
+        reader = MessageReader(f)
+        reader.find_messages()
+    else:
+        reader = seek_messages(f, since)
+    for msg in reader:
+        time = message_time(msg)
+        if since is not None and time < since:
+            continue
+        if until is not None and time >= until:
+            # the rest are later still
+            return
+        yield msg
+
+
 def format_time(seconds):
     return f"{seconds:.3f}"  # float in seconds, 3 decimal places
 
@@ -48,26 +229,34 @@ class Span:
     label: str
 
 
-def generate_spans(tracks, final_duration_sec=360) -> list[Span]:
-    if not tracks:
-        return []
-
-    spans = []
-    base_time = tracks[0]["time"]
-    for i, track in enumerate(tracks):
-        start = track["time"] - base_time
-        if i + 1 < len(tracks):
-            end = tracks[i + 1]["time"] - base_time
+def iter_spans(tracks: Iterable[dict], final_duration_sec=360) -> Iterator[Span]:
+    base_time = None
+    previous = None
+    for track in tracks:
+        if previous is not None:
+            yield make_span(previous, track["time"] - base_time, base_time)
         else:
-            end = start + final_duration_sec
-        spans.append(
-            Span(
-                start=format_time(start),
-                end=format_time(end),
-                label=f"{track['singer']} – {track['song']}",
-            )
-        )
-    return spans
+            base_time = track["time"]
+        previous = track
+    if previous is not None:
+        end = previous["time"] - base_time + final_duration_sec
+        yield make_span(previous, end, base_time)
+
+
+def make_span(track, end, base_time) -> Span:
+    return Span(
+        start=format_time(track["time"] - base_time),
+        end=format_time(end),
+        label=f"{track['singer']} – {track['song']}",
+    )
+
+
+def generate_spans(tracks, final_duration_sec=360) -> list[Span]:
+    return list(iter_spans(tracks, final_duration_sec))
+
+
+def parse_date(text: str) -> int:
+    return int(datetime.fromisoformat(text).timestamp())
 
 
 def main():
@@ -75,18 +264,18 @@ def main():
         description="Generate karaoke label spans from chat export."
     )
     parser.add_argument("input_path", help="Path to the chat JSON file")
+    parser.add_argument(
+        "--since", type=parse_date, help="first date or time, e.g. 2024-12-31T20:00"
+    )
+    parser.add_argument("--until", type=parse_date, help="date or time to stop before")
     args = parser.parse_args()
 
     input_path = Path(args.input_path)
-    with input_path.open("r", encoding="utf-8") as f:
-        data = json.load(f)
-
-    messages = data.get("messages", [])
-    tracks = parse_messages(messages)
-    spans = generate_spans(tracks)
-
-    for span in spans:
-        print(f"{span.start}\t{span.end}\t{span.label}")
+    with input_path.open("rb") as f:
+        messages = read_messages(f, args.since, args.until)
+        # exports are in chronological order, so tracks can go out as read
+        for span in iter_spans(iter_tracks(messages)):
+            print(f"{span.start}\t{span.end}\t{span.label}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,79 @@
+import io
+import json
+import sys
+
+import labels
+
+
+def make_export(count: int, start: int = 1000, step: int = 10) -> dict:
+    return {
+        "name": "Karaoke",
+        "type": "private_group",
+        "messages": [
+            {
+                "id": i,
+                "type": "message",
+                "date_unixtime": str(start + i * step),
+                "from": "Karaoke Host Bot",
+                "text": [
+                    "Singer: ",
+                    {"type": "mention", "text": f"@singer{i}"},
+                    "\nSong: ",
+                    {"type": "text_link", "text": f"Песня {i}"},
+                ],
+            }
+            for i in range(count)
+        ],
+    }
+
+
+def pretty(export: dict) -> bytes:
+    # laid out the way Telegram writes it
+    return json.dumps(export, indent=1, ensure_ascii=False).encode()
+
+
+def compact(export: dict) -> bytes:
+    return json.dumps(export, ensure_ascii=False).encode()
+
+
+def read(data: bytes, since: int | None = None, until: int | None = None):
+    return [msg["id"] for msg in labels.read_messages(io.BytesIO(data), since, until)]
+
+
+def test_bisection(monkeypatch):
+    monkeypatch.setattr(labels, "CHUNK_SIZE", 256)
+    data = pretty(make_export(200))
+    assert read(data) == list(range(200))
+    assert read(data, since=1995) == list(range(100, 200))
+    assert read(data, since=1995, until=2100) == list(range(100, 110))
+    assert read(data, since=99999) == []
+    # the reader starts within a chunk of the first message wanted
+    first = next(iter(labels.seek_messages(io.BytesIO(data), 1995)))
+    assert 80 < first["id"] <= 100
+
+
+def test_compact_fallback(monkeypatch):
+    monkeypatch.setattr(labels, "CHUNK_SIZE", 256)
+    data = compact(make_export(200))
+    assert labels.message_after(io.BytesIO(data), 0) is None
+    assert read(data, since=1995, until=2100) == list(range(100, 110))
+    # read from the start
+    assert next(iter(labels.seek_messages(io.BytesIO(data), 1995)))["id"] == 0
+
+
+def test_no_messages():
+    data = b'{"name": "Karaoke", "type": "private_group"}'
+    assert read(data) == []
+    assert read(data, since=1000) == []
+
+
+def test_main(tmp_path, monkeypatch, capsys):
+    path = tmp_path / "result.json"
+    path.write_bytes(pretty(make_export(3, start=1700000000, step=60)))
+    until = labels.datetime.fromtimestamp(1700000120).isoformat()
+    monkeypatch.setattr(sys, "argv", ["labels.py", str(path), "--until", until])
+    labels.main()
+    assert capsys.readouterr().out.splitlines() == [
+        "0.000\t60.000\t@singer0 – Песня 0",
+        "60.000\t420.000\t@singer1 – Песня 1",
+    ]